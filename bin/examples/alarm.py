@@ -62,6 +62,13 @@ from weeutil.weeutil import timestamp_to_string
 class MyAlarm(StdService):
     """Custom service that sounds an alarm if an arbitrary expression evaluates true"""
     
+    # Sending email can be slow. Do it on a worker thread, so the engine
+    # does not have to wait:
+    dispatch = 'queued'
+    # Only section [Alarm] matters, so the service gets rebuilt on a reload
+    # only if that section has changed:
+    config_sections = ('Alarm',)
+    
     def __init__(self, engine, config_dict):
         # Pass the initialization information on to my superclass:
         super(MyAlarm, self).__init__(engine, config_dict)
@@ -63,6 +63,14 @@ from weeutil.weeutil import timestamp_to_string
 class BatteryAlarm(StdService):
     """Custom service that sounds an alarm if one of the batteries is low"""
     
+    # Sending email can be slow. Do it on a worker thread, so the engine
+    # does not have to wait:
+    dispatch = 'queued'
+    # Only the most recent LOOP packet matters, so skip any that pile up:
+    queue_policy = 'coalesce'
+    # Only section [Alarm] matters for a reload:
+    config_sections = ('Alarm',)
+    
     def __init__(self, engine, config_dict):
         # Pass the initialization information on to my superclass:
         super(BatteryAlarm, self).__init__(engine, config_dict)
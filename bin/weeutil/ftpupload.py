@@ -12,22 +12,32 @@
 import os
 import sys
 import ftplib
-import cPickle
 import time
 import syslog
 
-class FtpUpload:
+import upload
+
+class FtpUpload(upload.Uploader):
     """Uploads a directory and all its descendants to a remote server.
     
-    Keeps track of when a file was last uploaded, so it is uploaded only
-    if its modification time is newer."""
+    Only the files that have changed since the last upload are sent (see
+    weeutil.upload.Uploader), over one or more FTP sessions.
+    
+    Each file is uploaded under a temporary name, then renamed, so anyone
+    reading the remote site never sees a partly written file."""
+
+    # Failures that mean the file should be tried again:
+    errors = ftplib.all_errors
 
     def __init__(self, server, 
                  user, password, 
                  local_root, remote_root, 
                  name      = "FTP", 
                  passive   = True, 
-                 max_tries = 3):
+                 max_tries = 3,
+                 retry_delay = 2,
+                 max_connections = 1,
+                 use_rename = True):
         """Initialize an instance of FtpUpload.
         
         After initializing, call method run() to perform the upload.
@@ -46,121 +56,125 @@ class FtpUpload:
         
         max_tries: How many times to try creating a directory or uploading
         a file before giving up [Optional. Default is 3]
+        
+        retry_delay: How long to wait before the second try, in seconds. It
+        doubles for each try after that. [Optional. Default is 2]
+        
+        max_connections: How many FTP sessions to use at once. Some servers
+        limit the number of sessions a user can have. [Optional. Default is 1]
+        
+        use_rename: True to upload each file under a temporary name, then rename
+        it; False to write it in place. [Optional. Default is True]
         """
+        upload.Uploader.__init__(self, local_root, remote_root, name,
+                                 max_tries       = max_tries,
+                                 retry_delay     = retry_delay,
+                                 max_connections = max_connections)
         self.server      = server
         self.user        = user
         self.password    = password
-        self.local_root  = os.path.normpath(local_root)
-        self.remote_root = os.path.normpath(remote_root)
-        self.name        = name
         self.passive     = passive
-        self.max_tries   = max_tries
+        self.use_rename  = use_rename
 
-    def run(self):
-        """Perform the actual upload.
-        
-        returns: the number of files uploaded."""
-        
-        # Get the timestamp and members of the last upload:
-        (timestamp, fileset) = self.getLastUpload()
-
-        n_uploaded = 0
+    def _connect(self):
+        """Open and log into an FTP session."""
+        ftp_server = ftplib.FTP(self.server)
+        #ftp_server.set_debuglevel(1)
+        ftp_server.login(self.user, self.password)
+        ftp_server.set_pasv(self.passive)
+        return ftp_server
+    
+    def _disconnect(self, ftp_server):
         try:
-            ftp_server = ftplib.FTP(self.server)
-            #ftp_server.set_debuglevel(1)
-            ftp_server.login(self.user, self.password)
-            ftp_server.set_pasv(self.passive)
-            
-            # Walk the local directory structure
-            for (dirpath, unused_dirnames, filenames) in os.walk(self.local_root):
+            ftp_server.quit()
+        except:
+            pass
     
-                # Strip out the common local root directory. What is left
-                # will be the relative directory both locally and remotely.
-                local_rel_dir_path = dirpath.replace(self.local_root, '.')
-                if self._skipThisDir(local_rel_dir_path):
-                    continue
-                # This is the absolute path to the remote directory:
-                remote_dir_path = os.path.normpath(os.path.join(self.remote_root, local_rel_dir_path))
+    def _transfer(self, ftp_server, full_local_path, full_remote_path):
+        if not self.use_rename:
+            self._store(ftp_server, full_local_path, full_remote_path)
+            return
+        # Upload to a temporary (hidden) name in the same directory, then
+        # rename it over the old file:
+        tmp_remote_path = upload._tmp_path(full_remote_path)
+        try:
+            self._store(ftp_server, full_local_path, tmp_remote_path)
+            if self._rename(ftp_server, tmp_remote_path, full_remote_path):
+                return
+        except ftplib.all_errors:
+            self._delete(ftp_server, tmp_remote_path)
+            raise
+        # The server would not rename it. Write it in place instead:
+        self._delete(ftp_server, tmp_remote_path)
+        self._store(ftp_server, full_local_path, full_remote_path)
     
-                # Make the remote directory if necessary:
-                self._make_remote_dir(ftp_server, remote_dir_path)
-                    
-                # Now iterate over all members of the local directory:
-                for filename in filenames:
+    def _store(self, ftp_server, full_local_path, remote_path):
+        fd = open(full_local_path, "rb")
+        try:
+            ftp_server.storbinary("STOR %s" % remote_path, fd)
+        finally:
+            fd.close()
     
-                    full_local_path = os.path.join(dirpath, filename)
-                    # See if this file can be skipped:
-                    if self._skipThisFile(timestamp, fileset, full_local_path):
-                        continue
+    def _recover(self, ftp_server):
+        ftp_server.set_pasv(self.passive)
     
-                    full_remote_path = os.path.join(remote_dir_path, filename)
-                    STOR_cmd = "STOR %s" % full_remote_path
-                    # Retry up to max_tries times:
-                    for count in range(self.max_tries):
-                        try:
-                            # If we have to retry, we should probably reopen the file as well.
-                            # Hence, the open is in the inner loop:
-                            fd = open(full_local_path, "r")
-                            ftp_server.storbinary(STOR_cmd, fd)
-                        except (ftplib.all_errors, IOError), e:
-                            # Unsuccessful. Log it and go around again.
-                            syslog.syslog(syslog.LOG_ERR, "ftpupload: attempt #%d. Failed uploading %s. Reason: %s" % (count+1, full_remote_path, e))
-                            ftp_server.set_pasv(self.passive)
-                        else:
-                            # Success. Log it, break out of the loop
-                            n_uploaded += 1
-                            fileset.add(full_local_path)
-                            syslog.syslog(syslog.LOG_DEBUG, "ftpupload: Uploaded file %s" % full_remote_path)
-                            break
-                        finally:
-                            # This is always executed on every loop. Close the file.
-                            try:
-                                fd.close()
-                            except:
-                                pass
-                    else:
-                        # This is executed only if the loop terminates naturally (without a break statement),
-                        # meaning the upload failed max_tries times. Log it, move on to the next file.
-                        syslog.syslog(syslog.LOG_ERR, "ftpupload: Failed to upload file %s" % full_remote_path)
-        finally:
-            try:
-                ftp_server.quit()
-            except:
-                pass
+    def _rename(self, ftp_server, from_path, to_path):
+        """Rename a remote file, replacing any file already there.
         
-        timestamp = time.time()
-        self.saveLastUpload(timestamp, fileset)
-        return n_uploaded
+        returns: True if it was renamed. False if the server would not, and the
+        file should be written in place instead. Any old file may have been
+        deleted by then."""
+        try:
+            ftp_server.rename(from_path, to_path)
+            return True
+        except ftplib.error_perm, e:
+            if not self._exists(ftp_server, to_path):
+                # Nothing in the way, so the server must not allow renaming at all:
+                syslog.syslog(syslog.LOG_ERR, "ftpupload: Server %s will not rename files (%s). Uploading in place instead." % (self.server, e))
+                self.use_rename = False
+                return False
+        # Some servers will not rename over an existing file. Delete it first.
+        # Readers may miss the file for a moment, but will never see part of one:
+        ftp_server.delete(to_path)
+        try:
+            ftp_server.rename(from_path, to_path)
+        except ftplib.error_perm, e:
+            # Nothing was in the way this time, so the server must not allow
+            # renaming at all. The old file is gone. The caller must put the
+            # new one in its place:
+            syslog.syslog(syslog.LOG_ERR, "ftpupload: Server %s will not rename files (%s). Uploading in place instead." % (self.server, e))
+            self.use_rename = False
+            return False
+        return True
     
-    def getLastUpload(self):
-        """Reads the time and members of the last upload from the local root"""
-        
-        timeStampFile = os.path.join(self.local_root, "#%s.last" % self.name )
+    def _exists(self, ftp_server, remote_path):
+        """Return True if a remote file exists."""
         try:
-            f = open(timeStampFile, "r")
-            timestamp = cPickle.load(f)
-            fileset   = cPickle.load(f) 
-            f.close()
-        except IOError:
-            timestamp = 0
-            fileset = set()
-        return (timestamp, fileset)
-
-    def saveLastUpload(self, timestamp, fileset):
-        """Saves the time and members of the last upload in the local root."""
-        timeStampFile = os.path.join(self.local_root, "#%s.last" % self.name )
+            ftp_server.size(remote_path)
+            return True
+        except ftplib.error_perm, e:
+            if str(e).startswith('550'):
+                return False
+        # The server does not do SIZE. List the directory instead:
+        (remote_dir_path, filename) = os.path.split(remote_path)
+        try:
+            return filename in [os.path.basename(name) for name in ftp_server.nlst(remote_dir_path)]
+        except ftplib.error_perm:
+            return False
+    
+    def _delete(self, ftp_server, remote_path):
+        """Delete a remote file, if it is there."""
         try:
-            f = open(timeStampFile, "w")
-            cPickle.dump(timestamp, f)
-            cPickle.dump(fileset,   f)
-            f.close()
-        except IOError:
+            ftp_server.delete(remote_path)
+        except ftplib.all_errors:
             pass
-                
+    
     def _make_remote_dir(self, ftp_server, remote_dir_path):
         """Make a remote directory if necessary."""
         # Try to make the remote directory up max_tries times, then give up.
-        for unused_count in range(self.max_tries):
+        for count in range(self.max_tries):
+            if count:
+                time.sleep(self.retry_delay * 2 ** (count - 1))
             try:
                 ftp_server.mkd(remote_dir_path)
             except ftplib.all_errors, e:
@@ -169,34 +183,15 @@ class FtpUpload:
                     # Directory already exists
                     return
                 syslog.syslog(syslog.LOG_ERR, "ftpupload: Got error while attempting to make remote directory %s" % remote_dir_path)
-                syslog.syslog(syslog.LOG_ERR, "     ****  Error:" % e)
+                syslog.syslog(syslog.LOG_ERR, "     ****  Error: %s" % e)
             else:
                 syslog.syslog(syslog.LOG_DEBUG, "ftpupload: Made directory %s" % remote_dir_path)
                 return
         else:
             syslog.syslog(syslog.LOG_ERR, "ftpupload: Unable to create remote directory %s" % remote_dir_path)
             raise IOError, "Unable to create remote directory %s" % remote_dir_path
-            
-    def _skipThisDir(self, local_dir):
-        
-        return os.path.basename(local_dir) in ('.svn', 'CVS')
 
-    def _skipThisFile(self, timestamp, fileset, full_local_path):
-        
-        filename = os.path.basename(full_local_path)
-        if filename[-1] == '~' or filename[0] == '#' :
-            return True
-        
-        if full_local_path not in fileset:
-            return False
-        
-        if os.stat(full_local_path).st_mtime > timestamp:
-            return False
-        
-        # Filename is in the set, and is up to date. 
-        return True
-        
-        
+
 if __name__ == '__main__':
     
     import weewx
@@ -207,8 +202,13 @@ if __name__ == '__main__':
     syslog.openlog('ftpupload', syslog.LOG_PID|syslog.LOG_CONS)
     syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_DEBUG))
 
+    # With --dry-run, just list what would be uploaded:
+    dry_run = '--dry-run' in sys.argv
+    if dry_run:
+        sys.argv.remove('--dry-run')
+
     if len(sys.argv) < 2 :
-        print """Usage: ftpupload.py path-to-configuration-file [path-to-be-ftp'd]"""
+        print """Usage: ftpupload.py path-to-configuration-file [path-to-be-ftp'd] [--dry-run]"""
         exit()
         
     try :
@@ -238,6 +238,12 @@ if __name__ == '__main__':
                            config_dict['Reports']['FTP']['path'],
                            'FTP',
                            config_dict['Reports']['FTP'].as_bool('passive'),
-                           config_dict['Reports']['FTP'].as_int('max_tries'))
-    ftp_upload.run()
+                           config_dict['Reports']['FTP'].as_int('max_tries'),
+                           max_connections = int(config_dict['Reports']['FTP'].get('max_connections', 1)),
+                           use_rename = config_dict['Reports']['FTP'].as_bool('use_rename') if config_dict['Reports']['FTP'].has_key('use_rename') else True)
+    if dry_run:
+        for (full_local_path, full_remote_path) in ftp_upload.dryRun():
+            print "%s -> %s" % (full_local_path, full_remote_path)
+    else:
+        ftp_upload.run()
     
\ No newline at end of file
@@ -0,0 +1,517 @@
+#
+#    Copyright (c) 2009, 2010, 2011 Tom Keffer <tkeffer@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+#    $Revision$
+#    $Author$
+#    $Date$
+#
+"""For publishing a directory and all its descendants to a web server.
+
+Class Uploader does the work common to all ways of publishing: it works out
+which files have changed since the last upload, hands them out to one or more
+sessions, and remembers what was done. A subclass supplies the transport:
+
+    LocalUpload:  Copies the files into a local directory,
+                  such as the document root of a web server on the same
+                  machine, or an NFS mount.
+
+    RsyncUpload:  Sends the files with rsync, over ssh.
+
+    FtpUpload:    Sends the files by FTP. See module weeutil.ftpupload.
+
+In all cases a file replaces the old one in a single step, so a reader never
+sees part of a file.
+"""
+from __future__ import with_statement
+
+import os
+import cPickle
+import errno
+import hashlib
+import Queue
+import shutil
+import subprocess
+import threading
+import time
+import syslog
+
+#===============================================================================
+#                    Class Uploader
+#===============================================================================
+
+class Uploader(object):
+    """Base class for uploading a directory and all its descendants.
+
+    Keeps track of when a file was last uploaded, so it is uploaded only
+    if its modification time is newer. It also keeps a manifest of the size
+    and MD5 digest of each file uploaded, so a file whose modification time
+    has changed, but whose contents have not, does not get uploaded again.
+
+    The remote directories known to exist are remembered as well, so they are
+    not made again on every run.
+
+    The files can be uploaded over several sessions at once, each taking the
+    next file from a shared list.
+
+    Subclasses override _connect(), _disconnect(), _make_remote_dir(), and
+    _transfer()."""
+
+    # The exceptions that mean a transfer failed, and should be tried again:
+    errors = (IOError, OSError)
+
+    def __init__(self, local_root, remote_root,
+                 name      = "FTP",
+                 max_tries = 3,
+                 retry_delay = 2,
+                 max_connections = 1):
+        """Initialize an instance of Uploader.
+
+        local_root: The local directory to be uploaded.
+
+        remote_root: Where it is to go.
+
+        name: A unique name to be given for this session. This allows more than
+        one session to be uploading from the same local directory. [Optional.
+        Default is 'FTP'.]
+
+        max_tries: How many times to try creating a directory or uploading
+        a file before giving up [Optional. Default is 3]
+
+        retry_delay: How long to wait before the second try, in seconds. It
+        doubles for each try after that. [Optional. Default is 2]
+
+        max_connections: How many sessions to use at once. [Optional. Default is 1]
+        """
+        self.local_root  = os.path.normpath(local_root)
+        self.remote_root = os.path.normpath(remote_root)
+        self.name        = name
+        self.max_tries   = max_tries
+        self.retry_delay = retry_delay
+        self.max_connections = max(int(max_connections), 1)
+
+    def run(self):
+        """Perform the actual upload.
+
+        returns: the number of files uploaded."""
+
+        # Get the timestamp, members, manifest, and remote directories of the last upload:
+        (timestamp, fileset, manifest, dirset) = self.getLastUpload()
+
+        t1 = time.time()
+        # Work out what has to be done:
+        (dir_list, file_list) = self._getWork(timestamp, fileset, manifest)
+
+        # The files to be uploaded go in a queue, shared by all the sessions:
+        work_queue = Queue.Queue()
+        for item in file_list:
+            work_queue.put(item)
+        # How many files, and bytes, have been uploaded. Guarded by the lock:
+        self.lock  = threading.Lock()
+        self.stats = {'files' : 0, 'bytes' : 0}
+
+        nconnections = min(self.max_connections, len(file_list))
+        session = None
+        try:
+            session = self._connect()
+
+            # Make the remote directories first, so they are there for all the
+            # sessions. Those made on an earlier run can be skipped:
+            for remote_dir_path in dir_list:
+                if remote_dir_path not in dirset:
+                    self._make_remote_dir(session, remote_dir_path)
+                    dirset.add(remote_dir_path)
+
+            # Start any extra sessions, each on its own thread. This session is
+            # used on this thread:
+            threads = []
+            for i in range(1, nconnections):
+                thread = threading.Thread(target=self._uploadWorker, args=(None, work_queue, fileset, manifest, dirset),
+                                          name="%s-%d" % (self.__class__.__name__, i))
+                thread.setDaemon(True)
+                thread.start()
+                threads.append(thread)
+            self._uploadWorker(session, work_queue, fileset, manifest, dirset)
+            for thread in threads:
+                thread.join()
+        finally:
+            self._disconnect(session)
+
+        t2 = time.time()
+        if self.stats['files']:
+            syslog.syslog(syslog.LOG_DEBUG, "upload: Uploaded %d files (%d bytes) in %.2f seconds over %d connections (%.1f files/s; %.1f kB/s)" %
+                          (self.stats['files'], self.stats['bytes'], t2 - t1, max(nconnections, 1),
+                           self.stats['files'] / (t2 - t1), self.stats['bytes'] / 1024.0 / (t2 - t1)))
+
+        timestamp = time.time()
+        self.saveLastUpload(timestamp, fileset, manifest, dirset)
+        return self.stats['files']
+
+    def dryRun(self):
+        """Work out what would be uploaded, without uploading anything.
+
+        returns: A list of 2-way tuples (full_local_path, full_remote_path)."""
+        (timestamp, fileset, manifest, unused_dirset) = self.getLastUpload()
+        (unused_dir_list, file_list) = self._getWork(timestamp, fileset, manifest)
+        return [(full_local_path, full_remote_path) for (full_local_path, full_remote_path, unused_signature) in file_list]
+
+    def _getWork(self, timestamp, fileset, manifest):
+        """Walk the local directory structure, and work out what has to be done.
+
+        returns: A 2-way tuple. The first element is a list of the remote
+        directories. The second is a list of 3-way tuples (full_local_path,
+        full_remote_path, signature), one for each file to be uploaded. The
+        signature is a 2-way tuple (size, MD5 digest) of the file."""
+        dir_list  = []
+        file_list = []
+        for (dirpath, unused_dirnames, filenames) in os.walk(self.local_root):
+
+            # Strip out the common local root directory. What is left
+            # will be the relative directory both locally and remotely.
+            local_rel_dir_path = dirpath.replace(self.local_root, '.')
+            if self._skipThisDir(local_rel_dir_path):
+                continue
+            # This is the absolute path to the remote directory:
+            remote_dir_path = os.path.normpath(os.path.join(self.remote_root, local_rel_dir_path))
+            dir_list.append(remote_dir_path)
+
+            # Now iterate over all members of the local directory:
+            for filename in filenames:
+
+                full_local_path = os.path.join(dirpath, filename)
+                # See if this file can be skipped:
+                if self._skipThisFile(timestamp, fileset, full_local_path):
+                    continue
+                full_remote_path = os.path.join(remote_dir_path, filename)
+                # The file is new, or has been touched. See if its contents
+                # have actually changed since it was last uploaded:
+                try:
+                    signature = _signature(full_local_path)
+                except IOError:
+                    # It disappeared. Nothing to upload:
+                    continue
+                if full_local_path in fileset and manifest.get(full_remote_path) == signature:
+                    continue
+                file_list.append((full_local_path, full_remote_path, signature))
+        return (dir_list, file_list)
+
+    def _uploadWorker(self, session, work_queue, fileset, manifest, dirset):
+        """Upload files from the queue until it is empty.
+
+        session: The session to use. If None, a new one is opened (and
+        closed when done)."""
+        own_session = session is None
+        try:
+            if own_session:
+                try:
+                    session = self._connect()
+                except self.errors, e:
+                    # The other sessions will have to do the work:
+                    syslog.syslog(syslog.LOG_ERR, "upload: Unable to open extra session. Reason: %s" % (e,))
+                    return
+            while True:
+                try:
+                    (full_local_path, full_remote_path, signature) = work_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                if self._uploadFile(session, full_local_path, full_remote_path):
+                    with self.lock:
+                        fileset.add(full_local_path)
+                        manifest[full_remote_path] = signature
+                        self.stats['files'] += 1
+                        self.stats['bytes'] += signature[0]
+                else:
+                    # Perhaps the remote directory has gone. Make sure it is
+                    # made again next time:
+                    with self.lock:
+                        dirset.discard(os.path.dirname(full_remote_path))
+        finally:
+            if own_session:
+                self._disconnect(session)
+
+    def _uploadFile(self, session, full_local_path, full_remote_path):
+        """Upload a single file, trying up to max_tries times.
+
+        returns: True if it was uploaded, False otherwise."""
+        # Retry up to max_tries times:
+        for count in range(self.max_tries):
+            # Give the server a moment before trying again:
+            if count:
+                time.sleep(self.retry_delay * 2 ** (count - 1))
+            try:
+                self._transfer(session, full_local_path, full_remote_path)
+            except self.errors, e:
+                # Unsuccessful. Log it and go around again.
+                syslog.syslog(syslog.LOG_ERR, "upload: attempt #%d. Failed uploading %s. Reason: %s" % (count+1, full_remote_path, e))
+                self._recover(session)
+            else:
+                # Success. Log it, break out of the loop
+                syslog.syslog(syslog.LOG_DEBUG, "upload: Uploaded file %s" % full_remote_path)
+                return True
+        # The upload failed max_tries times. Log it, move on to the next file.
+        syslog.syslog(syslog.LOG_ERR, "upload: Failed to upload file %s" % full_remote_path)
+        return False
+
+    def _connect(self):
+        """Open a session. Returns whatever _transfer() needs to use it."""
+        return None
+
+    def _disconnect(self, session):
+        """Close a session opened by _connect(). It may be None."""
+        pass
+
+    def _make_remote_dir(self, session, remote_dir_path):
+        """Make a remote directory if necessary."""
+        pass
+
+    def _transfer(self, session, full_local_path, full_remote_path):
+        """Upload a single file, replacing any already there. Raise one of
+        self.errors if it fails."""
+        raise NotImplementedError, "Method _transfer() not implemented by %s" % self.__class__.__name__
+
+    def _recover(self, session):
+        """Called after a failed transfer, before trying again."""
+        pass
+
+    def getLastUpload(self):
+        """Reads the time, members, manifest, and remote directories of the last
+        upload from the local root"""
+
+        timestamp = 0
+        fileset   = set()
+        manifest  = {}
+        dirset    = set()
+        timeStampFile = os.path.join(self.local_root, "#%s.last" % self.name )
+        try:
+            f = open(timeStampFile, "r")
+            try:
+                timestamp = cPickle.load(f)
+                fileset   = cPickle.load(f)
+                # Older versions did not save these:
+                manifest  = cPickle.load(f)
+                dirset    = cPickle.load(f)
+            except EOFError:
+                pass
+            f.close()
+        except IOError:
+            pass
+        return (timestamp, fileset, manifest, dirset)
+
+    def saveLastUpload(self, timestamp, fileset, manifest, dirset):
+        """Saves the time, members, manifest, and remote directories of the last
+        upload in the local root."""
+        timeStampFile = os.path.join(self.local_root, "#%s.last" % self.name )
+        try:
+            f = open(timeStampFile, "w")
+            cPickle.dump(timestamp, f)
+            cPickle.dump(fileset,   f)
+            cPickle.dump(manifest,  f)
+            cPickle.dump(dirset,    f)
+            f.close()
+        except IOError:
+            pass
+
+    def _skipThisDir(self, local_dir):
+
+        return os.path.basename(local_dir) in ('.svn', 'CVS')
+
+    def _skipThisFile(self, timestamp, fileset, full_local_path):
+
+        filename = os.path.basename(full_local_path)
+        if filename[-1] == '~' or filename[0] == '#' :
+            return True
+
+        if full_local_path not in fileset:
+            return False
+
+        if os.stat(full_local_path).st_mtime > timestamp:
+            return False
+
+        # Filename is in the set, and is up to date.
+        return True
+
+def _signature(full_local_path):
+    """Return the size and MD5 digest of a file, as a 2-way tuple."""
+    digest = hashlib.md5()
+    nbytes = 0
+    f = open(full_local_path, "rb")
+    try:
+        while True:
+            block = f.read(65536)
+            if not block:
+                break
+            digest.update(block)
+            nbytes += len(block)
+    finally:
+        f.close()
+    return (nbytes, digest.hexdigest())
+
+def _tmp_path(full_remote_path):
+    """The temporary (hidden) name a file is uploaded under, before it is
+    renamed into place."""
+    (remote_dir_path, filename) = os.path.split(full_remote_path)
+    return os.path.join(remote_dir_path, ".%s.tmp" % filename)
+
+#===============================================================================
+#                    Class LocalUpload
+#===============================================================================
+
+class LocalUpload(Uploader):
+    """Publishes a directory to another directory on the same machine.
+
+    Each file is copied to a temporary name next to its destination, then
+    renamed into place. The files are always copied, never hard linked: the
+    report generators rewrite their files in place, which would show through
+    a link."""
+
+    def __init__(self, local_root, remote_root, name = "FTP", **kwargs):
+        """Initialize an instance of LocalUpload.
+
+        For the arguments, see Uploader."""
+        Uploader.__init__(self, local_root, remote_root, name, **kwargs)
+
+    def _make_remote_dir(self, session, remote_dir_path):
+        try:
+            os.makedirs(remote_dir_path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                syslog.syslog(syslog.LOG_ERR, "upload: Unable to create directory %s" % remote_dir_path)
+                raise IOError, "Unable to create directory %s" % remote_dir_path
+
+    def _transfer(self, session, full_local_path, full_remote_path):
+        tmp_remote_path = _tmp_path(full_remote_path)
+        shutil.copy2(full_local_path, tmp_remote_path)
+        os.rename(tmp_remote_path, full_remote_path)
+
+#===============================================================================
+#                    Class RsyncUpload
+#===============================================================================
+
+class RsyncUpload(Uploader):
+    """Publishes a directory to a remote server with rsync, over ssh.
+
+    The files are sent in batches, each by one run of rsync. rsync makes any
+    directories needed, and writes each file under a temporary name before
+    renaming it into place. Each session runs its own rsync, so several batches
+    can be in flight at once."""
+
+    def __init__(self, server, local_root, remote_root, name = "FTP",
+                 user = None, port = None, timeout = None, batch_size = 100, **kwargs):
+        """Initialize an instance of RsyncUpload.
+
+        server: The remote server to which the files are to be uploaded.
+
+        user: The user name to log in as. [Optional. Default is the ssh default]
+
+        port: The ssh port. [Optional. Default is the ssh default]
+
+        timeout: How long rsync should wait for the server, in seconds.
+        [Optional. Default is to wait forever]
+
+        batch_size: The most files to send in one run of rsync. [Optional.
+        Default is 100]
+
+        For the other arguments, see Uploader."""
+        Uploader.__init__(self, local_root, remote_root, name, **kwargs)
+        self.server     = server
+        self.user       = user
+        self.port       = port
+        self.timeout    = timeout
+        self.batch_size = batch_size
+
+    def _uploadWorker(self, session, work_queue, fileset, manifest, dirset):
+        """Upload files from the queue in batches, until it is empty."""
+        while True:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(work_queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if not batch:
+                return
+            if self._uploadBatch([full_local_path for (full_local_path, unused_remote, unused_signature) in batch]):
+                with self.lock:
+                    for (full_local_path, full_remote_path, signature) in batch:
+                        fileset.add(full_local_path)
+                        manifest[full_remote_path] = signature
+                        self.stats['files'] += 1
+                        self.stats['bytes'] += signature[0]
+
+    def _uploadBatch(self, local_path_list):
+        """Send a batch of files, trying up to max_tries times.
+
+        returns: True if they were all uploaded, False otherwise."""
+        # The paths, relative to the local root, are fed to rsync on its standard
+        # input. The directory structure below the root is kept on the server:
+        rel_path_list = [full_local_path[len(self.local_root):].lstrip(os.sep) for full_local_path in local_path_list]
+        cmd = ['rsync', '--times', '--from0', '--files-from=-']
+        if self.port:
+            cmd.append('--rsh=ssh -p %d' % int(self.port))
+        if self.timeout:
+            cmd.append('--timeout=%d' % int(self.timeout))
+        destination = "%s:%s/" % (self.server, self.remote_root)
+        if self.user:
+            destination = "%s@%s" % (self.user, destination)
+        cmd += [self.local_root + os.sep, destination]
+
+        for count in range(self.max_tries):
+            if count:
+                time.sleep(self.retry_delay * 2 ** (count - 1))
+            try:
+                proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                output = proc.communicate('\0'.join(rel_path_list))[0]
+            except OSError, e:
+                syslog.syslog(syslog.LOG_ERR, "upload: Unable to run rsync. Reason: %s" % (e,))
+                return False
+            if proc.returncode == 0:
+                syslog.syslog(syslog.LOG_DEBUG, "upload: rsync'd %d files to %s" % (len(rel_path_list), destination))
+                return True
+            syslog.syslog(syslog.LOG_ERR, "upload: attempt #%d. rsync to %s failed with code %d" % (count+1, destination, proc.returncode))
+            for line in output.splitlines()[-5:]:
+                syslog.syslog(syslog.LOG_ERR, "     ****  %s" % line)
+        syslog.syslog(syslog.LOG_ERR, "upload: Failed to rsync %d files to %s" % (len(rel_path_list), destination))
+        return False
+
+
+if __name__ == '__main__':
+
+    # Publish a directory of "images" locally. Then touch them all, as the
+    # report generators would, and publish again: nothing should be sent.
+    # Finally, rewrite one in place, as the generators do, and make sure the
+    # published copy is not affected.
+    import tempfile
+
+    src = tempfile.mkdtemp()
+    for sub in ('', 'NOAA', 'mobile'):
+        if sub:
+            os.mkdir(os.path.join(src, sub))
+        for i in range(200):
+            open(os.path.join(src, sub, 'image%d.png' % i), 'wb').write(os.urandom(20000))
+
+    dest = tempfile.mkdtemp()
+    uploader = LocalUpload(src, dest, name = 'test', max_connections = 4)
+    t1 = time.time()
+    N = uploader.run()
+    t2 = time.time()
+    print "%d files in %.3f seconds" % (N, t2 - t1)
+    assert N == 600
+    assert open(os.path.join(dest, 'NOAA', 'image7.png'), 'rb').read() == open(os.path.join(src, 'NOAA', 'image7.png'), 'rb').read()
+    assert not [f for f in os.listdir(dest) if f.endswith('.tmp')]
+
+    for (dirpath, unused_dirnames, filenames) in os.walk(src):
+        for filename in filenames:
+            if filename[0] != '#':
+                os.utime(os.path.join(dirpath, filename), None)
+    open(os.path.join(src, 'image3.png'), 'wb').write('changed')
+    uploader = LocalUpload(src, dest, name = 'test')
+    print "After touching all files, and changing one:", uploader.dryRun()
+    assert uploader.run() == 1
+    assert open(os.path.join(dest, 'image3.png'), 'rb').read() == 'changed'
+
+    open(os.path.join(src, 'image3.png'), 'wb').write('partial')
+    assert open(os.path.join(dest, 'image3.png'), 'rb').read() == 'changed'
+
+    for d in (src, dest):
+        shutil.rmtree(d)
@@ -606,8 +606,8 @@ def log_traceback(prefix=''):
         syslog.syslog(syslog.LOG_INFO, prefix + line)
     del sfd
     
-def _get_object(module_class, *args, **kwargs):
-    """Given a path to a class, instantiates an instance of the class with the given args and returns it."""
+def _get_class(module_class):
+    """Given a path to a class, imports its module and returns the class."""
     
     # Split the path into its parts
     parts = module_class.split('.')
@@ -618,8 +618,13 @@ def _get_object(module_class, *args, **kwargs):
     # Then recursively work down from the top level module to the class name:
     for part in parts[1:]:
         mod = getattr(mod, part)
-    # Instance 'mod' will now be a class. Instantiate an instance and return it:
-    obj = mod(*args, **kwargs)
+    # Instance 'mod' will now be a class:
+    return mod
+
+def _get_object(module_class, *args, **kwargs):
+    """Given a path to a class, instantiates an instance of the class with the given args and returns it."""
+    
+    obj = _get_class(module_class)(*args, **kwargs)
     return obj
         
 if __name__ == '__main__':
@@ -0,0 +1,671 @@
+#
+#    Copyright (c) 2011 Tom Keffer <tkeffer@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+#    $Revision$
+#    $Author$
+#    $Date$
+#
+"""A simulated Davis VantagePro console, for testing without hardware.
+
+Select it by setting station_type = Simulator in weewx.conf. Class Simulator
+is a VantagePro, but instead of a serial port, it talks to an in-process
+FakeConsole. The fake console speaks the Davis serial protocol: wakeups, LOOP,
+DMPAFT, GETTIME, SETTIME, EEBRD, RXCHECK, SETPER and CLRLOG. The LOOP packets
+and archive pages it sends are byte-for-byte what a real console would send,
+including the CRCs, so the complete VantagePro driver gets exercised.
+
+The console has its own clock, which can run faster than real time. Every
+archive interval on that clock, it logs a new archive record into its
+memory. The weather comes either from a simple synthetic model, or from
+the records in an existing weewx archive, which get replayed.
+
+CRC errors and timeouts can be injected at random, to test the retry logic.
+"""
+
+from __future__ import with_statement
+import math
+import random
+import struct
+import syslog
+import time
+
+import weewx
+import weewx.VantagePro
+import weewx.archive
+from weewx.VantagePro import _ack, _resend
+from weewx.crc16 import crc16
+import weeutil.weeutil
+
+# A couple more characters used by the Davis protocol:
+_esc    = chr(0x1b)
+_cancel = chr(0x18)
+
+# How many archive records the console can hold (512 pages of 5 records each):
+_max_records = 2560
+
+#===============================================================================
+#                    Class SimulatedClock
+#===============================================================================
+
+class SimulatedClock(object):
+    """A clock that can run faster than real time."""
+
+    def __init__(self, start_ts, speedup=1.0):
+        """Initialize an instance of SimulatedClock.
+
+        start_ts: What time the clock should read right now.
+
+        speedup: How many times faster than real time the clock should run."""
+        self.speedup = float(speedup)
+        self.setTime(start_ts)
+
+    def time(self):
+        return self.start_ts + (time.time() - self.real_start_ts) * self.speedup
+
+    def setTime(self, ts):
+        self.start_ts      = ts
+        self.real_start_ts = time.time()
+
+    def sleep(self, seconds):
+        """Sleep for the given number of seconds of simulated time."""
+        if seconds > 0:
+            time.sleep(seconds / self.speedup)
+
+#===============================================================================
+#                    Weather sources
+#===============================================================================
+
+class SyntheticWeather(object):
+    """Makes up plausible weather, as a function of time."""
+
+    def __init__(self, seed=None):
+        self.seed = seed
+
+    def getRecord(self, ts):
+        """Return a record of the weather at time ts, in US units."""
+        # Seed the noise with the time, so the same time always gives the same weather:
+        rand = random.Random(hash((self.seed, int(ts))))
+        day  = 2.0 * math.pi * ((ts % 86400) - 21600) / 86400.0
+        week = 2.0 * math.pi * (ts % 604800) / 604800.0
+        outTemp = 50.0 + 15.0 * math.sin(day) + 5.0 * math.sin(week)
+        outHumidity = 70.0 - 20.0 * math.sin(day)
+        windSpeed = max(0.0, 8.0 + 6.0 * math.sin(week * 3) + rand.gauss(0.0, 2.0))
+        windDir   = (270.0 + 90.0 * math.sin(week * 2) + rand.gauss(0.0, 20.0)) % 360.0
+        # Rain for a few hours every couple days:
+        rainRate  = 0.3 if ts % 172800 < 10800 else 0.0
+        return {'dateTime'    : ts,
+                'usUnits'     : weewx.US,
+                'outTemp'     : outTemp,
+                'highOutTemp' : outTemp + 0.5,
+                'lowOutTemp'  : outTemp - 0.5,
+                'inTemp'      : 70.0 + 2.0 * math.sin(day),
+                'outHumidity' : outHumidity,
+                'inHumidity'  : 40.0,
+                'barometer'   : 30.0 + 0.3 * math.sin(week),
+                'windSpeed'   : windSpeed,
+                'windDir'     : windDir,
+                'windGust'    : windSpeed * 1.5,
+                'windGustDir' : windDir,
+                'rainRate'    : rainRate,
+                'rain'        : None,
+                'radiation'   : max(0.0, 800.0 * math.sin(day)),
+                'UV'          : max(0.0, 6.0 * math.sin(day)),
+                'ET'          : 0.0}
+
+class ReplayWeather(object):
+    """Replays the records of an existing weewx archive."""
+
+    def __init__(self, archiveFilename):
+        archive = weewx.archive.Archive(archiveFilename)
+        self.records = [dict(rec) for rec in archive.genBatchRecords()]
+        if not self.records:
+            raise weewx.ViolatedPrecondition, "Simulator: No records to replay in %s" % archiveFilename
+        self.index   = 0
+        syslog.syslog(syslog.LOG_INFO, "Simulator: Replaying %d records from %s" % (len(self.records), archiveFilename))
+
+    @property
+    def start_ts(self):
+        return self.records[0]['dateTime']
+
+    def getRecord(self, ts):
+        """Return the last record at or before time ts."""
+        # Times almost always move forward, so search from where we were last time:
+        if self.records[self.index]['dateTime'] > ts:
+            self.index = 0
+        while self.index + 1 < len(self.records) and self.records[self.index + 1]['dateTime'] <= ts:
+            self.index += 1
+        return self.records[self.index]
+
+#===============================================================================
+#                    Class FakeConsole
+#===============================================================================
+
+class FakeConsole(object):
+    """An in-process imitation of a Davis VantagePro2 console, as seen through its
+    serial port. It has the same methods as a serial.Serial object."""
+
+    def __init__(self, clock, weather, archive_interval=300, preload=0,
+                 crc_error_rate=0.0, timeout_rate=0.0, timeout=5.0, line_rate=None, seed=None):
+        """Initialize an instance of FakeConsole.
+
+        clock: An instance of SimulatedClock.
+
+        weather: Where the weather comes from. An object with a method
+        getRecord(ts). See SyntheticWeather and ReplayWeather.
+
+        archive_interval: The archive interval in seconds. [Optional. Default is 300]
+
+        preload: How many archive records should already be in memory.
+        [Optional. Default is 0]
+
+        crc_error_rate: The fraction of responses that should have a byte
+        corrupted. [Optional. Default is 0]
+
+        timeout_rate: The fraction of responses that should get cut off, as
+        if the console had stopped talking. [Optional. Default is 0]
+
+        timeout: How long (in seconds of real time) a cut off read should block.
+        It is scaled down by the speedup of the clock. [Optional. Default is 5]
+
+        line_rate: If given, the console's responses arrive no faster than they
+        could over a serial line running at this many bits per second (also
+        scaled by the speedup). [Optional. Default is None: they arrive at once]
+
+        seed: Seed for the random number generator. [Optional. Default is None]"""
+        self.clock            = clock
+        self.weather          = weather
+        self.archive_interval = archive_interval
+        self.crc_error_rate   = crc_error_rate
+        self.timeout_rate     = timeout_rate
+        self.timeout          = timeout
+        self.line_rate        = line_rate
+        self.rand             = random.Random(seed)
+
+        # The archive memory. Each entry is a 2-way tuple (timestamp, raw record):
+        self.memory           = []
+        self.last_logged_ts   = weeutil.weeutil.startOfInterval(self.clock.time(), archive_interval) - preload * archive_interval
+        self.rain_totals      = {}
+
+        # Characters received from, and waiting to go to, the host:
+        self.input            = ''
+        self.output           = ''
+        self.state            = None
+        self.loops_left       = 0
+        self.next_loop_ts     = None
+        # When the last character of the output will have arrived at the host:
+        self.line_free_ts     = 0
+
+        # Statistics:
+        self.stats = {'wakeups' : 0, 'loop_packets' : 0, 'pages' : 0, 'crc_errors' : 0, 'timeouts' : 0}
+
+        self._logRecords()
+
+    #
+    # The serial.Serial interface:
+    #
+
+    def write(self, data):
+        # Anything received from the host cancels a LOOP in progress:
+        self.loops_left = 0
+        self.input += data
+        self._process()
+
+    def read(self, nbytes=1):
+        self._makeLoopPackets(nbytes)
+        _buffer = self.output[:nbytes]
+        self.output = self.output[nbytes:]
+        if self.line_rate:
+            # Wait for the characters to come down the line. It takes 10 bits
+            # to send one character:
+            _arrival_ts = self.line_free_ts - len(self.output) * 10.0 / self.line_rate
+            if _arrival_ts > self.clock.time():
+                self.clock.sleep(_arrival_ts - self.clock.time())
+        if len(_buffer) < nbytes:
+            # Not enough data. A real serial port would wait for the timeout:
+            self.clock.sleep(self.timeout)
+        return _buffer
+
+    def inWaiting(self):
+        return len(self.output)
+
+    def flushInput(self):
+        # This is the host's input; i.e., what the console has sent:
+        self.output = ''
+        self.line_free_ts = 0
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        self.loops_left = 0
+
+    #
+    # The console itself:
+    #
+
+    def _process(self):
+        """Act on whatever the host has sent."""
+        while self.input:
+            if self.state == 'DMPAFT':
+                if len(self.input) < 6:
+                    return
+                (data, self.input) = (self.input[:6], self.input[6:])
+                if crc16(data):
+                    self._send(_resend)
+                    continue
+                self._startDump(struct.unpack("<HH", data[:4]))
+            elif self.state == 'SETTIME':
+                if len(self.input) < 8:
+                    return
+                (data, self.input) = (self.input[:8], self.input[8:])
+                if crc16(data):
+                    self._send(_resend)
+                    continue
+                self._setTime(struct.unpack("<bbbbbb", data[:6]))
+                self._send(_ack)
+                self.state = None
+            elif self.state == 'dumping':
+                c = self.input[0]
+                if c == _ack:
+                    self.page_index += 1
+                    self._sendPage()
+                elif c == _resend:
+                    if self.page_index < self.page_first:
+                        # The host did not get the header. Send it again:
+                        self._sendBlock(self.header)
+                    else:
+                        self._sendPage()
+                else:
+                    # Anything else (usually an <ESC> or a wakeup) cancels the dump:
+                    self.state = None
+                    if c == _esc:
+                        self.input = self.input[1:]
+                    continue
+                self.input = self.input[1:]
+            elif self.input[0] == '\n':
+                # A wakeup:
+                self.input = self.input[1:]
+                self.stats['wakeups'] += 1
+                self._sendBlock('\n\r', check_crc=False)
+            elif '\n' in self.input:
+                (line, self.input) = self.input.split('\n', 1)
+                self._command(line.strip())
+            elif self.input[0] in (_ack, _resend, _esc, _cancel):
+                self.input = self.input[1:]
+            else:
+                # A partial command. Wait for the rest:
+                return
+
+    def _command(self, line):
+        self._logRecords()
+        words = line.split()
+        if not words:
+            return
+        cmd = words[0]
+        if cmd == 'LOOP':
+            self._send(_ack)
+            self.loops_left   = int(words[1])
+            self.next_loop_ts = self.clock.time()
+        elif cmd == 'DMPAFT':
+            self._send(_ack)
+            self.state = 'DMPAFT'
+        elif cmd == 'GETTIME':
+            self._send(_ack)
+            now_tt = time.localtime(self.clock.time())
+            self._sendBlock(struct.pack("<bbbbbb", now_tt[5], now_tt[4], now_tt[3], now_tt[2], now_tt[1], now_tt[0] - 1900))
+        elif cmd == 'SETTIME':
+            self._send(_ack)
+            self.state = 'SETTIME'
+        elif cmd == 'EEBRD' and words[1:] == ['2D', '01']:
+            self._send(_ack)
+            self._sendBlock(chr(self.archive_interval / 60))
+        elif cmd == 'RXCHECK':
+            self._send('\n\rOK\n\r 21629 15 0 3204 128\n\r')
+        elif cmd == 'SETPER':
+            self.archive_interval = int(words[1]) * 60
+            self._send('\n\rOK\n\r')
+        elif cmd == 'CLRLOG':
+            self._send(_ack)
+            self.memory = []
+        else:
+            self._send('\n\rNO\n\r')
+
+    def _setTime(self, time_tuple):
+        (sec, minute, hr, day, mon, yr) = time_tuple
+        new_ts = time.mktime((yr + 1900, mon, day, hr, minute, sec, 0, 0, -1))
+        if self.clock.speedup == 1.0:
+            self.clock.setTime(new_ts)
+        else:
+            # The host's clock runs at real speed, ours doesn't. Ignore it.
+            syslog.syslog(syslog.LOG_DEBUG, "Simulator: Ignoring SETTIME on a clock running %.0fx" % self.clock.speedup)
+
+    def _startDump(self, stamps):
+        """Start a DMPAFT, given the date and time stamps sent by the host."""
+        (date_stamp, time_stamp) = stamps
+        if date_stamp == 0 and time_stamp == 0:
+            since_ts = 0
+        else:
+            since_ts = weewx.VantagePro._archive_datetime({'date_stamp' : date_stamp, 'time_stamp' : time_stamp})
+        # Find the first record newer than the requested time:
+        for first in xrange(len(self.memory)):
+            if self.memory[first][0] > since_ts:
+                break
+        else:
+            first = len(self.memory)
+        if first < len(self.memory):
+            first_page = first // 5
+            npages     = (len(self.memory) - 1) // 5 - first_page + 1
+            start      = first % 5
+        else:
+            first_page, npages, start = (0, 0, 0)
+        self.header     = struct.pack("<HH", npages, start)
+        self.page_first = first_page
+        self.page_last  = first_page + npages - 1
+        self.page_index = first_page - 1
+        self.state      = 'dumping'
+        self._send(_ack)
+        self._sendBlock(self.header)
+
+    def _sendPage(self):
+        if self.page_index > self.page_last:
+            self.state = None
+            return
+        records = [raw for (unused_ts, raw) in self.memory[self.page_index * 5 : self.page_index * 5 + 5]]
+        # Unused records are filled with 0xff:
+        records += [chr(0xff) * 52] * (5 - len(records))
+        self.stats['pages'] += 1
+        self._sendBlock(chr(self.page_index % 256) + ''.join(records) + chr(0) * 4)
+
+    def _makeLoopPackets(self, nbytes):
+        """Generate LOOP packets, at the same pace a real console would, until there
+        is enough output to satisfy a read."""
+        while self.loops_left > 0 and len(self.output) < nbytes:
+            self.clock.sleep(self.next_loop_ts - self.clock.time())
+            self._logRecords()
+            self.loops_left  -= 1
+            self.next_loop_ts += 2.0
+            self.stats['loop_packets'] += 1
+            if not self._sendBlock(self._packLoop(self.clock.time()) + '\n\r'):
+                # The packet got cut off. The host will see a short read:
+                break
+
+    def _send(self, data):
+        self.output += data
+        if self.line_rate:
+            # The line is busy until the last character has been sent:
+            self.line_free_ts = max(self.line_free_ts, self.clock.time()) + len(data) * 10.0 / self.line_rate
+
+    def _sendBlock(self, data, check_crc=True):
+        """Send a block of data, appending a CRC. This is where errors get injected.
+        
+        returns: False if the block got cut off, True otherwise."""
+        if check_crc:
+            data += struct.pack(">H", crc16(data))
+        if self.timeout_rate and self.rand.random() < self.timeout_rate:
+            # Cut the block off:
+            self.stats['timeouts'] += 1
+            self._send(data[:self.rand.randint(0, len(data) - 1)])
+            return False
+        elif check_crc and self.crc_error_rate and self.rand.random() < self.crc_error_rate:
+            # Corrupt one byte:
+            self.stats['crc_errors'] += 1
+            i = self.rand.randint(0, len(data) - 1)
+            data = data[:i] + chr(ord(data[i]) ^ 0x55) + data[i+1:]
+        self._send(data)
+        return True
+
+    #
+    # Archive memory and encoding:
+    #
+
+    def _logRecords(self):
+        """Log an archive record for every archive interval that has ended since the last one logged."""
+        now = self.clock.time()
+        while self.last_logged_ts + self.archive_interval <= now:
+            self.last_logged_ts += self.archive_interval
+            record = dict(self.weather.getRecord(self.last_logged_ts))
+            record['dateTime'] = self.last_logged_ts
+            if record.get('rain') is None:
+                record['rain'] = (record.get('rainRate') or 0.0) * self.archive_interval / 3600.0
+            self._addRain(record)
+            self.memory.append((self.last_logged_ts, self._packArchive(record)))
+        if len(self.memory) > _max_records:
+            # Drop whole pages, so the records stay in the same place on a page:
+            ndrop = (len(self.memory) - _max_records + 4) // 5 * 5
+            self.memory = self.memory[ndrop:]
+
+    def _addRain(self, record):
+        tt = time.localtime(record['dateTime'] - 1)
+        for (period, key) in (('day', tt[0:3]), ('month', tt[0:2]), ('year', tt[0:1])):
+            if self.rain_totals.get(period, (None,))[0] != key:
+                self.rain_totals[period] = (key, 0.0)
+            self.rain_totals[period] = (key, self.rain_totals[period][1] + record['rain'])
+
+    def _packArchive(self, record):
+        """Encode a record, in US units, as a 52 byte Rev B archive record."""
+        tt = time.localtime(record['dateTime'])
+        g = record.get
+        expected = 960.0 * self.archive_interval / 60 / 41.0
+        fields = {'date_stamp'             : tt[2] + (tt[1] << 5) + ((tt[0] - 2000) << 9),
+                  'time_stamp'             : tt[3] * 100 + tt[4],
+                  'outTemp'                : _enc(g('outTemp'),     10,   0x7fff, 'h'),
+                  'highOutTemp'            : _enc(g('highOutTemp'), 10,  -32768, 'h'),
+                  'lowOutTemp'             : _enc(g('lowOutTemp'),  10,   0x7fff, 'h'),
+                  'rain'                   : _enc(g('rain'),        100,  0,      'H'),
+                  'rainRate'               : _enc(g('rainRate'),    100,  0,      'H'),
+                  'barometer'              : _enc(g('barometer'),   1000, 0,      'H'),
+                  'radiation'              : _enc(g('radiation'),   1,    0x7fff, 'H'),
+                  'number_of_wind_samples' : int(expected * 0.95),
+                  'inTemp'                 : _enc(g('inTemp'),      10,   0x7fff, 'h'),
+                  'inHumidity'             : _enc(g('inHumidity'),  1,    0xff,   'B'),
+                  'outHumidity'            : _enc(g('outHumidity'), 1,    0xff,   'B'),
+                  'windSpeed'              : _enc(g('windSpeed'),   1,    0xff,   'B'),
+                  'windGust'               : _enc(g('windGust'),    1,    0,      'B'),
+                  'windGustDir'            : _encDir(g('windGustDir')),
+                  'windDir'                : _encDir(g('windDir')),
+                  'UV'                     : _enc(g('UV'),          10,   0xff,   'B'),
+                  'ET'                     : _enc(g('ET'),          1000, 0,      'B'),
+                  'highRadiation'          : _enc(g('highRadiation'), 1,  0,      'H'),
+                  'highUV'                 : _enc(g('highUV'),      10,   0xff,   'B'),
+                  'forecastRule'           : int(g('forecastRule') or 0),
+                  'download_record_type'   : 0}
+        for obs_type in ('leafTemp1', 'leafTemp2', 'soilTemp1', 'soilTemp2', 'soilTemp3', 'soilTemp4',
+                         'extraTemp1', 'extraTemp2', 'extraTemp3'):
+            fields[obs_type] = _encTemp(g(obs_type))
+        for obs_type in ('leafWet1', 'leafWet2', 'extraHumid1', 'extraHumid2',
+                         'soilMoist1', 'soilMoist2', 'soilMoist3', 'soilMoist4'):
+            fields[obs_type] = _enc(g(obs_type), 1, 0xff, 'B')
+        return weewx.VantagePro.archive_format.pack(*[fields[obs_type] for obs_type in weewx.VantagePro.vp2archB])
+
+    def _packLoop(self, ts):
+        """Encode the weather at time ts as the first 95 bytes of a LOOP packet."""
+        record = self.weather.getRecord(ts)
+        g = record.get
+        fields = {'loop'               : 'LOO',
+                  'loop_type'          : ord('P'),
+                  'packet_type'        : 0,
+                  'next_record'        : len(self.memory) % _max_records,
+                  'barometer'          : _enc(g('barometer'),   1000, 0,      'H'),
+                  'inTemp'             : _enc(g('inTemp'),      10,   0x7fff, 'h'),
+                  'inHumidity'         : _enc(g('inHumidity'),  1,    0xff,   'B'),
+                  'outTemp'            : _enc(g('outTemp'),     10,   0x7fff, 'h'),
+                  'windSpeed'          : _enc(g('windSpeed'),   1,    0xff,   'B'),
+                  'windSpeed10'        : _enc(g('windSpeed'),   1,    0xff,   'B'),
+                  'windDir'            : _enc(g('windDir'),     1,    0x7fff, 'H'),
+                  'outHumidity'        : _enc(g('outHumidity'), 1,    0xff,   'B'),
+                  'rainRate'           : _enc(g('rainRate'),    100,  0xffff, 'H'),
+                  'UV'                 : _enc(g('UV'),          10,   0xff,   'B'),
+                  'radiation'          : _enc(g('radiation'),   1,    0x7fff, 'H'),
+                  'stormRain'          : 0,
+                  'stormStart'         : 0xffff,
+                  'dayRain'            : _enc(self.rain_totals.get('day',   (None, 0.0))[1], 100, 0, 'H'),
+                  'monthRain'          : _enc(self.rain_totals.get('month', (None, 0.0))[1], 100, 0, 'H'),
+                  'yearRain'           : _enc(self.rain_totals.get('year',  (None, 0.0))[1], 100, 0, 'H'),
+                  'dayET'              : 0,
+                  'monthET'            : 0,
+                  'yearET'             : 0,
+                  'txBatteryStatus'    : 0,
+                  # 4.7 volts:
+                  'consBatteryVoltage' : 802,
+                  'forecastIcon'       : 6,
+                  'forecastRule'       : int(g('forecastRule') or 0),
+                  'sunrise'            : 630,
+                  'sunset'             : 1845}
+        for obs_type in weewx.VantagePro.vp2loop:
+            if obs_type not in fields:
+                if 'Temp' in obs_type:
+                    fields[obs_type] = _encTemp(g(obs_type))
+                elif 'Alarm' in obs_type:
+                    fields[obs_type] = 0
+                else:
+                    fields[obs_type] = _enc(g(obs_type), 1, 0xff, 'B')
+        return weewx.VantagePro.loop_format.pack(*[fields[obs_type] for obs_type in weewx.VantagePro.vp2loop])
+
+# The ranges of the struct formats used in the Davis encoding:
+_ranges = {'h' : (-32768, 32767), 'H' : (0, 65535), 'B' : (0, 255)}
+
+def _enc(v, scale, dash, fmt):
+    """Encode a physical value as a scaled integer, using dash for None."""
+    if v is None:
+        return dash
+    (lo, hi) = _ranges[fmt]
+    return min(max(int(round(v * scale)), lo), hi)
+
+def _encTemp(v):
+    return _enc(v + 90 if v is not None else None, 1, 0xff, 'B')
+
+def _encDir(v):
+    return int(round(v / 22.5)) % 16 if v is not None else 0xff
+
+#===============================================================================
+#                    Class SimulatorWrapper
+#===============================================================================
+
+class SimulatorWrapper(object):
+    """Plays the role of weewx.VantagePro.SerialWrapper for a FakeConsole."""
+
+    def __init__(self, console):
+        self.console = console
+
+    def __enter__(self):
+        return self.console
+
+    def __exit__(self, dummy_etyp, dummy_einst, dummy_etb):
+        self.console.close()
+
+#===============================================================================
+#                    Class Simulator
+#===============================================================================
+
+class Simulator(weewx.VantagePro.VantagePro):
+    """A VantagePro that talks to a FakeConsole, instead of real hardware."""
+
+    def __init__(self, **sim_dict):
+        """Initialize an instance of Simulator.
+
+        NAMED ARGUMENTS:
+
+        speedup: How many times faster than real time the console's clock
+        should run. [Optional. Default is 1]
+
+        archive_interval: The console's archive interval, in seconds.
+        [Optional. Default is 300]
+
+        replay_file: Path to a weewx archive, whose records are to be replayed. If
+        not given, the weather is made up. [Optional. Default is None]
+
+        start_time: What time the console's clock should start at. [Optional.
+        Default is the present time or, if replaying, the time of the first
+        record to be replayed plus enough to cover the preloaded records]
+
+        preload: How many archive records should already be in the console's
+        memory at the start. [Optional. Default is 0]
+
+        crc_error_rate: The fraction of responses that should arrive with a
+        CRC error. [Optional. Default is 0]
+
+        timeout_rate: The fraction of responses that should get cut off,
+        causing a timeout. [Optional. Default is 0]
+
+        line_rate: Pace the console's responses as if they came over a serial
+        line running at this many bits per second. [Optional. Default is no pacing]
+
+        seed: Seed for the random number generator. [Optional. Default is None]
+
+        All the other arguments of VantagePro are accepted as well."""
+
+        speedup          = float(sim_dict.get('speedup', 1.0))
+        archive_interval = int(sim_dict.get('archive_interval', 300))
+        preload          = int(sim_dict.get('preload', 0))
+        seed             = sim_dict.get('seed')
+        replay_file      = sim_dict.get('replay_file')
+
+        if replay_file:
+            weather  = ReplayWeather(replay_file)
+            start_ts = weather.start_ts + preload * archive_interval
+        else:
+            weather  = SyntheticWeather(seed)
+            start_ts = time.time()
+        start_ts = float(sim_dict.get('start_time', start_ts))
+
+        self.console = FakeConsole(SimulatedClock(start_ts, speedup), weather, archive_interval, preload,
+                                   crc_error_rate = float(sim_dict.get('crc_error_rate', 0.0)),
+                                   timeout_rate   = float(sim_dict.get('timeout_rate', 0.0)),
+                                   timeout        = float(sim_dict.get('timeout', 5.0)),
+                                   line_rate      = float(sim_dict['line_rate']) if sim_dict.get('line_rate') else None,
+                                   seed           = seed)
+
+        # There is no real port, and the waits can be scaled down with the clock:
+        sim_dict = dict(sim_dict)
+        sim_dict.setdefault('port', 'simulator')
+        sim_dict.setdefault('wakeup_delay',      0.5 / speedup)
+        sim_dict.setdefault('wait_before_retry', 1.2 / speedup)
+        syslog.syslog(syslog.LOG_INFO, "Simulator: Clock starts at %s, running %.0fx" %
+                      (weeutil.weeutil.timestamp_to_string(start_ts), speedup))
+
+        super(Simulator, self).__init__(**sim_dict)
+
+    def openPort(self):
+        return SimulatorWrapper(self.console)
+
+    def now(self):
+        return self.console.clock.time()
+
+
+if __name__ == '__main__':
+
+    # Put the simulator through its paces, with lots of errors.
+    station = Simulator(speedup=1000, preload=50, crc_error_rate=0.1, timeout_rate=0.05,
+                        max_tries=10, timeout=0.5, seed=1)
+
+    assert station.getArchiveInterval() == 300
+
+    t1 = time.time()
+    since_ts = station.now() - 30 * 300
+    records = list(station.genArchivePackets(since_ts))
+    t2 = time.time()
+    print "Got %d archive records in %.2f seconds" % (len(records), t2 - t1)
+    assert len(records) == 30
+    assert records[0]['dateTime'] > since_ts
+    for i in xrange(1, len(records)):
+        assert records[i]['dateTime'] - records[i-1]['dateTime'] == 300
+
+    # Every value must decode to what the weather source gave, to within the
+    # resolution of the Davis encoding:
+    for record in records:
+        source = station.console.weather.getRecord(record['dateTime'])
+        assert abs(record['outTemp']   - source['outTemp'])   <= 0.05
+        assert abs(record['barometer'] - source['barometer']) <= 0.0005
+        assert abs(record['windSpeed'] - source['windSpeed']) <= 0.5
+
+    t1 = time.time()
+    npackets = 0
+    for packet in station.genLoopPackets():
+        npackets += 1
+    t2 = time.time()
+    print "Got %d LOOP packets in %.2f seconds" % (npackets, t2 - t1)
+
+    print "Console time: %s" % time.asctime(station.getTime())
+    print "Console statistics:", station.console.stats
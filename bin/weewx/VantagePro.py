@@ -9,10 +9,14 @@
 #
 """classes and functions for interfacing with a Davis VantagePro or VantagePro2"""
 from __future__ import with_statement
+import Queue
+import math
 import serial
 import struct
+import sys
 import syslog
 import datetime
+import threading
 import time
 
 from weewx.crc16 import crc16
@@ -49,6 +53,94 @@ class SerialWrapper(object):
         except:
             pass
 
+class SerialSession(object):
+    """A serial connection to the console that stays open between commands.
+    
+    Waking up the console takes over a second, so it is done only when
+    necessary: the first time, after the connection has been idle for a while
+    (when the console may have gone back to sleep), and after an error or
+    an interrupted command. 
+    
+    Use it in a 'with' statement. This returns the open serial port. If
+    something other than a console I/O error escapes the block, the port gets
+    closed, to be reopened the next time."""
+    
+    def __init__(self, opener, idle_timeout=60.0, max_tries=3, wait_before_retry=1.2, wakeup_delay=0.5):
+        """Initialize an instance of SerialSession.
+        
+        opener: A function returning a context manager which opens the port
+        on entry, and closes it on exit, such as an instance of SerialWrapper.
+        
+        idle_timeout: After this many seconds without a command, wake the console
+        up again. [Optional. Default is 60]
+        
+        max_tries, wait_before_retry, wakeup_delay: Passed on to the function that
+        wakes up the console."""
+        self.opener            = opener
+        self.idle_timeout      = idle_timeout
+        self.max_tries         = max_tries
+        self.wait_before_retry = wait_before_retry
+        self.wakeup_delay      = wakeup_delay
+        self.wrapper           = None
+        self.serial_port       = None
+        self.awake             = False
+        self.last_used         = 0
+        self.stats = {'opens'      : 0,
+                      'wakeups'    : 0,
+                      'retries'    : 0,
+                      'crc_errors' : 0,
+                      'timeouts'   : 0}
+        
+    def __enter__(self):
+        if self.serial_port is None:
+            self.wrapper     = self.opener()
+            self.serial_port = self.wrapper.__enter__()
+            self.awake       = False
+            self.stats['opens'] += 1
+        return self.serial_port
+    
+    def __exit__(self, etyp, dummy_einst, dummy_etb):
+        self.last_used = time.time()
+        # A generator that gets closed early keeps track of the console's state
+        # itself. For anything else, the console may be in the middle of something,
+        # so wake it up before the next command:
+        if etyp is not None and etyp is not GeneratorExit:
+            self.awake = False
+            if not issubclass(etyp, weewx.WeeWxIOError):
+                # Something unexpected. Start over with a fresh port:
+                self.close()
+        return False
+    
+    def wakeup(self):
+        """Wake up the console, if it might be asleep."""
+        if self.awake and time.time() - self.last_used < self.idle_timeout:
+            return
+        _wakeup_console(self.serial_port, self.max_tries, self.wait_before_retry, self.wakeup_delay, self.stats)
+        self.awake     = True
+        self.last_used = time.time()
+        
+    def invalidate(self):
+        """The console may not be ready for a command. Wake it up before the next one."""
+        self.awake = False
+        
+    def validate(self):
+        """The console is known to be ready for a command."""
+        self.awake     = True
+        self.last_used = time.time()
+    
+    def close(self):
+        if self.wrapper is not None:
+            try:
+                self.wrapper.__exit__(None, None, None)
+            finally:
+                self.wrapper     = None
+                self.serial_port = None
+                self.awake       = False
+
+    def logStats(self):
+        syslog.syslog(syslog.LOG_DEBUG, "VantagePro: Session has %d open(s), %d wakeup(s), %d retries, %d CRC error(s), %d timeout(s)" %
+                      (self.stats['opens'], self.stats['wakeups'], self.stats['retries'], self.stats['crc_errors'], self.stats['timeouts']))
+
 class VantagePro (object) :
     """Class that represents a connection to a VantagePro console."""
 
@@ -76,6 +168,13 @@ class VantagePro (object) :
         max_tries: How many times to try again before giving up. [Optional.
         Default is 4]
         
+        wakeup_delay: How long to wait for the console to settle down after
+        sending the wakeup line feeds. [Optional. Default is 0.5 seconds]
+        
+        idle_timeout: The serial port is kept open between commands. After
+        this many seconds without a command, the console gets woken up
+        again. [Optional. Default is 60 seconds]
+        
         archive_delay: How long to wait after an archive record is due
         before retrieving it. [Optional. Default is 15 seconds]
         
@@ -95,34 +194,72 @@ class VantagePro (object) :
         self.timeout          = float(vp_dict.get('timeout', 5.0))
         self.wait_before_retry= float(vp_dict.get('wait_before_retry', 1.2))
         self.max_tries        = int(vp_dict.get('max_tries'    , 4))
+        self.wakeup_delay     = float(vp_dict.get('wakeup_delay', 0.5))
         self.archive_delay    = int(vp_dict.get('archive_delay', 15))
         self.unit_system      = int(vp_dict.get('unit_system'  , 1))
         self.dst_delta        = 3600
+        
+        # Measured interval between LOOP packets. Start with the nominal value:
+        self.loop_interval    = 2.0
+        # How late (in seconds) the last archive record was fetched:
+        self.archive_lateness = None
+        
+        # The connection to the console:
+        self.session = SerialSession(self.openPort, 
+                                     float(vp_dict.get('idle_timeout', 60.0)),
+                                     self.max_tries, self.wait_before_retry, self.wakeup_delay)
 
         # Get the archive interval dynamically:
         self.archive_interval = self.getArchiveInterval()
         
+    def openPort(self):
+        """Return a context manager that opens the serial port to the console
+        on entry, and closes it on exit."""
+        return SerialWrapper(self.port, self.baudrate, self.timeout)
+    
+    def closePort(self):
+        """Close the serial port to the console. It will be reopened if needed."""
+        self.session.close()
+    
+    def now(self):
+        """Return the current time. 
+        
+        The simulator overrides this, so its clock can run fast."""
+        return time.time()
+        
     def genLoopPackets(self):
         """Generator function that returns loop packets until the next archive record is due."""
 
         # Next time to ask for archive records:
-        nextArchive_ts = (int(time.time() / self.archive_interval) + 1) *\
+        nextArchive_ts = (int(self.now() / self.archive_interval) + 1) *\
                             self.archive_interval + self.archive_delay
         
         while True:
-            # Get LOOP packets in big batches, then cancel as necessary when the expiration
-            # time is up. This is necessary because there is an undocumented limit to how
-            # many LOOP records you can for on the VP (somewhere around 220).
-            for _loopPacket in self.genDavisLoopPackets(200):
-                # Translate the LOOP packet to one with physical units:
-                _physicalPacket = self.translateLoopPacket(_loopPacket)
+            # Ask for just enough LOOP packets to get to the time of the next archive
+            # record, so the batch ends when it is due. There is an undocumented limit
+            # to how many LOOP records you can ask for on the VP (somewhere around 220),
+            # so no more than 200 at a time.
+            _N = int(math.ceil((nextArchive_ts - self.now()) / self.loop_interval))
+            _N = min(max(_N, 1), 200)
+            _last_ts = None
+            for _buffer in self._genLoopBuffers(_N):
+                # Keep track of how often the console sends packets:
+                _now = self.now()
+                if _last_ts is not None:
+                    self.loop_interval += 0.1 * (min(_now - _last_ts, 10.0) - self.loop_interval)
+                _last_ts = _now
+                # Decode the LOOP packet straight into physical units:
+                _physicalPacket = self.decodeLoopBuffer(_buffer)
                 self.accumulateLoop(_physicalPacket)
                 yield _physicalPacket
                 
                 # Check to see if it's time to get new archive data. If so, cancel the loop
-                # and return
-                if time.time() >= nextArchive_ts:
-                    syslog.syslog(syslog.LOG_DEBUG, "VantagePro: new archive record due. Canceling loop")
+                # (if it hasn't ended already) and return
+                _now = self.now()
+                if _now >= nextArchive_ts:
+                    syslog.syslog(syslog.LOG_DEBUG, "VantagePro: new archive record due. Fetching it %.1f seconds late; LOOP interval %.2f seconds" %
+                                  (_now - nextArchive_ts, self.loop_interval))
+                    self.archive_lateness = _now - nextArchive_ts
                     return
 
     def genDavisLoopPackets(self, N=1):
@@ -132,37 +269,57 @@ class VantagePro (object) :
         
         yields: up to N DavisLoopPacket objects
         """
+        for _buffer in self._genLoopBuffers(N):
+            # ... decode it
+            yield unpackLoopPacket(_buffer[:95])
+
+    def _genLoopBuffers(self, N=1):
+        """Generator function to return the raw data of N LOOP packets from a VantagePro console.
+        
+        N: The number of packets to generate [default is 1]
+        
+        yields: up to N LOOP packets, each as a string of 99 bytes, with a good CRC
+        """
 
         syslog.syslog(syslog.LOG_DEBUG, "VantagePro: Requesting %d LOOP packets." % N)
         
         # Open up the serial port. It will automatically be closed if an 
         # exception is raised:
-        with SerialWrapper(self.port, self.baudrate, self.timeout) as serial_port:
+        with self.session as serial_port:
 
-            _wakeup_console(serial_port, self.max_tries, self.wait_before_retry)
+            self.session.wakeup()
             
-            # Request N packets:
+            # Request N packets. Until the last one has been read, the console
+            # will need a wakeup before it will accept another command:
             _send_data(serial_port, "LOOP %d\n" % N)
+            self.session.invalidate()
             
+            # Each read gets one of the N packets. A bad one is skipped, but
+            # too many bad ones in a row means something is wrong.
+            _nbad = 0
             for loop in xrange(N) :
                 
-                for unused_count in xrange(self.max_tries):
-                    # Fetch a packet
-                    buffer = serial_port.read(99)
-                    if len(buffer) != 99 :
-                        syslog.syslog(syslog.LOG_ERR, 
-                                      "VantagePro: LOOP #%d; buffer not full (%d) after timeout... retrying" % (loop,len(buffer)))
-                        continue
-                    if crc16(buffer) :
-                        syslog.syslog(syslog.LOG_ERR,
-                                      "VantagePro: LOOP #%d; CRC error... retrying" % loop)
-                        continue
-                    # ... decode it
-                    pkt_dict = unpackLoopPacket(buffer[:95])
-                    # Yield it
-                    yield pkt_dict
-                    break
+                # Fetch a packet
+                buffer = serial_port.read(99)
+                if len(buffer) != 99 :
+                    syslog.syslog(syslog.LOG_ERR, 
+                                  "VantagePro: LOOP #%d; buffer not full (%d) after timeout... skipping" % (loop,len(buffer)))
+                    self.session.stats['timeouts'] += 1
+                elif crc16(buffer) :
+                    syslog.syslog(syslog.LOG_ERR,
+                                  "VantagePro: LOOP #%d; CRC error... skipping" % loop)
+                    self.session.stats['crc_errors'] += 1
                 else:
+                    _nbad = 0
+                    if loop == N - 1:
+                        # That was the last packet, so the console is ready for the next command:
+                        self.session.validate()
+                    # Yield it
+                    yield buffer
+                    continue
+
+                _nbad += 1
+                if _nbad >= self.max_tries:
                     syslog.syslog(syslog.LOG_ERR, 
                                   "VantagePro: Max retries exceeded while getting LOOP packets")
                     raise weewx.RetriesExceeded, "While getting LOOP packets"
@@ -193,45 +350,25 @@ class VantagePro (object) :
         # Save the last good time:
         _last_good_ts = since_ts if since_ts else 0
         
-        with SerialWrapper(self.port, self.baudrate, self.timeout) as serial_port:
+        # Right now, only US units are supported
+        if self.unit_system != weewx.US :
+            raise weewx.UnsupportedFeature, "Only US Units are supported on the Davis VP2."
+
+        with self.session:
 
             # Retry the dump up to max_tries times
             for unused_count in xrange(self.max_tries) :
+                _completed = False
+                # The pages are read on a separate thread, so the console can send the
+                # next page while this one is being decoded and stored:
+                _page_gen = self._genPagesThreaded(_datestr)
                 try :
-                    # Wake up the console...
-                    _wakeup_console(serial_port, self.max_tries, self.wait_before_retry)
-                    # ... request a dump...
-                    _send_data(serial_port, 'DMPAFT\n')
-                    # ... from the designated date:
-                    _send_data_with_crc16(serial_port, _datestr, self.max_tries)
-                    
-                    # Get the response with how many pages and starting index and decode it:
-                    _buffer = _get_data_with_crc16(serial_port, 6, max_tries=self.max_tries)
-                    (_npages, _start_index) = struct.unpack("<HH", _buffer[:4])
-                  
-                    syslog.syslog(syslog.LOG_DEBUG, "VantagePro: Retrieving %d page(s); starting index= %d" % (_npages, _start_index))
-                    
-                    # Cycle through the pages...
-                    for unused_ipage in xrange(_npages) :
-                        # ... get a page of archive data
-                        _page = _get_data_with_crc16(serial_port, 267, prompt=_ack, max_tries=self.max_tries)
-                        # Now extract each record from the page
-                        for _index in xrange(_start_index, 5) :
-                            # If the console has been recently initialized, there will
-                            # be unused records, which are filled with 0xff:
-                            if _page[1+52*_index:53+52*_index] == 52*chr(0xff) :
-                                # This record has never been used. We're done.
-                                return
-                            # Unpack the raw archive packet:
-                            _packet = unpackArchivePacket(_page[1+52*_index:53+52*_index])
-                            # Divide archive interval by 60 to keep consistent with wview
-                            _packet['interval']   = self.archive_interval / 60 
-                            _packet['model_type'] = self.model_type
-                            _packet['iss_id']     = self.iss_id
-                            _packet['rxCheckPercent'] = _rxcheck(_packet)
-    
-                            # Convert from the internal, Davis encoding to physical units:
-                            _record = self.translateArchivePacket(_packet)
+                    for (_page, _start_index) in _page_gen :
+                        # Decode all the records in the page, straight into physical units.
+                        # Divide archive interval by 60 to keep consistent with wview
+                        _record_list = decodeArchivePage(_page, _start_index, self.archive_interval / 60,
+                                                         self.model_type, self.iss_id)
+                        for _record in _record_list :
                             # Check to see if the time stamps are declining, which would
                             # signal this is a wrap around record on the last page.
                             # However, the time stamps may be declining just because of the
@@ -245,14 +382,94 @@ class VantagePro (object) :
                             # Set the last time to the current time, and yield the packet
                             _last_good_ts = _record['dateTime']
                             yield _record
-                        _start_index = 0
+                        # If the console has been recently initialized, there will
+                        # be unused records, which are filled with 0xff:
+                        if len(_record_list) < 5 - _start_index :
+                            # This record has never been used. We're done.
+                            return
+                    # All the pages have been read, so the console is done with the dump:
+                    _completed = True
                     return
                 except weewx.WeeWxIOError:
                     # Caught an error. Keep retrying...
                     continue
+                finally:
+                    # Stop the reader, if it is still going:
+                    _page_gen.close()
+                    # If the dump was cut short, the console is still waiting for
+                    # an acknowledgment. Wake it up before the next command.
+                    if _completed:
+                        self.session.validate()
+                    else:
+                        self.session.invalidate()
+                    self.session.logStats()
             syslog.syslog(syslog.LOG_ERR, "VantagePro: Max retries exceeded while getting archive packets")
             raise weewx.RetriesExceeded, "Max retries exceeded while getting archive packets"
 
+    def _genPages(self, datestr):
+        """Generator function that requests a dump of the archive memory, then
+        returns its pages.
+        
+        datestr: The date and time of the dump, as packed for command DMPAFT.
+        
+        yields: 2-way tuples (page, start_index), where page is a page of archive
+        data as a string, and start_index is the index of its first new record."""
+        serial_port = self.session.serial_port
+        # Wake up the console...
+        self.session.wakeup()
+        # ... request a dump...
+        _send_data(serial_port, 'DMPAFT\n')
+        # ... from the designated date:
+        _send_data_with_crc16(serial_port, datestr, self.max_tries, stats=self.session.stats)
+        
+        # Get the response with how many pages and starting index and decode it:
+        _buffer = _get_data_with_crc16(serial_port, 6, max_tries=self.max_tries, stats=self.session.stats)
+        (_npages, _start_index) = struct.unpack("<HH", _buffer[:4])
+      
+        syslog.syslog(syslog.LOG_DEBUG, "VantagePro: Retrieving %d page(s); starting index= %d" % (_npages, _start_index))
+        
+        # Cycle through the pages...
+        for unused_ipage in xrange(_npages) :
+            # ... get a page of archive data. The prompt acknowledges the one before.
+            _page = _get_data_with_crc16(serial_port, 267, prompt=_ack, max_tries=self.max_tries, stats=self.session.stats)
+            yield (_page, _start_index)
+            _start_index = 0
+
+    def _genPagesThreaded(self, datestr):
+        """Like _genPages(), except the pages are read by a separate thread, as fast
+        as the console can send them, and put in a queue. 
+        
+        An exception raised by the reader is reraised here. When the generator is
+        closed, the reader stops before asking for another page."""
+        _queue = Queue.Queue()
+        _stop  = threading.Event()
+        
+        def _reader():
+            try:
+                for _item in self._genPages(datestr):
+                    _queue.put(('page', _item))
+                    if _stop.isSet():
+                        break
+                _queue.put(('done', None))
+            except Exception:
+                _queue.put(('error', sys.exc_info()))
+
+        _thread = threading.Thread(target=_reader, name='VantagePro-dump')
+        _thread.setDaemon(True)
+        _thread.start()
+        try:
+            while True:
+                (_kind, _value) = _queue.get()
+                if _kind == 'page':
+                    yield _value
+                elif _kind == 'error':
+                    raise _value[0], _value[1], _value[2]
+                else:
+                    return
+        finally:
+            _stop.set()
+            _thread.join()
+
     def accumulateLoop(self, physicalLOOPPacket):
         """Process LOOP data, calculating averages within an archive period."""
         try:
@@ -313,22 +530,23 @@ class VantagePro (object) :
         
         returns: the time as a time-tuple
         """
-        with SerialWrapper(self.port, self.baudrate, self.timeout) as serial_port:
+        with self.session as serial_port:
     
             # Try up to 3 times:
             for unused_count in xrange(self.max_tries) :
                 try :
                     # Wake up the console...
-                    _wakeup_console(serial_port, max_tries=self.max_tries, wait_before_retry=self.wait_before_retry)
+                    self.session.wakeup()
                     # ... request the time...
                     _send_data(serial_port, 'GETTIME\n')
                     # ... get the binary data. No prompt, only one try:
-                    _buffer = _get_data_with_crc16(serial_port, 8, max_tries=1)
+                    _buffer = _get_data_with_crc16(serial_port, 8, max_tries=1, stats=self.session.stats)
                     (sec, min, hr, day, mon, yr, unused_crc) = struct.unpack("<bbbbbbH", _buffer)
                     time_tt = (yr+1900, mon, day, hr, min, sec, 0, 0, -1)
                     return time_tt
                 except weewx.WeeWxIOError :
                     # Caught an error. Keep retrying...
+                    self.session.invalidate()
                     continue
             syslog.syslog(syslog.LOG_ERR, "VantagePro: Max retries exceeded while getting time")
             raise weewx.RetriesExceeded, "While getting console time"
@@ -354,18 +572,19 @@ class VantagePro (object) :
         _buffer = struct.pack("<bbbbbb", newtime_tt[5], newtime_tt[4], newtime_tt[3], newtime_tt[2],
                                          newtime_tt[1], newtime_tt[0] - 1900)
             
-        with SerialWrapper(self.port, self.baudrate, self.timeout) as serial_port:
+        with self.session as serial_port:
             for unused_count in xrange(self.max_tries) :
                 try :
-                    _wakeup_console(serial_port, max_tries=self.max_tries, wait_before_retry=self.wait_before_retry)
+                    self.session.wakeup()
                     _send_data(serial_port, 'SETTIME\n')
-                    _send_data_with_crc16(serial_port, _buffer, max_tries=self.max_tries)
+                    _send_data_with_crc16(serial_port, _buffer, max_tries=self.max_tries, stats=self.session.stats)
                     syslog.syslog(syslog.LOG_NOTICE,
                                   "VantagePro: Clock set to %s (%d)" % (time.asctime(newtime_tt), 
                                                                        time.mktime(newtime_tt)) )
                     return
                 except weewx.WeeWxIOError :
                     # Caught an error. Keep retrying...
+                    self.session.invalidate()
                     continue
             syslog.syslog(syslog.LOG_ERR, "VantagePro: Max retries exceeded while setting time")
             raise weewx.RetriesExceeded, "While setting console time"
@@ -383,10 +602,10 @@ class VantagePro (object) :
         if archive_interval_minutes not in (1, 5, 10, 15, 30, 60, 120):
             raise weewx.ViolatedPrecondition, "VantagePro: Invalid archive interval (%f)" % archive_interval
 
-        with SerialWrapper(self.port, self.baudrate, self.timeout) as serial_port:
+        with self.session as serial_port:
             for unused_count in xrange(self.max_tries):
                 try :
-                    _wakeup_console(serial_port, max_tries=self.max_tries, wait_before_retry=self.wait_before_retry)
+                    self.session.wakeup()
                 
                     # The Davis documentation is wrong about the SETPER command.
                     # It actually returns an 'OK', not an <ACK>
@@ -404,9 +623,12 @@ class VantagePro (object) :
                         self.archive_interval = archive_interval_minutes * 60
                         syslog.syslog(syslog.LOG_NOTICE, "VantagePro: archive interval set to %d" % (self.archive_interval,))
                         return
+                    # Unexpected response. Wake the console up again before retrying:
+                    self.session.invalidate()
     
                 except weewx.WeeWxIOError:
                     # Caught an error. Keep trying...
+                    self.session.invalidate()
                     continue
             
             syslog.syslog(syslog.LOG_ERR, "VantagePro: Max retries exceeded while setting archive interval")
@@ -414,15 +636,16 @@ class VantagePro (object) :
     
     def clearLog(self):
         """Clear the internal archive memory in the VantagePro."""
-        with SerialWrapper(self.port, self.baudrate, self.timeout) as serial_port:
+        with self.session as serial_port:
             for unused_count in xrange(self.max_tries):
                 try:
-                    _wakeup_console(serial_port, max_tries=self.max_tries, wait_before_retry=self.wait_before_retry)
+                    self.session.wakeup()
                     _send_data(serial_port, "CLRLOG\n")
                     syslog.syslog(syslog.LOG_NOTICE, "VantagePro: Archive memory cleared.")
                     return
                 except weewx.WeeWxIOError:
                     #Caught an error. Keey trying...
+                    self.session.invalidate()
                     continue
             syslog.syslog(syslog.LOG_ERR, "VantagePro: Max retries exceeded while clearing log")
             raise weewx.RetriesExceeded
@@ -430,17 +653,18 @@ class VantagePro (object) :
     def getArchiveInterval(self):
         """Return the present archive interval in seconds."""
         
-        with SerialWrapper(self.port, self.baudrate, self.timeout) as serial_port:
+        with self.session as serial_port:
             for unused_count in xrange(self.max_tries):
                 try :
-                    _wakeup_console(serial_port, max_tries=self.max_tries, wait_before_retry=self.wait_before_retry)
+                    self.session.wakeup()
                     _send_data(serial_port, "EEBRD 2D 01\n")
                     # ... get the binary data. No prompt, only one try:
-                    _buffer = _get_data_with_crc16(serial_port, 3, max_tries=1)
+                    _buffer = _get_data_with_crc16(serial_port, 3, max_tries=1, stats=self.session.stats)
                     _archive_interval = ord(_buffer[0]) * 60
                     return _archive_interval
                 except weewx.WeeWxIOError:
                     # Caught an error. Keep trying...
+                    self.session.invalidate()
                     continue
             
             syslog.syslog(syslog.LOG_ERR, "VantagePro: Max retries exceeded while getting archive interval")
@@ -454,10 +678,10 @@ class VantagePro (object) :
         # of resynchronizations, the max # of packets received w/o an error,
         the # of CRC errors detected.)"""
         
-        with SerialWrapper(self.port, self.baudrate, self.timeout) as serial_port:
+        with self.session as serial_port:
             for unused_count in xrange(self.max_tries) :
                 try :
-                    _wakeup_console(serial_port, max_tries=self.max_tries, wait_before_retry=self.wait_before_retry)
+                    self.session.wakeup()
                     # Can't use function _send_data because the VP doesn't respond with an 
                     # ACK for this command, it responds with 'OK'. Go figure.
                     serial_port.write('RXCHECK\n')
@@ -472,8 +696,11 @@ class VantagePro (object) :
                     rx_list = _buffer.split()
                     # The first member should be the 'OK' in the VP response
                     if len(rx_list) == 6 and rx_list[0] == 'OK' : return rx_list[1:]
+                    # Unexpected response. Wake the console up again before retrying:
+                    self.session.invalidate()
                 except weewx.WeeWxIOError:
                     # Caught an error. Keep retrying...
+                    self.session.invalidate()
                     continue
             syslog.syslog(syslog.LOG_ERR, "VantagePro: Max retries exceeded while getting RX data")
             raise weewx.RetriesExceeded, "While getting RX data"
@@ -492,6 +719,18 @@ class VantagePro (object) :
         return _packet
     
 
+    def decodeLoopBuffer(self, buffer):
+        """Decodes the raw data of a LOOP packet straight into physical units.
+        
+        buffer: A LOOP packet, as a string.
+        
+        returns: A dictionary with the values in physical units."""
+        # Right now, only US customary units are supported
+        if self.unit_system != weewx.US :
+            raise weewx.UnsupportedFeature, "Only US Customary Units are supported on the Davis VP2."
+
+        return decodeLoopPacket(buffer, int(self.now() + 0.5))
+
     def translateArchivePacket(self, archivePacket):
         """Translates an archive packet from the internal units used by Davis, into physical units.
         
@@ -510,11 +749,15 @@ class VantagePro (object) :
 #          Primitives for working with the Davis Console
 #===============================================================================
 
-def _wakeup_console(serial_port, max_tries=3, wait_before_retry=1.2):
-    """ Wake up a Davis VantagePro console."""
+def _wakeup_console(serial_port, max_tries=3, wait_before_retry=1.2, wakeup_delay=0.5, stats=None):
+    """ Wake up a Davis VantagePro console.
+    
+    stats: If given, a dictionary of connection statistics to be updated. Default=None"""
     
     # Wake up the console. Try up to max_tries times
     for unused_count in xrange(max_tries) :
+        if stats is not None:
+            stats['wakeups'] += 1
         # Clear out any pending input or output characters:
         serial_port.flushOutput()
         serial_port.flushInput()
@@ -522,7 +765,7 @@ def _wakeup_console(serial_port, max_tries=3, wait_before_retry=1.2):
         # when in the middle of a LOOP command. Send a whole bunch of line feeds,
         # then flush everything, then look for the \n\r acknowledgment
         serial_port.write('\n\n\n')
-        time.sleep(0.5)
+        time.sleep(wakeup_delay)
         serial_port.flushInput()
         serial_port.write('\n')
         _resp = serial_port.read(2)
@@ -550,11 +793,13 @@ def _send_data(serial_port, data):
         syslog.syslog(syslog.LOG_ERR, "VantagePro: No <ACK> received from console")
         raise weewx.AckError, "No <ACK> received from VantagePro console"
     
-def _send_data_with_crc16(serial_port, data, max_tries=3) :
+def _send_data_with_crc16(serial_port, data, max_tries=3, stats=None) :
     """Send data to the Davis console along with a CRC check, waiting for an acknowledging <ack>.
     If none received, resend up to 3 times.
     
-    data: The data to send, as a string"""
+    data: The data to send, as a string
+    
+    stats: If given, a dictionary of connection statistics to be updated. Default=None"""
     
     #Calculate the crc for the data:
     _crc = crc16(data)
@@ -568,12 +813,14 @@ def _send_data_with_crc16(serial_port, data, max_tries=3) :
         # Look for the acknowledgment.
         _resp = serial_port.read()
         if _resp == _ack : break
+        if stats is not None:
+            stats['retries'] += 1
     else :
         syslog.syslog(syslog.LOG_ERR, "VantagePro: Unable to pass CRC16 check while sending data")
         raise weewx.CRCError, "Unable to pass CRC16 check while sending data to VantagePro console"
 
 
-def _get_data_with_crc16(serial_port, nbytes, prompt=None, max_tries=3) :
+def _get_data_with_crc16(serial_port, nbytes, prompt=None, max_tries=3, stats=None) :
     """Get a packet of data and do a CRC16 check on it, asking for retransmit if necessary.
     
     It is guaranteed that the length of the returned data will be of the requested length.
@@ -586,6 +833,8 @@ def _get_data_with_crc16(serial_port, nbytes, prompt=None, max_tries=3) :
     
     max_tries: Number of tries before giving up. Default=3
     
+    stats: If given, a dictionary of connection statistics to be updated. Default=None
+    
     returns: the packet data as a string"""
     if prompt :
         serial_port.write(prompt)
@@ -596,6 +845,9 @@ def _get_data_with_crc16(serial_port, nbytes, prompt=None, max_tries=3) :
         # return it. Otherwise, signal to resend
         if len(_buffer) == nbytes and crc16(_buffer) == 0 : 
             return _buffer
+        if stats is not None:
+            stats['timeouts' if len(_buffer) != nbytes else 'crc_errors'] += 1
+            stats['retries'] += 1
         serial_port.write(_resend)
     else :
         syslog.syslog(syslog.LOG_ERR, "VantagePro: Unable to pass CRC16 check while getting data")
@@ -984,6 +1236,157 @@ _archive_map={'interval'       : _null_int,
               'rxCheckPercent' : _null_float,
               'forecastRule'   : _null}
 
+#===============================================================================
+#                      Compiled decoders
+#===============================================================================
+
+# The decoding functions above that do simple arithmetic, as tuples
+# (offset, multiplier, divisor, sentinel). A value is decoded as
+# float(v + offset) * multiplier / divisor, or None if it equals the sentinel.
+# A value of None means the value is used as is.
+_decode_specs = {_null          : None,
+                 _null_float    : (0,    None, None, None),
+                 _big_val       : (0,    None, None, 0x7fff),
+                 _big_val10     : (0,    None, 10.0, 0x7fff),
+                 _big_val100    : (0,    None, 100.0, 0xffff),
+                 _val100        : (0,    None, 100.0, None),
+                 _val1000       : (0,    None, 1000.0, None),
+                 _val1000Zero   : (0,    None, 1000.0, 0),
+                 _little_val    : (0,    None, None, 0x00ff),
+                 _little_val10  : (0,    None, 10.0, 0x00ff),
+                 _little_temp   : (-90,  None, None, 0x00ff),
+                 _windDir       : (0,    22.5, None, 0x00ff)}
+
+def _compileDecoder(packet_format, raw_types, decode_map, name):
+    """Compile a function that decodes a packet into a record in physical units.
+    
+    The packet is unpacked straight from the buffer, then each type in
+    decode_map that is held in the packet is decoded with inline arithmetic (if
+    its decoding function is in _decode_specs), or a call to its decoding
+    function (if not). Types in decode_map that are not in the packet are skipped.
+    
+    packet_format: A struct.Struct object for the packet.
+    
+    raw_types: The names of the fields held in the packet, in their native order.
+    
+    decode_map: A dictionary mapping a type to its decoding function.
+    
+    name: A name for the generated code, used in tracebacks.
+    
+    returns: A function with signature decode(buffer, offset=0). It returns a
+    2-way tuple (record, data_tuple), where data_tuple holds the raw, unpacked
+    values."""
+    namespace = {'_unpack_from' : packet_format.unpack_from}
+    items = []
+    for _type in raw_types:
+        if not decode_map.has_key(_type):
+            continue
+        func = decode_map[_type]
+        v = '_v[%d]' % list(raw_types).index(_type)
+        if _decode_specs.has_key(func):
+            spec = _decode_specs[func]
+            if spec is None:
+                expr = v
+            else:
+                (offset, multiplier, divisor, sentinel) = spec
+                expr = 'float(%s - %d)' % (v, -offset) if offset else 'float(%s)' % v
+                if multiplier is not None:
+                    expr += ' * %r' % multiplier
+                if divisor is not None:
+                    expr += ' / %r' % divisor
+                if sentinel is not None:
+                    expr = '%s if %s != %d else None' % (expr, v, sentinel)
+        else:
+            namespace['_f_' + _type] = func
+            expr = '_f_%s(%s)' % (_type, v)
+        items.append("        %r : %s," % (_type, expr))
+    lines = ["def decode(buffer, offset=0):",
+             "    _v = _unpack_from(buffer, offset)",
+             "    return ({"] + items + ["        }, _v)"]
+    exec compile('\n'.join(lines) + '\n', name, 'exec') in namespace
+    return namespace['decode']
+
+_decodeLoop    = _compileDecoder(loop_format,    vp2loop,  _loop_map,    'VantagePro LOOP decoder')
+_decodeArchive = _compileDecoder(archive_format, vp2archB, _archive_map, 'VantagePro archive decoder')
+
+# Indexes of a few raw values needed after decoding:
+_date_stamp_index      = vp2archB.index('date_stamp')
+_time_stamp_index      = vp2archB.index('time_stamp')
+_wind_samples_index    = vp2archB.index('number_of_wind_samples')
+
+# An archive record that has never been used is filled with 0xff:
+_unused_record = 52*chr(0xff)
+
+def decodeLoopPacket(raw_packet, time_ts):
+    """Decode a Davis LOOP packet, straight into a record in US Customary Units.
+    
+    This gives the same results as translateLoopToUS(unpackLoopPacket(raw_packet)),
+    but does it in one pass.
+    
+    raw_packet: The loop packet data buffer, as a string.
+    
+    time_ts: The timestamp to be given to the record.
+    
+    returns: A dictionary with the values in US Customary Units."""
+    (record, unused_data) = _decodeLoop(raw_packet)
+    record['dateTime'] = time_ts
+
+    # Add a few derived values that are not in the packet itself.
+    T = record['outTemp']
+    R = record['outHumidity']
+    W = record['windSpeed']
+
+    record['dewpoint']  = weewx.wxformulas.dewpointF(T, R)
+    record['heatindex'] = weewx.wxformulas.heatindexF(T, R)
+    record['windchill'] = weewx.wxformulas.windchillF(T, W)
+    
+    return record
+
+def decodeArchivePage(page, start_index=0, interval=None, model_type=None, iss_id=None):
+    """Decode the archive records in a page of archive memory, straight into
+    records in US units.
+    
+    page: A page of archive data, as a string of 267 bytes: a sequence
+    number, 5 archive records of 52 bytes each, 4 unused bytes, and the CRC.
+    
+    start_index: The index of the first record to be decoded. [Optional. Default is 0]
+    
+    interval: The archive interval in minutes.
+    
+    model_type, iss_id: Needed to calculate the fraction of packets received.
+    
+    returns: A list of dictionaries with the values in US units. It stops
+    short at the first record that has never been used."""
+    records = []
+    for _index in xrange(start_index, 5):
+        _offset = 1 + 52*_index
+        if page[_offset:_offset+52] == _unused_record:
+            break
+        # Check that this is a Rev B style packet. We don't know how to handle any others
+        packet_type = ord(page[_offset+42])
+        if packet_type != 0x0000 :
+            raise weewx.UnknownArchiveType, "Unknown archive type = 0x%x" % packet_type 
+        (record, data) = _decodeArchive(page, _offset)
+        record['interval'] = _null_int(interval)
+        record['rxCheckPercent'] = _null_float(_rxcheck({'model_type'             : model_type,
+                                                        'interval'               : interval,
+                                                        'iss_id'                 : iss_id,
+                                                        'number_of_wind_samples' : data[_wind_samples_index]}))
+    
+        # Add a few derived values that are not in the packet itself.
+        T = record['outTemp']
+        R = record['outHumidity']
+        W = record['windSpeed']
+    
+        record['dewpoint']  = weewx.wxformulas.dewpointF(T, R)
+        record['heatindex'] = weewx.wxformulas.heatindexF(T, R)
+        record['windchill'] = weewx.wxformulas.windchillF(T, W)
+        record['dateTime']  = _archive_datetime({'date_stamp' : data[_date_stamp_index],
+                                                 'time_stamp' : data[_time_stamp_index]})
+        record['usUnits']   = weewx.US
+        records.append(record)
+    return records
+
 if __name__ == '__main__':
     import configobj
     from optparse import OptionParser
@@ -9,7 +9,7 @@
 #
 """Statistical accumulators"""
 
-import math
+import weewx.wxformulas
 
 class OutOfSpan(ValueError):
     """Raised when a record is outside of a timespan"""
@@ -184,8 +184,9 @@ class WindAccum(StdAccum):
             # a significant number of bad theta's (equal to None), then vecavg
             # could be off slightly.  
             if theta is not None :
-                self.xsum      += speed * math.cos(math.radians(90.0 - theta))
-                self.ysum      += speed * math.sin(math.radians(90.0 - theta))
+                (x, y) = weewx.wxformulas.unit_vector(theta)
+                self.xsum      += speed * x
+                self.ysum      += speed * y
     
     def addToRms(self, rec):
         """Add a record to the wind-specific rms stats"""
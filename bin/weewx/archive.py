@@ -11,10 +11,10 @@
 from __future__ import with_statement
 import syslog
 import os.path
-import math
 from pysqlite2 import dbapi2 as sqlite3
     
 import weewx.units
+import weewx.wxformulas
 import weeutil.weeutil
 import weeutil.dbutil
 
@@ -328,6 +328,8 @@ class Archive(object):
         time_vec = list()
         data_vec = list()
         std_unit_system = None
+        # Local binding, to avoid the attribute lookups inside the loops below:
+        unit_vector = weewx.wxformulas.unit_vector
         _connection = sqlite3.connect(self.archiveFilename)
         _cursor=_connection.cursor()
 
@@ -382,8 +384,9 @@ class Archive(object):
                             # No need to do the arithmetic if mag is zero.
                             # We also need a good direction
                             if mag > 0.0 and dir is not None:
-                                xsum += mag * math.cos(math.radians(90.0 - dir))
-                                ysum += mag * math.sin(math.radians(90.0 - dir))
+                                (x, y) = unit_vector(dir)
+                                xsum += mag * x
+                                ysum += mag * y
                 # We've gone through the whole interval. Was their any good data?
                 if count:
                     # Record the time of the last good data point:
@@ -397,8 +400,7 @@ class Archive(object):
                                 assert(mag_extreme <= 1.0e-6)
                             x_extreme = y_extreme = 0.0
                         else:
-                            x_extreme = mag_extreme * math.cos(math.radians(90.0 - dir_at_extreme))
-                            y_extreme = mag_extreme * math.sin(math.radians(90.0 - dir_at_extreme))
+                            (x_extreme, y_extreme) = weewx.wxformulas.wind_components(mag_extreme, dir_at_extreme)
                         data_vec.append(complex(x_extreme, y_extreme))
                     elif aggregate_type == 'sum':
                         data_vec.append(complex(xsum, ysum))
@@ -426,8 +428,9 @@ class Archive(object):
                 if mag is None or dir is None:
                     data_vec.append(None)
                 else:
-                    x = mag * math.cos(math.radians(90.0 - dir))
-                    y = mag * math.sin(math.radians(90.0 - dir))
+                    (x, y) = unit_vector(dir)
+                    x *= mag
+                    y *= mag
                     if weewx.debug:
                         # There seem to be some little rounding errors that are driving
                         # my debugging crazy. Zero them out
@@ -0,0 +1,213 @@
+#
+#    Copyright (c) 2011 Tom Keffer <tkeffer@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+#    $Revision$
+#    $Author$
+#    $Date$
+#
+"""Compiled calibration corrections and quality checks.
+
+The calibration corrections and the quality control limits given in the
+configuration file are compiled once, into a single piece of code that
+does all the work for a packet in one call, rather than looking up and
+evaluating each type separately for every packet.
+"""
+
+import StringIO
+import __builtin__
+import keyword
+import syslog
+import tokenize
+
+#===============================================================================
+#                    Class Calibrator
+#===============================================================================
+
+class Calibrator(object):
+    """Applies a set of calibration expressions to packets.
+
+    The expressions are applied in the order given. Each one sees the results
+    of the ones before it. A correction is applied only if its type is in the
+    packet and is not None."""
+
+    def __init__(self, correction_list):
+        """Initialize an instance of Calibrator.
+
+        correction_list: A list of 2-way tuples (obs_type, expression), where
+        expression is a string, such as 'outTemp - 0.2'."""
+
+        self.correction_list = list(correction_list)
+
+        # Find all the names used by the expressions. The corrected types, and the
+        # builtins, are bound to local variables in the generated function. A
+        # builtin can be overridden by a value in the packet, just as with eval().
+        # A corrected type that is missing from the packet is None, so it gets skipped.
+        obs_types = [obs_type for (obs_type, expression) in self.correction_list]
+        names = list(obs_types)
+        # An expression that uses any other name gets evaluated with the packet
+        # as its namespace, as before. Then a name that is not there raises
+        # NameError, rather than quietly being None:
+        namespace = {'_eval' : eval, '_globals' : {}}
+        code_list = []
+        for (obs_type, expression) in self.correction_list:
+            # Check the expression now, so an error points at the offending line:
+            code = compile(expression, 'StdCalibrate', 'eval')
+            fast = True
+            for name in _getNames(expression):
+                if name in obs_types:
+                    continue
+                if not hasattr(__builtin__, name):
+                    fast = False
+                elif name not in names:
+                    names.append(name)
+            if fast:
+                code_list.append((obs_type, "(%s)" % expression))
+            else:
+                namespace['_code_%d' % len(code_list)] = code
+                code_list.append((obs_type, "_eval(_code_%d, _globals, packet)" % len(code_list)))
+
+        lines = ["def _calibrate(packet):",
+                 "    _get = packet.get"]
+        for name in names:
+            if name in obs_types:
+                lines.append("    %s = _get(%r)" % (name, name))
+            else:
+                namespace['_default_' + name] = getattr(__builtin__, name)
+                lines.append("    %s = _get(%r, _default_%s)" % (name, name, name))
+        for (obs_type, code) in code_list:
+            lines.append("    if %s is not None:" % (obs_type,))
+            lines.append("        %s = packet[%r] = %s" % (obs_type, obs_type, code))
+        lines.append("    return packet")
+        exec compile('\n'.join(lines) + '\n', 'StdCalibrate', 'exec') in namespace
+        self.apply = namespace['_calibrate']
+
+    def applyToRecords(self, record_list):
+        """Apply all corrections to each of a sequence of records, in place."""
+        _calibrate = self.apply
+        for record in record_list:
+            _calibrate(record)
+
+    def __len__(self):
+        return len(self.correction_list)
+
+def _getNames(expression):
+    """Return the variable names used in an expression."""
+    names = []
+    previous = None
+    for (token_type, token, unused_start, unused_end, unused_line) in tokenize.generate_tokens(StringIO.StringIO(expression).readline):
+        # Skip keywords, the constants, and attributes (the 'sqrt' in 'math.sqrt'):
+        if token_type == tokenize.NAME and not keyword.iskeyword(token) and \
+                token not in ('None', 'True', 'False') and previous != '.':
+            names.append(token)
+        previous = token
+    return names
+
+#===============================================================================
+#                    Class QualityControl
+#===============================================================================
+
+class QualityControl(object):
+    """Sets to None any value that falls outside its limits."""
+
+    def __init__(self, min_max_list):
+        """Initialize an instance of QualityControl.
+
+        min_max_list: A list of 3-way tuples (obs_type, min, max)."""
+
+        self.min_max_list = [(obs_type, float(min_val), float(max_val)) for (obs_type, min_val, max_val) in min_max_list]
+
+        # Generate a function that does all the checks, with the limits as constants:
+        lines = ["def _check(packet):",
+                 "    _get = packet.get"]
+        for (obs_type, min_val, max_val) in self.min_max_list:
+            lines.append("    _val = _get(%r)" % obs_type)
+            lines.append("    if _val is not None and not %r <= _val <= %r:" % (min_val, max_val))
+            lines.append("        packet[%r] = None" % obs_type)
+        lines.append("    return packet")
+        namespace = {}
+        exec compile('\n'.join(lines) + '\n', 'StdQC', 'exec') in namespace
+        self.apply = namespace['_check']
+
+    def applyToRecords(self, record_list):
+        """Apply the checks to each of a sequence of records, in place."""
+        _check = self.apply
+        for record in record_list:
+            _check(record)
+
+    def __len__(self):
+        return len(self.min_max_list)
+
+def _fromConfig(config_dict, section, subsection):
+    try:
+        return config_dict[section][subsection]
+    except KeyError:
+        syslog.syslog(syslog.LOG_DEBUG, "calibrate: No section [%s][[%s]]." % (section, subsection))
+        return None
+
+def calibratorFromConfig(config_dict):
+    """Return a Calibrator for section [Calibrate][[Corrections]]."""
+    correction_dict = _fromConfig(config_dict, 'Calibrate', 'Corrections')
+    if not correction_dict:
+        return Calibrator([])
+    return Calibrator([(obs_type, correction_dict[obs_type]) for obs_type in correction_dict.scalars])
+
+def qualityControlFromConfig(config_dict):
+    """Return a QualityControl for section [QC][[MinMax]]."""
+    min_max_dict = _fromConfig(config_dict, 'QC', 'MinMax')
+    if not min_max_dict:
+        return QualityControl([])
+    return QualityControl([(obs_type, min_max_dict[obs_type][0], min_max_dict[obs_type][1]) for obs_type in min_max_dict.scalars])
+
+
+if __name__ == '__main__':
+
+    # Compare against the old way of doing things: an eval() for each type.
+    import timeit
+
+    correction_list = [('outTemp', 'outTemp - 0.2'), ('barometer', 'barometer + 0.01'),
+                       ('outHumidity', 'outHumidity * 1.02'), ('windSpeed', 'windSpeed * 1.1')]
+    min_max_list    = [('outTemp', -40, 120), ('barometer', 28, 32.5), ('outHumidity', 0, 100)]
+    packet = {'dateTime' : 1300000000, 'outTemp' : 45.2, 'barometer' : 30.12, 'outHumidity' : 99.0,
+              'windSpeed' : 4.0, 'windDir' : 270.0, 'inTemp' : 68.0, 'rainRate' : None}
+
+    corrections  = dict([(obs_type, compile(expr, 'test', 'eval')) for (obs_type, expr) in correction_list])
+    min_max_dict = dict([(obs_type, (float(lo), float(hi))) for (obs_type, lo, hi) in min_max_list])
+
+    def old_way(loopPacket):
+        for obs_type in corrections:
+            if loopPacket.has_key(obs_type) and loopPacket[obs_type] is not None:
+                loopPacket[obs_type] = eval(corrections[obs_type], None, loopPacket)
+        for obs_type in min_max_dict:
+            if loopPacket.has_key(obs_type) and loopPacket[obs_type] is not None:
+                if not min_max_dict[obs_type][0] <= loopPacket[obs_type] <= min_max_dict[obs_type][1]:
+                    loopPacket[obs_type] = None
+
+    calibrator = Calibrator(correction_list)
+    qc         = QualityControl(min_max_list)
+
+    def new_way(loopPacket):
+        calibrator.apply(loopPacket)
+        qc.apply(loopPacket)
+
+    # The results must be the same:
+    p1 = dict(packet)
+    p2 = dict(packet)
+    old_way(p1)
+    new_way(p2)
+    assert p1 == p2, "%s != %s" % (p1, p2)
+    assert p2['outHumidity'] is None
+
+    N = 20000
+    t_old = min(timeit.Timer('old_way(dict(packet))', 'from __main__ import old_way, packet').repeat(3, N)) / N
+    t_new = min(timeit.Timer('new_way(dict(packet))', 'from __main__ import new_way, packet').repeat(3, N)) / N
+    print "Per-type eval:  %.2f microseconds per packet" % (t_old * 1e6,)
+    print "Compiled:       %.2f microseconds per packet (%.1fx)" % (t_new * 1e6, t_old / t_new)
+
+    records = [dict(packet, dateTime=packet['dateTime'] + 300 * i) for i in range(N)]
+    t1 = timeit.default_timer()
+    calibrator.applyToRecords(records)
+    qc.applyToRecords(records)
+    t2 = timeit.default_timer()
+    print "Block of %d records: %.2f microseconds per record" % (N, (t2 - t1) * 1e6 / N)
@@ -11,6 +11,8 @@
 
 """
 import array
+import binascii
+import struct
 
 _table=(
 0x0000,  0x1021,  0x2042,  0x3063,  0x4084,  0x50a5,  0x60c6,  0x70e7,  # 0x00
@@ -49,16 +51,52 @@ _table=(
 
 table = array.array('H',_table)
 
-def crc16(string, crc=0):
-    """ Calculate CRC16 sum"""
+def _crc16_table(string, crc=0):
+    """ Calculate CRC16 sum, one byte at a time, using the table."""
 
     for ch in string:
         crc = (table[((crc>>8)^ord(ch)) & 0xff] ^ (crc<<8)) & 0xffff
     return crc
 
+def _crc16_binascii(string, crc=0):
+    """ Calculate CRC16 sum, using the C implementation in module binascii."""
+    return binascii.crc_hqx(string, crc)
+
+# The Davis CRC is the same as the one used by the old BinHex format, which
+# binascii can calculate much faster. But, make sure it gives exactly the same
+# results as the table before using it:
+def _binascii_ok():
+    try:
+        for (string, crc) in (("", 0), ("123456789", 0), (struct.pack("<HH", 0xCEC6, 0x03A2), 0),
+                              ("".join([chr(i) for i in range(256)]), 0x1d0f)):
+            if _crc16_binascii(string, crc) != _crc16_table(string, crc):
+                return False
+    except AttributeError:
+        # No crc_hqx in this version of Python
+        return False
+    return True
+
+if _binascii_ok():
+    crc16 = _crc16_binascii
+else:
+    crc16 = _crc16_table
+
 
 if __name__ == '__main__' :
-    import struct
+    import random
+    import timeit
     str = struct.pack("<HH", 0xCEC6, 0x03A2)
     crc = crc16(str)
     assert(crc==0xe2b4)
+    
+    # Check that the two versions agree:
+    for i in xrange(2000):
+        s = ''.join([chr(random.randrange(256)) for j in xrange(random.randrange(300))])
+        c = random.randrange(0x10000)
+        assert _crc16_binascii(s, c) == _crc16_table(s, c)
+    
+    print "Using %s" % crc16.__name__
+    page = ''.join([chr(random.randrange(256)) for j in xrange(267)])
+    for f in (_crc16_table, _crc16_binascii):
+        t = min(timeit.Timer(lambda: f(page)).repeat(3, 1000)) / 1000
+        print "%-16s %.2f microseconds per 267 byte page" % (f.__name__, t * 1e6)
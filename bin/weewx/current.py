@@ -0,0 +1,257 @@
+#
+#    Copyright (c) 2011 Tom Keffer <tkeffer@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+#    $Revision$
+#    $Author$
+#    $Date$
+#
+"""An in-memory cache of current conditions, fed from the packet stream.
+
+The engine keeps an instance of CurrentConditions. It holds the latest LOOP
+packet, the archive records of the last day or so, and a few rolling windows
+(rain in the last hour, the last 24 hours, and since the start of the day, the
+highest gust in the last 10 minutes), all kept up to date as the packets come
+in.
+
+Services can find it as attribute 'current' of the engine. Anything else in
+the same process, such as a report generator or the RESTful thread, can look it
+up by the path of the archive database it belongs to:
+
+    current = weewx.current.lookup(archive.archiveFilename)
+    if current:
+        record = current.getArchiveRecord(time_ts)
+
+If there is no cache (for example, when reports are run by themselves), or it
+does not cover the time wanted, the caller should go to the database.
+"""
+
+from __future__ import with_statement
+import collections
+import os.path
+import syslog
+import threading
+
+import weeutil.weeutil
+
+#===============================================================================
+#                    Class CurrentConditions
+#===============================================================================
+
+class CurrentConditions(object):
+    """A thread-safe snapshot of current conditions.
+
+    Archive records must be added in order of increasing time."""
+
+    def __init__(self, history=26*3600, gust_window=600):
+        """Initialize an instance of CurrentConditions.
+
+        history: How many seconds of archive records to keep. It should be more
+        than a day, so rain since the start of the day can be calculated, even
+        on the day DST ends. [Optional. Default is 26 hours]
+
+        gust_window: The length in seconds of the window over which the highest
+        gust is taken. [Optional. Default is 600]"""
+        self.history     = history
+        self.gust_window = gust_window
+        self.lock        = threading.Lock()
+
+        self._loop_packet = None
+        # The archive records of the last 'history' seconds, oldest first:
+        self._records = collections.deque()
+        # All archive records with a timestamp greater than this are in the cache.
+        # Until it has been backfilled, nothing is known:
+        self._coverage_start = None
+
+        # The rain sums at the time of each archive record, as 3-way tuples
+        # (last hour, last 24 hours, since the start of the day), keyed by timestamp:
+        self._rain_sums = {}
+
+        # The candidates for the highest gust, as (timestamp, speed, direction).
+        # The speeds are in decreasing order, so the first is the highest:
+        self._gusts = collections.deque()
+
+    def backfill(self, archive):
+        """Fill the cache with the recent records in an archive database.
+
+        archive: An instance of weewx.archive.Archive, or None if there is no
+        database yet."""
+        lastgood_ts = archive.lastGoodStamp() if archive is not None else None
+        with self.lock:
+            if lastgood_ts is None:
+                # The database is empty, so every record there is in the cache:
+                self._coverage_start = 0
+                return
+            self._coverage_start = lastgood_ts - self.history
+        n = 0
+        for record in archive.genBatchRecords(lastgood_ts - self.history, lastgood_ts):
+            self.addArchiveRecord(record)
+            n += 1
+        syslog.syslog(syslog.LOG_DEBUG, "current: Backfilled %d archive records." % n)
+
+    def addLoopPacket(self, packet):
+        """Add a new LOOP packet."""
+        packet = dict(packet)
+        ts = packet['dateTime']
+        gust = packet.get('windGust')
+        if gust is None:
+            gust = packet.get('windSpeed')
+        with self.lock:
+            self._loop_packet = packet
+            # Keep the gust deque in decreasing order of speed. Anything slower
+            # than the new gust can never be the highest again:
+            if gust is not None:
+                while self._gusts and self._gusts[-1][1] <= gust:
+                    self._gusts.pop()
+                self._gusts.append((ts, gust, packet.get('windDir')))
+            while self._gusts and self._gusts[0][0] <= ts - self.gust_window:
+                self._gusts.popleft()
+
+    def addArchiveRecord(self, record):
+        """Add a new archive record."""
+        record = dict(record)
+        ts = record['dateTime']
+        with self.lock:
+            if ts is None or (self._records and ts <= self._records[-1]['dateTime']):
+                # Out of order. Ignore it.
+                return
+            if self._coverage_start is None:
+                # Not backfilled. Only records from now on will be in the cache:
+                self._coverage_start = ts - 1
+            self._records.append(record)
+            while self._records[0]['dateTime'] <= ts - self.history:
+                self._coverage_start = self._records.popleft()['dateTime']
+                self._rain_sums.pop(self._coverage_start, None)
+
+            # Work out the rain sums now, once, rather than every time they are
+            # asked for. They can only be trusted if all the records they need
+            # are in the cache:
+            sod_ts = weeutil.weeutil.startOfDay(ts)
+            if min(ts - 24*3600, sod_ts - 1) >= self._coverage_start:
+                self._rain_sums[ts] = self._sumRain(ts, sod_ts)
+
+    @property
+    def loop_packet(self):
+        """The latest LOOP packet, or None if there has not been one."""
+        with self.lock:
+            return dict(self._loop_packet) if self._loop_packet is not None else None
+
+    @property
+    def archive_record(self):
+        """The latest archive record, or None if there has not been one."""
+        with self.lock:
+            return dict(self._records[-1]) if self._records else None
+
+    def getRainSums(self, time_ts):
+        """Return the rain up to the archive record with a given timestamp, as a
+        3-way tuple (last hour, last 24 hours, since the start of the day), or
+        None if it is not known.
+
+        The same time spans are used as by the RESTful protocols: the last hour
+        and 24 hours are exclusive on the left, inclusive on the right. The day
+        includes a record at midnight. Each sum is None if there is no rain
+        data in its span (just like SUM(rain) in SQL)."""
+        with self.lock:
+            return self._rain_sums.get(time_ts)
+
+    @property
+    def gust10(self):
+        """The highest gust in the window up to the latest LOOP packet, as a 3-way
+        tuple (timestamp, speed, direction), or None if there is none."""
+        with self.lock:
+            return self._gusts[0] if self._gusts else None
+
+    def covers(self, start_ts, stop_ts):
+        """Return True if the cache holds every archive record with
+        start_ts < dateTime <= stop_ts."""
+        with self.lock:
+            return self._coverage_start is not None and start_ts >= self._coverage_start and \
+                    bool(self._records) and stop_ts <= self._records[-1]['dateTime']
+
+    def getArchiveRecord(self, time_ts):
+        """Return the archive record with a given timestamp, or None if it is
+        not in the cache."""
+        with self.lock:
+            # The one wanted is almost always the latest, so search backwards:
+            for i in xrange(len(self._records) - 1, -1, -1):
+                ts = self._records[i]['dateTime']
+                if ts == time_ts:
+                    return dict(self._records[i])
+                elif ts < time_ts:
+                    break
+        return None
+
+    def rainSum(self, start_ts, stop_ts, include_start=False):
+        """Return the rain in the archive records with start_ts < dateTime <= stop_ts,
+        or None if there is none (just like SUM(rain) in SQL).
+
+        include_start: If True, a record at start_ts is included as well.
+
+        The cache must cover the time span. See covers()."""
+        total = None
+        with self.lock:
+            for i in xrange(len(self._records) - 1, -1, -1):
+                record = self._records[i]
+                ts = record['dateTime']
+                if ts < start_ts or (ts == start_ts and not include_start):
+                    break
+                if ts <= stop_ts and record.get('rain') is not None:
+                    total = record['rain'] if total is None else total + record['rain']
+        return total
+
+    def _sumRain(self, time_ts, sod_ts):
+        """Sum the rain for getRainSums(), in one pass back through the records.
+
+        The lock must be held by the caller."""
+        sum1h = sum24h = sumday = None
+        for i in xrange(len(self._records) - 1, -1, -1):
+            ts = self._records[i]['dateTime']
+            if ts <= time_ts - 24*3600 and ts < sod_ts:
+                break
+            rain = self._records[i].get('rain')
+            if rain is None:
+                continue
+            if ts > time_ts - 3600:
+                sum1h = rain if sum1h is None else sum1h + rain
+            if ts > time_ts - 24*3600:
+                sum24h = rain if sum24h is None else sum24h + rain
+            if ts >= sod_ts:
+                sumday = rain if sumday is None else sumday + rain
+        return (sum1h, sum24h, sumday)
+
+#===============================================================================
+#                    The registry
+#===============================================================================
+
+# Maps the path of an archive database to the cache for it:
+_registry      = {}
+_registry_lock = threading.Lock()
+
+def register(archiveFilename, current):
+    """Make a cache available to the rest of the process."""
+    with _registry_lock:
+        _registry[os.path.abspath(archiveFilename)] = current
+
+def unregister(archiveFilename, current):
+    """Withdraw a cache, if it is still the one registered."""
+    with _registry_lock:
+        path = os.path.abspath(archiveFilename)
+        if _registry.get(path) is current:
+            del _registry[path]
+
+def lookup(archiveFilename):
+    """Return the cache for an archive database, or None if there is none."""
+    with _registry_lock:
+        return _registry.get(os.path.abspath(archiveFilename))
+
+def afterFork():
+    """Call in a child process, right after a fork.
+
+    Only the thread that forked carries on in the child, so a lock held by any
+    other thread at the time would never be released. Give the registry, and
+    each cache in it, a new lock."""
+    global _registry_lock
+    _registry_lock = threading.Lock()
+    for current in _registry.values():
+        current.lock = threading.Lock()
@@ -0,0 +1,229 @@
+#
+#    Copyright (c) 2011 Tom Keffer <tkeffer@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+#    $Revision$
+#    $Author$
+#    $Date$
+#
+"""Deliver engine events to services on their own worker threads.
+
+Normally, the engine calls each service in turn on the same thread that is
+reading the console. A slow service will delay the next read. A service
+that has been marked as 'queued' is instead wrapped in an instance of
+QueuedService, which puts the events into a bounded queue. A dedicated worker
+thread takes them off the queue and calls the service.
+
+Every event for a queued service goes through its queue, so the service
+still sees its events one at a time, and in order.
+
+Only LOOP packets are ever discarded. What happens when the queue is full and
+a new LOOP packet arrives depends on the policy:
+
+  block:       Wait until the worker has made room.
+
+  drop_oldest: Discard the oldest LOOP packet still waiting in the queue.
+
+  coalesce:    Discard all LOOP packets still waiting in the queue. The
+               service will skip straight to the newest one.
+
+All other events (archive packets, etc.) are always accepted, even if the
+queue is full, so they are never lost and never block the engine.
+"""
+
+from __future__ import with_statement
+import collections
+import sys
+import syslog
+import threading
+import time
+
+import weewx
+import weeutil.weeutil
+
+policies = ('block', 'drop_oldest', 'coalesce')
+
+#===============================================================================
+#                    Class EventQueue
+#===============================================================================
+
+class EventQueue(object):
+    """A bounded FIFO queue of events, with a policy for what to do when it is full.
+
+    Each event is a 2-way tuple (event_name, argument-tuple)."""
+
+    def __init__(self, maxsize=100, policy='block'):
+        """Initialize an instance of EventQueue.
+
+        maxsize: The maximum number of LOOP packets that can be waiting in the
+        queue. [Optional. Default is 100]
+
+        policy: What to do with a new LOOP packet when the queue is full.
+        One of 'block', 'drop_oldest', or 'coalesce'. [Optional. Default is 'block']"""
+        if policy not in policies:
+            raise weewx.ViolatedPrecondition, "Unknown queue policy '%s'" % policy
+        self.maxsize    = max(int(maxsize), 1)
+        self.policy     = policy
+        self._events    = collections.deque()
+        self._nloop     = 0
+        self._not_empty = threading.Condition()
+        self._not_full  = threading.Condition(self._not_empty)
+
+        # Metrics:
+        self.max_depth  = 0
+        self.dropped    = 0
+        self.coalesced  = 0
+        self.blocked    = 0.0
+        self.processed  = 0
+
+    def put(self, event, droppable=False):
+        """Put an event in the queue.
+
+        event: A 2-way tuple (event_name, argument-tuple)
+
+        droppable: True if this event may be discarded (LOOP packets)."""
+        with self._not_empty:
+            if droppable:
+                if self._nloop >= self.maxsize:
+                    if self.policy == 'drop_oldest':
+                        self._discard(1)
+                        self.dropped += 1
+                    elif self.policy == 'coalesce':
+                        self.coalesced += self._discard(self._nloop)
+                    else:
+                        t1 = time.time()
+                        while self._nloop >= self.maxsize:
+                            self._not_full.wait()
+                        self.blocked += time.time() - t1
+                self._nloop += 1
+            self._events.append((droppable, event))
+            self.max_depth = max(self.max_depth, len(self._events))
+            self._not_empty.notify()
+
+    def get(self):
+        """Take the next event off the queue, blocking until one is available."""
+        with self._not_empty:
+            while not self._events:
+                self._not_empty.wait()
+            (droppable, event) = self._events.popleft()
+            if droppable:
+                self._nloop -= 1
+                self._not_full.notify()
+            self.processed += 1
+            return event
+
+    @property
+    def depth(self):
+        return len(self._events)
+
+    def _discard(self, n):
+        """Remove up to n of the oldest LOOP packets. Returns how many were removed.
+
+        The lock must be held by the caller."""
+        keep = collections.deque()
+        ndiscarded = 0
+        for (droppable, event) in self._events:
+            if droppable and ndiscarded < n:
+                ndiscarded += 1
+            else:
+                keep.append((droppable, event))
+        self._events = keep
+        self._nloop -= ndiscarded
+        return ndiscarded
+
+#===============================================================================
+#                    Class QueuedService
+#===============================================================================
+
+class QueuedService(object):
+    """Wraps a service, so its events get run on a worker thread.
+
+    Method setup() is run inline, before any other events. Method shutDown()
+    waits for the worker to finish any events still in the queue, then shuts
+    down the service.
+
+    If the service raises an exception on the worker thread, it will be
+    reraised on the engine's thread the next time an event is dispatched,
+    just as if the service had been run inline."""
+
+    def __init__(self, service, name=None, policy='block', maxsize=100):
+        """Initialize an instance of QueuedService.
+
+        service: The service to be wrapped. Usually, an instance of
+        a subclass of weewx.wxengine.StdService.
+
+        name: A name for the service to be used in the log. [Optional. Default
+        is the class name of the service]
+
+        policy: Queue policy. See class EventQueue. [Optional. Default is 'block']
+
+        maxsize: Maximum number of LOOP packets that can be waiting. [Optional. Default is 100]"""
+        self.service  = service
+        self.name     = name if name else service.__class__.__name__
+        self.queue    = EventQueue(maxsize, policy)
+        self.exc_info = None
+        self.thread   = threading.Thread(target=self._run, name="Queued-%s" % self.name)
+        # Allow the program to exit even if the worker is running:
+        self.thread.setDaemon(True)
+        self.thread.start()
+        syslog.syslog(syslog.LOG_DEBUG, "eventbus: Started worker for %s (policy '%s'; queue size %d)" %
+                      (self.name, self.queue.policy, self.queue.maxsize))
+
+    def setup(self):
+        self.service.setup()
+
+    def preloop(self):
+        self._put('preloop')
+
+    def newLoopPacket(self, loopPacket):
+        # The packet is shared with the other services, which may change it
+        # after we return. So, queue a copy.
+        self._put('newLoopPacket', dict(loopPacket), droppable=True)
+
+    def newArchivePacket(self, archivePacket):
+        self._put('newArchivePacket', dict(archivePacket))
+
+    def processArchiveData(self):
+        self.logMetrics()
+        self._put('processArchiveData')
+
+    def shutDown(self):
+        """Drain the queue, stop the worker, then shut down the service."""
+        # A None event signals the worker to exit:
+        self.queue.put(None)
+        self.thread.join(20.0)
+        if self.thread.isAlive():
+            syslog.syslog(syslog.LOG_ERR, "eventbus: Worker for %s did not exit." % self.name)
+        self.service.shutDown()
+
+    def logMetrics(self):
+        _queue = self.queue
+        syslog.syslog(syslog.LOG_DEBUG, "eventbus: %s queue depth %d (max %d); %d processed, %d dropped, %d coalesced; blocked %.2f seconds" %
+                      (self.name, _queue.depth, _queue.max_depth, _queue.processed, _queue.dropped, _queue.coalesced, _queue.blocked))
+
+    def __getattr__(self, attr):
+        # Any other attributes (including custom events) come from the service itself:
+        return getattr(self.service, attr)
+
+    def _put(self, event_name, *args, **kwargs):
+        # If the worker died, reraise its exception on this thread:
+        if self.exc_info:
+            exc_info = self.exc_info
+            self.exc_info = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.queue.put((event_name, args), **kwargs)
+
+    def _run(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            (event_name, args) = event
+            try:
+                getattr(self.service, event_name)(*args)
+            except Exception, e:
+                syslog.syslog(syslog.LOG_CRIT, "eventbus: Caught exception in %s.%s" % (self.name, event_name))
+                syslog.syslog(syslog.LOG_CRIT, "    ****  %s" % e)
+                weeutil.weeutil.log_traceback("    ****  ")
+                self.exc_info = sys.exc_info()
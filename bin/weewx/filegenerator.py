@@ -20,6 +20,7 @@ import Cheetah.Filters
 import weeutil.Almanac
 import weeutil.weeutil
 import weewx.archive
+import weewx.current
 import weewx.reportengine
 import weewx.station
 import weewx.stats
@@ -70,8 +71,14 @@ class FileGenerator(weewx.reportengine.ReportGenerator):
         self.stop_ts  = archive.lastGoodStamp() if self.gen_ts is None else self.gen_ts
         self.start_ts = archive.firstGoodStamp()
         
-        # Get a dictionary with the current record:
-        current_dict = archive.getRecord(self.stop_ts)
+        # Get a dictionary with the current record. If the engine is running in
+        # this process, it is probably in its cache of current conditions:
+        cache = weewx.current.lookup(archiveFilename)
+        record = cache.getArchiveRecord(self.stop_ts) if cache else None
+        if record is not None:
+            current_dict = dict([(obs_type, record.get(obs_type)) for obs_type in archive.sqlkeys])
+        else:
+            current_dict = archive.getRecord(self.stop_ts)
         
         # Wrap it in a ValueDict
         currentRec = weewx.units.ValueDict(current_dict, self.unit_info)
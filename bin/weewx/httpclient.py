@@ -0,0 +1,188 @@
+#
+#    Copyright (c) 2011 Tom Keffer <tkeffer@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+#    $Revision$
+#    $Author$
+#    $Date$
+#
+"""A simple HTTP client that keeps its connection open between requests.
+
+urllib2.urlopen() opens a new connection for every request, so every post
+pays for a DNS lookup and a TCP handshake (plus a TLS handshake for https).
+An instance of KeepAliveClient holds on to one connection to one server, and
+uses it for request after request, for as long as the server will allow.
+
+A connection is not used past its lifetime, so a change in the server's
+address is picked up eventually. If a request fails on a connection that has
+been used before, the server has probably closed it while it was idle, so the
+request is tried once more on a new connection.
+
+Instances are not thread safe. Each thread should have its own.
+"""
+
+import httplib
+import socket
+import syslog
+import time
+import urlparse
+
+class KeepAliveClient(object):
+    """Makes HTTP GET requests to a single server, reusing the connection."""
+
+    def __init__(self, url, timeout=None, lifetime=600):
+        """Initialize an instance of KeepAliveClient.
+
+        url: A URL on the server. Only the scheme ('http' or 'https'), host, and
+        port are used.
+
+        timeout: The socket timeout in seconds. [Optional. Default is the global
+        socket timeout (option socket_timeout in weewx.conf)]
+
+        lifetime: How long a connection can be used before it is replaced, in
+        seconds. [Optional. Default is 600]"""
+        (scheme, netloc) = urlparse.urlsplit(url)[0:2]
+        if scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        elif scheme == 'http':
+            self.connection_class = httplib.HTTPConnection
+        else:
+            raise ValueError, "Unsupported URL scheme '%s'" % scheme
+        self.netloc     = netloc
+        self.timeout    = timeout
+        self.lifetime   = lifetime
+        self.connection = None
+        self.opened_ts  = None
+        self.nrequests  = 0
+        self.stats      = {'requests' : 0, 'connections' : 0, 'reconnects' : 0}
+
+    def get(self, url):
+        """Make a GET request.
+
+        url: The complete URL. It must be on the server given when the client
+        was created.
+
+        returns: A 3-way tuple (status, reason, body). The body is a string.
+
+        Raises an instance of httplib.HTTPException or socket.error if the
+        request fails."""
+        (scheme, netloc, path, query) = urlparse.urlsplit(url)[0:4]
+        if netloc != self.netloc:
+            raise ValueError, "URL %s is not on server %s" % (url, self.netloc)
+        selector = path or '/'
+        if query:
+            selector += '?' + query
+
+        if self.connection and time.time() - self.opened_ts > self.lifetime:
+            self.close()
+        try:
+            return self._request(selector)
+        except (httplib.HTTPException, socket.error):
+            # If the connection was fresh, there is no point trying again:
+            if not self.nrequests:
+                self.close()
+                raise
+        # The server probably closed the connection while it was idle. Try once
+        # more, on a new connection:
+        self.close()
+        self.stats['reconnects'] += 1
+        try:
+            return self._request(selector)
+        except (httplib.HTTPException, socket.error):
+            self.close()
+            raise
+
+    def close(self):
+        if self.connection:
+            try:
+                self.connection.close()
+            except (httplib.HTTPException, socket.error):
+                pass
+        self.connection = None
+        self.nrequests  = 0
+
+    def logStats(self):
+        syslog.syslog(syslog.LOG_DEBUG, "httpclient: %s: %d requests on %d connections (%d reconnects)" %
+                      (self.netloc, self.stats['requests'], self.stats['connections'], self.stats['reconnects']))
+
+    def _request(self, selector):
+        if not self.connection:
+            self._connect()
+        self.connection.request('GET', selector, headers={'Connection' : 'keep-alive'})
+        response = self.connection.getresponse()
+        # The whole body must be read before the connection can be used again:
+        body = response.read()
+        self.nrequests += 1
+        self.stats['requests'] += 1
+        if response.will_close:
+            self.close()
+        return (response.status, response.reason, body)
+
+    def _connect(self):
+        self.connection = self.connection_class(self.netloc)
+        # Connect explicitly, so the timeout can be set on the socket:
+        self.connection.connect()
+        if self.timeout is not None:
+            self.connection.sock.settimeout(self.timeout)
+        self.opened_ts = time.time()
+        self.stats['connections'] += 1
+
+
+if __name__ == '__main__':
+
+    # Compare posts per second with urllib2 and KeepAliveClient, against a
+    # local stand-in for an upload server.
+    import BaseHTTPServer
+    import SocketServer
+    import threading
+    import urllib2
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Send the response in one piece, like a real server:
+        wbufsize = -1
+        def do_GET(self):
+            body = 'success\n'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+    url = "http://127.0.0.1:%d/weatherstation/updateweatherstation.php?action=updateraw&ID=TEST&tempf=%%.1f" % server.server_address[1]
+    N = 500
+
+    t1 = time.time()
+    for i in xrange(N):
+        assert urllib2.urlopen(url % i).read() == 'success\n'
+    t_urllib2 = time.time() - t1
+
+    client = KeepAliveClient(url)
+    t1 = time.time()
+    for i in xrange(N):
+        assert client.get(url % i) == (200, 'OK', 'success\n')
+    t_client = time.time() - t1
+
+    print "urllib2:         %6.0f posts per second" % (N / t_urllib2,)
+    print "KeepAliveClient: %6.0f posts per second (%.1fx)" % (N / t_client, t_urllib2 / t_client)
+    print client.stats
+    assert client.stats['connections'] == 1
+
+    # A connection closed by the server while idle must be replaced:
+    client.connection.sock.close()
+    assert client.get(url % 0)[0] == 200
+    assert client.stats['reconnects'] == 1
+
+    client.close()
+    server.shutdown()
@@ -0,0 +1,257 @@
+#
+#    Copyright (c) 2011 Tom Keffer <tkeffer@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+#    $Revision$
+#    $Author$
+#    $Date$
+#
+"""Measure how long each service takes to handle each engine event.
+
+When profiling is turned on, the engine wraps each service in an instance of
+ProfiledService. The wrapper times every call, and records the result in a
+shared Profiler, keyed by (service, event). Periodically, the engine asks the
+profiler to report. It logs a summary and, optionally, writes the results to
+a JSON file.
+
+When profiling is turned off (the default), no wrapping is done, so there is
+no overhead at all.
+"""
+
+from __future__ import with_statement
+import os
+import syslog
+import threading
+import time
+import timeit
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+# The best timer available on this platform:
+timer = timeit.default_timer
+
+# The events that get timed:
+events = ('setup', 'preloop', 'newLoopPacket', 'newArchivePacket', 'processArchiveData', 'shutDown')
+
+# Upper bounds (in seconds) of the histogram buckets. A last bucket catches
+# anything longer:
+bucket_bounds = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+bucket_labels = ('<0.1ms', '<1ms', '<10ms', '<100ms', '<1s', '<10s', '>=10s')
+
+#===============================================================================
+#                    Class EventStats
+#===============================================================================
+
+class EventStats(object):
+    """Timing statistics for a single (service, event) pair.
+
+    Holds cumulative statistics, plus a histogram and a ring of recent
+    samples for the current reporting interval."""
+
+    def __init__(self, nsamples=500):
+        self.nsamples = nsamples
+        # Cumulative:
+        self.total_count = 0
+        self.total_time  = 0.0
+        self.resetInterval()
+
+    def resetInterval(self):
+        self.count   = 0
+        self.time    = 0.0
+        self.min     = None
+        self.max     = None
+        self.buckets = [0] * (len(bucket_bounds) + 1)
+        self.samples = []
+        self._next   = 0
+
+    def add(self, elapsed):
+        self.count += 1
+        self.time  += elapsed
+        self.total_count += 1
+        self.total_time  += elapsed
+        if self.min is None or elapsed < self.min:
+            self.min = elapsed
+        if self.max is None or elapsed > self.max:
+            self.max = elapsed
+
+        i = 0
+        for bound in bucket_bounds:
+            if elapsed < bound:
+                break
+            i += 1
+        self.buckets[i] += 1
+
+        # Keep the last nsamples samples in a ring buffer:
+        if len(self.samples) < self.nsamples:
+            self.samples.append(elapsed)
+        else:
+            self.samples[self._next] = elapsed
+            self._next = (self._next + 1) % self.nsamples
+
+    def percentile(self, p):
+        """Return the p'th percentile of the recent samples, or None if there are none."""
+        if not self.samples:
+            return None
+        _sorted = sorted(self.samples)
+        return _sorted[min(int(len(_sorted) * p / 100.0), len(_sorted) - 1)]
+
+    def toDict(self):
+        return {'count'       : self.count,
+                'time'        : self.time,
+                'mean'        : self.time / self.count if self.count else None,
+                'min'         : self.min,
+                'max'         : self.max,
+                'p50'         : self.percentile(50),
+                'p95'         : self.percentile(95),
+                'histogram'   : dict(zip(bucket_labels, self.buckets)),
+                'total_count' : self.total_count,
+                'total_time'  : self.total_time}
+
+#===============================================================================
+#                    Class Profiler
+#===============================================================================
+
+class Profiler(object):
+    """Collects timings for all services, and reports them periodically."""
+
+    def __init__(self, report_interval=3600, profile_file=None):
+        """Initialize an instance of Profiler.
+
+        report_interval: How often to report, in seconds. [Optional. Default is 3600]
+
+        profile_file: Path to a file where the results should be written in JSON.
+        If None, the results are only logged. [Optional. Default is None]"""
+        self.report_interval = report_interval
+        self.profile_file    = profile_file
+        self.stats           = {}
+        self.lock            = threading.Lock()
+        self.interval_start  = time.time()
+        if profile_file and json is None:
+            syslog.syslog(syslog.LOG_ERR, "profiler: No json or simplejson module. Results will only be logged.")
+            self.profile_file = None
+
+    def wrap(self, service, name):
+        """Wrap a service, so its events get timed."""
+        return ProfiledService(service, name, self)
+
+    def record(self, name, event, elapsed):
+        # Services run on different threads, so this must be locked:
+        with self.lock:
+            try:
+                stats = self.stats[(name, event)]
+            except KeyError:
+                stats = self.stats[(name, event)] = EventStats()
+            stats.add(elapsed)
+
+    def maybeReport(self):
+        """Report, if the reporting interval has passed."""
+        if time.time() - self.interval_start >= self.report_interval:
+            self.report()
+
+    def report(self):
+        """Log the results for the current interval, write them out, then start a new interval."""
+        now = time.time()
+        with self.lock:
+            results = {}
+            for (name, event) in sorted(self.stats.keys()):
+                results.setdefault(name, {})[event] = self.stats[(name, event)].toDict()
+                self.stats[(name, event)].resetInterval()
+            interval_start = self.interval_start
+            self.interval_start = now
+
+        syslog.syslog(syslog.LOG_INFO, "profiler: Service timings for the last %.0f seconds:" % (now - interval_start))
+        for name in sorted(results.keys()):
+            for event in events:
+                if event in results[name] and results[name][event]['count']:
+                    r = results[name][event]
+                    syslog.syslog(syslog.LOG_INFO, "    ****  %s.%s: %d calls; mean %.2f ms; p95 %.2f ms; max %.2f ms; total %.2f s" %
+                                  (name, event, r['count'], r['mean'] * 1000.0, r['p95'] * 1000.0, r['max'] * 1000.0, r['time']))
+
+        if self.profile_file:
+            self.writeResults({'start' : interval_start, 'stop' : now, 'services' : results})
+
+    def writeResults(self, results):
+        # Write to a temporary file, then rename it, so readers never see a partial file:
+        tmp_file = self.profile_file + '.tmp'
+        try:
+            f = open(tmp_file, 'w')
+            try:
+                json.dump(results, f, indent=2)
+            finally:
+                f.close()
+            os.rename(tmp_file, self.profile_file)
+        except (IOError, OSError), e:
+            syslog.syslog(syslog.LOG_ERR, "profiler: Unable to write profile file %s" % self.profile_file)
+            syslog.syslog(syslog.LOG_ERR, "    ****  %s" % e)
+
+#===============================================================================
+#                    Class ProfiledService
+#===============================================================================
+
+class ProfiledService(object):
+    """Wraps a service, timing each of its events."""
+
+    def __init__(self, service, name, profiler):
+        self.service  = service
+        self.name     = name
+        self.profiler = profiler
+
+    def setup(self):
+        self._time('setup')
+
+    def preloop(self):
+        self._time('preloop')
+
+    def newLoopPacket(self, loopPacket):
+        self._time('newLoopPacket', loopPacket)
+
+    def newArchivePacket(self, archivePacket):
+        self._time('newArchivePacket', archivePacket)
+
+    def processArchiveData(self):
+        self._time('processArchiveData')
+
+    def shutDown(self):
+        self._time('shutDown')
+
+    def __getattr__(self, attr):
+        # Any other attributes come from the service itself:
+        return getattr(self.service, attr)
+
+    def _time(self, event, *args):
+        t1 = timer()
+        try:
+            getattr(self.service, event)(*args)
+        finally:
+            self.profiler.record(self.name, event, timer() - t1)
+
+
+if __name__ == '__main__':
+
+    # Measure the overhead of the wrapper.
+    class Dummy(object):
+        def newLoopPacket(self, loopPacket):
+            pass
+
+    profiler = Profiler()
+    svc      = Dummy()
+    wrapped  = profiler.wrap(svc, 'Dummy')
+    packet   = {'dateTime' : 0}
+
+    t = timeit.Timer('svc.newLoopPacket(packet)', 'from __main__ import svc, packet')
+    direct = min(t.repeat(3, 100000)) / 100000
+    t = timeit.Timer('wrapped.newLoopPacket(packet)', 'from __main__ import wrapped, packet')
+    profiled = min(t.repeat(3, 100000)) / 100000
+    print "Direct call:   %.2f microseconds" % (direct * 1e6,)
+    print "Profiled call: %.2f microseconds" % (profiled * 1e6,)
+
+    stats = profiler.stats[('Dummy', 'newLoopPacket')]
+    assert stats.total_count == 300000
+    print stats.toDict()
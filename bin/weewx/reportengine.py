@@ -21,8 +21,17 @@ import time
 
 import configobj
 
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5. The reports will be run one at a time.
+    multiprocessing = None
+
 import weewx
+import weewx.current
+import weewx.restful
 import weeutil.ftpupload
+import weeutil.upload
 import weeutil.weeutil
 
 class StdReportEngine(threading.Thread):
@@ -37,13 +46,21 @@ class StdReportEngine(threading.Thread):
     StdReportEngine inherits from threading.Thread, so it will be run in a separate
     thread.
     
+    If option report_processes in section [Reports] is more than 1, up to that
+    many reports are run at once, each in a process of its own. A report that
+    uploads (one using an UploadGenerator) waits for the reports it publishes:
+    those named by its option depends_on or, if there is none, all the reports
+    that do not upload. It is run on a thread of this process, so the state of
+    its circuit breaker carries over from one run to the next.
+    
     See below for examples of generators.
     """
     
     def __init__(self, config_path, gen_ts = None, first_run = True):
         """Initializer for the report engine. 
         
-        config_path: File path to the configuration dictionary.
+        config_path: File path to the configuration dictionary. The configuration
+        dictionary itself can also be given.
         
         gen_ts: The timestamp for which the output is to be current [Optional; default
         is the last time in the database]
@@ -75,63 +92,164 @@ class StdReportEngine(threading.Thread):
         Runs through the list of reports. """
         
         self.setup()
-
-        # Iterate over each requested report
-        for report in self.config_dict['Reports'].sections:
-            
-            syslog.syslog(syslog.LOG_DEBUG, "reportengine: Running report %s" % report)
+        
+        t1 = time.time()
+        nprocesses = int(self.config_dict['Reports'].get('report_processes', 1))
+        if nprocesses > 1 and multiprocessing is None:
+            syslog.syslog(syslog.LOG_INFO, "reportengine: No multiprocessing module. Reports will be run one at a time.")
+        if nprocesses > 1 and multiprocessing is not None:
+            self.runParallel(nprocesses)
+        else:
+            # Iterate over each requested report
+            for report in self.config_dict['Reports'].sections:
+                skin_dict = self.getSkinDict(report)
+                if skin_dict is not None:
+                    self.runReport(report, skin_dict)
+        t2 = time.time()
+        syslog.syslog(syslog.LOG_DEBUG, "reportengine: Ran all reports in %.2f seconds" % (t2 - t1))
+        
+    def getSkinDict(self, report):
+        """Return the skin configuration dictionary for a report, with all the
+        overrides applied, or None if it cannot be found."""
+        
+        # Figure out where the configuration file is for the skin used for this report:
+        skin_config_path = os.path.join(self.config_dict['Station']['WEEWX_ROOT'],
+                                        self.config_dict['Reports']['SKIN_ROOT'],
+                                        self.config_dict['Reports'][report].get('skin', 'Standard'),
+                                        'skin.conf')
+        # Retrieve the configuration dictionary for the skin. Wrap it in a try
+        # block in case we fail
+        try :
+            skin_dict = configobj.ConfigObj(skin_config_path, file_error=True)
+            syslog.syslog(syslog.LOG_DEBUG, "reportengine: Found configuration file %s for report %s" % (skin_config_path, report))
+        except IOError:
+            syslog.syslog(syslog.LOG_ERR, "reportengine: No skin configuration file for report %s" % report)
+            syslog.syslog(syslog.LOG_ERR, "        ****  Tried path %s" % skin_config_path)
+            syslog.syslog(syslog.LOG_ERR, "        ****  Report ignored...")
+            return None
             
-            # Figure out where the configuration file is for the skin used for this report:
-            skin_config_path = os.path.join(self.config_dict['Station']['WEEWX_ROOT'],
-                                            self.config_dict['Reports']['SKIN_ROOT'],
-                                            self.config_dict['Reports'][report].get('skin', 'Standard'),
-                                            'skin.conf')
-            # Retrieve the configuration dictionary for the skin. Wrap it in a try
-            # block in case we fail
-            try :
-                skin_dict = configobj.ConfigObj(skin_config_path, file_error=True)
-                syslog.syslog(syslog.LOG_DEBUG, "reportengine: Found configuration file %s for report %s" % (skin_config_path, report))
-            except IOError:
-                syslog.syslog(syslog.LOG_ERR, "reportengine: No skin configuration file for report %s" % report)
-                syslog.syslog(syslog.LOG_ERR, "        ****  Tried path %s" % skin_config_path)
-                syslog.syslog(syslog.LOG_ERR, "        ****  Report ignored...")
+        # Inject any overrides the user may have specified in the weewx.conf
+        # configuration file for all reports:
+        for scalar in self.config_dict['Reports'].scalars:
+            skin_dict[scalar] = self.config_dict['Reports'][scalar]
+        
+        # Now inject any overrides for this specific report:
+        skin_dict.merge(self.config_dict['Reports'][report])
+        
+        # Finally, add the report name:
+        skin_dict['REPORT_NAME'] = report
+        
+        return skin_dict
+    
+    def runReport(self, report, skin_dict):
+        """Run the generators of a report, one after another."""
+        
+        syslog.syslog(syslog.LOG_DEBUG, "reportengine: Running report %s" % report)
+        
+        for generator in weeutil.weeutil.option_as_list(skin_dict['Generators'].get('generator_list')):
+            try:
+                # Instantiate an instance of the class.
+                obj = weeutil.weeutil._get_object(generator, 
+                                                  self.config_dict, 
+                                                  skin_dict, 
+                                                  self.gen_ts, 
+                                                  self.first_run)
+            except Exception, e:
+                syslog.syslog(syslog.LOG_CRIT, "reportengine: Unable to instantiate generator %s." % generator)
+                syslog.syslog(syslog.LOG_CRIT, "        ****  %s" % e)
+                syslog.syslog(syslog.LOG_CRIT, "        ****  Generator ignored...")
                 continue
+
+            t1 = time.time()
+            try:
+                # Call its start() method
+                obj.start()
                 
-            # Inject any overrides the user may have specified in the weewx.conf
-            # configuration file for all reports:
-            for scalar in self.config_dict['Reports'].scalars:
-                skin_dict[scalar] = self.config_dict['Reports'][scalar]
-            
-            # Now inject any overrides for this specific report:
-            skin_dict.merge(self.config_dict['Reports'][report])
-            
-            # Finally, add the report name:
-            skin_dict['REPORT_NAME'] = report
-            
+            except Exception, e:
+                # Caught unrecoverable error. Log it, exit
+                syslog.syslog(syslog.LOG_CRIT, "reportengine: Caught unrecoverable exception in generator %s" % (generator,))
+                syslog.syslog(syslog.LOG_CRIT, "        ****  %s" % e)
+                weeutil.weeutil.log_traceback("        ****  ")
+                syslog.syslog(syslog.LOG_CRIT, "        ****  Generator terminated...")
+            t2 = time.time()
+            syslog.syslog(syslog.LOG_DEBUG, "reportengine: Generator %s for report %s ran in %.2f seconds" % (generator, report, t2 - t1))
+
+    def runParallel(self, nprocesses):
+        """Run the reports up to nprocesses at a time, each as soon as the
+        reports it depends on are done."""
+        
+        # Each task is a 4-way tuple (report, skin_dict, depends_on, is_upload):
+        task_list = []
+        for report in self.config_dict['Reports'].sections:
+            skin_dict = self.getSkinDict(report)
+            if skin_dict is None:
+                continue
+            is_upload = False
             for generator in weeutil.weeutil.option_as_list(skin_dict['Generators'].get('generator_list')):
                 try:
-                    # Instantiate an instance of the class.
-                    obj = weeutil.weeutil._get_object(generator, 
-                                                      self.config_dict, 
-                                                      skin_dict, 
-                                                      self.gen_ts, 
-                                                      self.first_run)
-                except Exception, e:
-                    syslog.syslog(syslog.LOG_CRIT, "reportengine: Unable to instantiate generator %s." % generator)
-                    syslog.syslog(syslog.LOG_CRIT, "        ****  %s" % e)
-                    syslog.syslog(syslog.LOG_CRIT, "        ****  Generator ignored...")
+                    if issubclass(weeutil.weeutil._get_class(generator), UploadGenerator):
+                        is_upload = True
+                except Exception:
+                    # It will be reported when the report is run
+                    pass
+            depends_on = set(weeutil.weeutil.option_as_list(skin_dict.get('depends_on')) or [])
+            for unknown in depends_on - set(self.config_dict['Reports'].sections):
+                syslog.syslog(syslog.LOG_ERR, "reportengine: Report %s depends on unknown report %s. Ignored." % (report, unknown))
+                depends_on.discard(unknown)
+            task_list.append((report, skin_dict, depends_on, is_upload))
+        
+        # By default, an upload waits for all the reports that do not upload:
+        others = set([task[0] for task in task_list if not task[3]])
+        for (report, skin_dict, depends_on, is_upload) in task_list:
+            if is_upload and not depends_on:
+                depends_on.update(others)
+        # Anything not in the list (such as a report that was ignored) is as
+        # good as done:
+        done = set(self.config_dict['Reports'].sections) - set([task[0] for task in task_list])
+        
+        # Maps report name to the process or thread running it:
+        running = {}
+        nchildren = 0
+        while task_list or running:
+            for task in list(task_list):
+                (report, skin_dict, depends_on, is_upload) = task
+                if not depends_on <= done:
                     continue
-    
-                try:
-                    # Call its start() method
-                    obj.start()
-                    
-                except Exception, e:
-                    # Caught unrecoverable error. Log it, exit
-                    syslog.syslog(syslog.LOG_CRIT, "reportengine: Caught unrecoverable exception in generator %s" % (generator,))
-                    syslog.syslog(syslog.LOG_CRIT, "        ****  %s" % e)
-                    weeutil.weeutil.log_traceback("        ****  ")
-                    syslog.syslog(syslog.LOG_CRIT, "        ****  Generator terminated...")
+                if is_upload:
+                    worker = threading.Thread(target=self.runReport, args=(report, skin_dict), name="Report-%s" % report)
+                elif nchildren < nprocesses:
+                    worker = multiprocessing.Process(target=self._runChild, args=(report, skin_dict), name="Report-%s" % report)
+                    nchildren += 1
+                else:
+                    continue
+                worker.start()
+                running[report] = worker
+                task_list.remove(task)
+            
+            if task_list and not running:
+                # Nothing can start. The reports must depend on each other in a circle:
+                syslog.syslog(syslog.LOG_ERR, "reportengine: Reports %s depend on each other. Running them anyway." %
+                              (', '.join([task[0] for task in task_list]),))
+                for task in task_list:
+                    task[2].clear()
+                continue
+            
+            time.sleep(0.05)
+            for (report, worker) in running.items():
+                if worker.is_alive():
+                    continue
+                worker.join()
+                del running[report]
+                done.add(report)
+                if isinstance(worker, multiprocessing.Process):
+                    nchildren -= 1
+                    if worker.exitcode:
+                        syslog.syslog(syslog.LOG_ERR, "reportengine: Process for report %s exited with code %d" % (report, worker.exitcode))
+
+    def _runChild(self, report, skin_dict):
+        """Run a report in a child process."""
+        weewx.current.afterFork()
+        self.runReport(report, skin_dict)
 
 
 class ReportGenerator(object):
@@ -148,38 +266,83 @@ class ReportGenerator(object):
     def run(self):
         pass
 
-class FtpGenerator(ReportGenerator):
-    """Class for managing the "FTP generator".
+class UploadGenerator(ReportGenerator):
+    """Class for managing the "upload generator".
     
-    This will ftp everything in the public_html subdirectory to a webserver."""
+    This will publish everything in the public_html subdirectory to a
+    webserver. Option "method" says how: 'ftp' (the default), 'rsync' (over
+    ssh), or 'local' (to a directory on this machine)."""
 
     def run(self):
 
         t1 = time.time()
 
+        method = self.skin_dict.get('method', 'ftp').lower()
+        if method not in ('ftp', 'rsync', 'local'):
+            syslog.syslog(syslog.LOG_ERR, "reportengine: Unknown upload method '%s' for report %s. Skipped." % (method, self.skin_dict['REPORT_NAME']))
+            return
         try:
-            ftpData = weeutil.ftpupload.FtpUpload(server      = self.skin_dict['server'],
-                                                  user        = self.skin_dict['user'],
-                                                  password    = self.skin_dict['password'],
-                                                  local_root  = os.path.join(self.config_dict['Station']['WEEWX_ROOT'],
-                                                                             self.config_dict['Reports']['HTML_ROOT']),
-                                                  remote_root = self.skin_dict['path'],
-                                                  name        = self.skin_dict['REPORT_NAME'],
-                                                  passive     = bool(self.skin_dict.get('passive', True)),
-                                                  max_tries   = int(self.skin_dict.get('max_tries', 3)))
+            uploader = self.getUploader(method)
         except Exception:
-            syslog.syslog(syslog.LOG_DEBUG, "reportengine: FTP upload not requested. Skipped.")
+            syslog.syslog(syslog.LOG_DEBUG, "reportengine: Upload not requested. Skipped.")
+            return
+
+        # If the server has been failing, do not keep hammering on it. The
+        # circuit breaker says when to try again:
+        archive_file = os.path.join(self.config_dict['Station']['WEEWX_ROOT'],
+                                    self.config_dict['Archive']['archive_file'])
+        breaker = weewx.restful.breakerFromDict("%s-%s" % (method.upper(), self.skin_dict['REPORT_NAME']), self.skin_dict,
+                                                archive_file)
+        if not breaker.allow():
+            syslog.syslog(syslog.LOG_INFO, "reportengine: Upload to %s paused after %d failures. Next try in %.0f seconds." %
+                          (self.skin_dict.get('server', self.skin_dict['path']), breaker.failures, breaker.waitTime()))
             return
 
         try:
-            N = ftpData.run()
-        except (socket.timeout, socket.gaierror, ftplib.all_errors, IOError), e:
+            N = uploader.run()
+        except (socket.timeout, socket.gaierror, ftplib.all_errors, IOError, OSError), e:
             (cl, unused_ob, unused_tr) = sys.exc_info()
-            syslog.syslog(syslog.LOG_ERR, "reportengine: Caught exception %s in FtpGenerator; %s." % (cl, e))
+            syslog.syslog(syslog.LOG_ERR, "reportengine: Caught exception %s in %s; %s." % (cl, self.__class__.__name__, e))
+            breaker.failure()
             return
+        except Exception:
+            # Anything else still has to be recorded, or the breaker could be
+            # left waiting for the outcome of its probe forever:
+            breaker.failure()
+            raise
+        breaker.success()
         
         t2= time.time()
-        syslog.syslog(syslog.LOG_INFO, """reportengine: ftp'd %d files in %0.2f seconds""" % (N, (t2-t1)))
+        syslog.syslog(syslog.LOG_INFO, """reportengine: Uploaded %d files in %0.2f seconds by %s""" % (N, (t2-t1), method))
+
+    def getUploader(self, method):
+        """Return an uploader for the given method, set up from the skin dictionary."""
+        kwargs = {'local_root'      : os.path.join(self.config_dict['Station']['WEEWX_ROOT'],
+                                                   self.config_dict['Reports']['HTML_ROOT']),
+                  'remote_root'     : self.skin_dict['path'],
+                  'name'            : self.skin_dict['REPORT_NAME'],
+                  'max_tries'       : int(self.skin_dict.get('max_tries', 3)),
+                  'retry_delay'     : float(self.skin_dict.get('retry_delay', 2)),
+                  'max_connections' : int(self.skin_dict.get('max_connections', 1))}
+        if method == 'local':
+            return weeutil.upload.LocalUpload(**kwargs)
+        elif method == 'rsync':
+            return weeutil.upload.RsyncUpload(server     = self.skin_dict['server'],
+                                              user       = self.skin_dict.get('user'),
+                                              port       = self.skin_dict.get('port'),
+                                              timeout    = self.skin_dict.get('timeout', self.config_dict.get('socket_timeout')),
+                                              **kwargs)
+        return weeutil.ftpupload.FtpUpload(server      = self.skin_dict['server'],
+                                           user        = self.skin_dict['user'],
+                                           password    = self.skin_dict['password'],
+                                           passive     = bool(self.skin_dict.get('passive', True)),
+                                           use_rename  = self.skin_dict.as_bool('use_rename') if self.skin_dict.has_key('use_rename') else True,
+                                           **kwargs)
+
+class FtpGenerator(UploadGenerator):
+    """Class for managing the "FTP generator".
+    
+    The same as UploadGenerator. Kept for skins that still name it."""
             
                 
 class CopyGenerator(ReportGenerator):
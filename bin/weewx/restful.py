@@ -8,15 +8,21 @@
 #    $Date$
 #
 """Publish weather data to RESTful sites such as the Weather Underground or PWSWeather."""
+from __future__ import with_statement
 import syslog
 import datetime
 import threading
 import httplib
+import os
+import random
+import select
 import urllib
-import urllib2
 import socket
 import time
+from pysqlite2 import dbapi2 as sqlite3
 
+import weewx.current
+import weewx.httpclient
 import weewx.units
 import weeutil.weeutil
 
@@ -36,6 +42,10 @@ class SkippedPost(Exception):
 class REST(object):
     """Abstract base class for RESTful protocols."""
     
+    # True if the site only wants the latest record. If records have piled up
+    # in the queue, only the latest gets posted:
+    latest_only = False
+
     # The types to be retrieved from the arhive database:
     archive_types = ('dateTime', 'usUnits', 'barometer', 'outTemp', 'outHumidity', 
                     'windSpeed', 'windDir', 'windGust', 'dewpoint', 'radiation')
@@ -59,8 +69,24 @@ class REST(object):
         
         sod_ts = weeutil.weeutil.startOfDay(time_ts)
         
+        # The engine keeps the record, and the rain sums up to it, in its cache
+        # of current conditions. Go to the database only if they are not there
+        # (for example, when catching up on old records):
+        current = weewx.current.lookup(archive.archiveFilename)
+        if current:
+            record = current.getArchiveRecord(time_ts)
+            rain_sums = current.getRainSums(time_ts)
+            if record is not None and rain_sums is not None:
+                datadict = dict([(obs_type, record.get(obs_type)) for obs_type in REST.archive_types])
+                if datadict['usUnits'] != weewx.US:
+                    raise weewx.UnsupportedFeature, "Only U.S. Units are supported for the Ambient protocol."
+                (datadict['rain'], datadict['rain24'], datadict['dailyrain']) = rain_sums
+                return datadict
+        
         # Get the values off the archive database:
         sqlrec = archive.getSql(REST.sql_select, time_ts)
+        if sqlrec is None:
+            raise SkippedPost, "No record %d in archive %s" % (time_ts, archive.archiveFilename)
         # Make a dictionary out of them:
         datadict = dict(zip(REST.archive_types, sqlrec))
     
@@ -97,8 +123,8 @@ class Ambient(REST):
     For details of the Ambient upload protocol,
     see http://wiki.wunderground.com/index.php/PWS_-_Upload_Protocol
     
-    For details on how urllib2 works, see "urllib2 - The Missing Manual"
-    at http://www.voidspace.org.uk/python/articles/urllib2.shtml
+    Posts are made with weewx.httpclient.KeepAliveClient, which keeps the
+    connection to the site open for the next post.
     """
 
     # Types and formats of the data to be published:
@@ -128,13 +154,29 @@ class Ambient(REST):
         given a prefix will be chosen on the basis of the upload site.
         
         max_tries: Max # of tries before giving up [Optional. Default
-        is 3]"""
+        is 3]
+        
+        retry_delay: How long to wait before the second try, in seconds.
+        It doubles for each try after that (see function retry_delay())
+        [Optional. Default is 2]
+        
+        timeout: Socket timeout in seconds [Optional. Default is
+        option socket_timeout in weewx.conf]
+        
+        connection_lifetime: How long in seconds a connection to the
+        site can be kept open and reused [Optional. Default is 600]"""
         
         self.site        = site
         self.station     = kwargs['station']
         self.password    = kwargs['password']
         self.http_prefix = kwargs.get('http_prefix', site_url[site])
         self.max_tries   = int(kwargs.get('max_tries', 3))
+        self.retry_delay = float(kwargs.get('retry_delay', 2))
+        timeout          = kwargs.get('timeout')
+        # Posts reuse the same connection, rather than opening a new one each time:
+        self.client      = weewx.httpclient.KeepAliveClient(self.http_prefix,
+                                                            float(timeout) if timeout is not None else None,
+                                                            int(kwargs.get('connection_lifetime', 600)))
 
     def postData(self, archive, time_ts):
         """Post using the Ambient HTTP protocol
@@ -147,19 +189,27 @@ class Ambient(REST):
         
         # Retry up to max_tries times:
         for _count in range(self.max_tries):
+            # Give the site a moment before trying again:
+            if _count:
+                time.sleep(retry_delay(_count, self.retry_delay))
             # Now use an HTTP GET to post the data. Wrap in a try block
             # in case there's a network problem.
             try:
-                _response = urllib2.urlopen(_url)
-            except (urllib2.URLError, socket.error, httplib.BadStatusLine), e:
+                (_status, _reason, _body) = self.client.get(_url)
+            except (httplib.HTTPException, socket.error), e:
                 # Unsuccessful. Log it and go around again for another try
                 syslog.syslog(syslog.LOG_ERR, "restful: Failed attempt #%d to upload to %s" % (_count+1, self.site))
                 syslog.syslog(syslog.LOG_ERR, "   ****  Reason: %s" % (e,))
             else:
+                if _status >= 400:
+                    # An HTTP error. Log it and go around again for another try
+                    syslog.syslog(syslog.LOG_ERR, "restful: Failed attempt #%d to upload to %s" % (_count+1, self.site))
+                    syslog.syslog(syslog.LOG_ERR, "   ****  Reason: HTTP error %d %s" % (_status, _reason))
+                    continue
                 # No exception thrown, but we're still not done.
                 # We have to also check for a bad station ID or password.
                 # It will have the error encoded in the return message:
-                for line in _response:
+                for line in _body.splitlines():
                     # PWSweather signals with 'ERROR', WU with 'INVALID':
                     if line.startswith('ERROR') or line.startswith('INVALID'):
                         # Bad login. No reason to retry. Log it and raise an exception.
@@ -215,6 +265,9 @@ class Ambient(REST):
 class CWOP(REST):
     """Upload using the CWOP protocol. """
 
+    # CWOP does not allow backfilling:
+    latest_only = True
+
     def __init__(self, site, **kwargs):
         """Initialize for a post to CWOP.
         
@@ -240,11 +293,22 @@ class CWOP(REST):
         used for a catchup [Optional. Default is 1800]
         
         max_tries: Max # of tries before giving up [Optional. Default is 3]
+        
+        retry_delay: How long to wait before going through the server list
+        again, in seconds. The wait doubles after each pass, and is jittered,
+        so many stations do not all come back at the same moment (see function
+        retry_delay()) [Optional. Default is 5]
+        
+        max_idle: How long the connection can go unused before it is
+        replaced, in seconds [Optional. Default is 900]
 
         CWOP does not like heavy traffic on their servers, so they encourage
         posts roughly every 15 minutes and at most every 5 minutes. So,
         key 'interval' should be set to no less than 300, but preferably 900.
         Setting it to zero will cause every archive record to be posted.
+        
+        The connection to the server is kept open between posts, so the login
+        is done only once. The server that worked last time is tried first.
         """
         self.site      = site
         self.station   = kwargs['station'].upper()
@@ -259,9 +323,18 @@ class CWOP(REST):
         self.interval  = int(kwargs.get('interval', 0))
         self.stale     = int(kwargs.get('stale', 1800))
         self.max_tries = int(kwargs.get('max_tries', 3))
+        self.retry_delay = float(kwargs.get('retry_delay', 5))
+        self.max_idle  = int(kwargs.get('max_idle', 900))
         
         self._lastpost = None
         
+        # The open connection, when it was last used, and which server it is to:
+        self._sock       = None
+        self._last_used  = None
+        self._server_idx = 0
+        self.stats = {'connects' : 0, 'failovers' : 0, 'posts' : 0,
+                      'connect_time' : 0.0, 'send_time' : 0.0}
+        
     def postData(self, archive, time_ts):
         """Post data to CWOP, using the CWOP protocol."""
         
@@ -294,23 +367,9 @@ class CWOP(REST):
         if _record['usUnits'] != weewx.US:
             raise SkippedPost, "CWOP: Units must be US Customary."
         
-        # Get the login and packet strings:
-        _login = self.getLoginString()
+        # Get the packet string, and send it:
         _tnc_packet = self.getTNCPacket(_record)
-
-        # Get a socket connection:
-        _sock = self._get_connect()
-
-        # Send the login:
-        self._send(_sock, _login)
-
-        # And now the packet
-        self._send(_sock, _tnc_packet)
-        
-        try:
-            _sock.close()
-        except:
-            pass
+        self._send_packet(_tnc_packet)
 
         self._lastpost = time_ts
         
@@ -385,124 +444,553 @@ class CWOP(REST):
         return tnc_packet
     
 
-    def _get_connect(self):
-        
-        # Go through the list of known server:ports, looking for
-        # a connection that works:
-        for serv_addr_str in self.server:
-            server, port = serv_addr_str.split(":")
-            port = int(port)
-            for _count in range(self.max_tries):
+    def _send_packet(self, tnc_packet):
+        """Send a packet, on the open connection if it is still good, otherwise
+        on a new one."""
+        for _count in range(2):
+            reused = self._is_alive()
+            if not reused:
+                self._close()
+                self._connect()
+            t1 = time.time()
+            try:
+                self._sock.sendall(tnc_packet)
+            except socket.error, e:
+                self._close()
+                if reused:
+                    # The server must have dropped the connection. Try again on a new one:
+                    syslog.syslog(syslog.LOG_DEBUG, "restful: Lost connection to %s. Reconnecting." % self.site)
+                    continue
+                syslog.syslog(syslog.LOG_ERR, "restful: Failed to upload to %s" % self.site)
+                raise IOError, "Failed CWOP upload to site %s: %s" % (self.site, e)
+            t2 = time.time()
+            self._last_used = t2
+            self.stats['posts']     += 1
+            self.stats['send_time'] += t2 - t1
+            syslog.syslog(syslog.LOG_DEBUG, "restful: %s: sent packet in %.3f seconds on %s connection. "
+                          "%d posts on %d connections (%d failovers); connect time mean %.3f s" %
+                          (self.site, t2 - t1, "open" if reused else "new", self.stats['posts'], self.stats['connects'],
+                           self.stats['failovers'], self.stats['connect_time'] / max(self.stats['connects'], 1)))
+            return
+
+    def _is_alive(self):
+        """Check whether the open connection can be used. Anything the server
+        has sent in the meantime (such as its keepalive comments) is read and
+        thrown away."""
+        if self._sock is None or time.time() - self._last_used > self.max_idle:
+            return False
+        try:
+            while select.select([self._sock], [], [], 0)[0]:
+                if not self._sock.recv(4096):
+                    # The server has closed the connection:
+                    return False
+        except (socket.error, select.error):
+            return False
+        return True
+
+    def _connect(self):
+        """Connect and log in. Go through the list of known server:ports,
+        starting with the one that worked last time. If none of them work, wait
+        a while, then go through the list again, up to max_tries times."""
+        t1 = time.time()
+        for _count in range(self.max_tries):
+            if _count:
+                # Wait longer each time. The jitter keeps stations from coming
+                # back all at the same moment:
+                _wait = retry_delay(_count, self.retry_delay)
+                syslog.syslog(syslog.LOG_DEBUG, "restful: Waiting %.1f seconds before trying %s again" % (_wait, self.site))
+                time.sleep(_wait)
+            for i in range(len(self.server)):
+                idx = (self._server_idx + i) % len(self.server)
+                server, port = self.server[idx].split(":")
+                port = int(port)
+                sock = None
                 try:
                     sock = socket.socket()
                     sock.connect((server, port))
-                except socket.error, e:
-                    # Unsuccessful. Log it and try again
+                    # Let TCP notice if the server goes away while the connection is idle:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                    self._send(sock, self.getLoginString())
+                except (IOError, socket.error), e:
+                    # Unsuccessful. Log it and try the next server
                     syslog.syslog(syslog.LOG_ERR, "restful: Connection attempt #%d failed to %s server %s:%d" % (_count+1, self.site, server, port))
                     syslog.syslog(syslog.LOG_ERR, "   ****  Reason: %s" % (e,))
-                else:
-                    syslog.syslog(syslog.LOG_DEBUG, "restful: Connected to %s server %s:%d" % (self.site, server, port))
-                    return sock
-                # Couldn't connect on this attempt. Close it, try again.
-                try:
-                    sock.close()
-                except:
-                    pass
-            # If we got here, that server didn't work. Log it and go on to the next one.
-            syslog.syslog(syslog.LOG_ERR, "restful: Unable to connect to %s server %s:%d" % (self.site, server, port))
+                    if sock is not None:
+                        try:
+                            sock.close()
+                        except:
+                            pass
+                    continue
+                if idx != self._server_idx:
+                    self.stats['failovers'] += 1
+                    self._server_idx = idx
+                self._sock       = sock
+                self._last_used  = time.time()
+                self.stats['connects']     += 1
+                self.stats['connect_time'] += self._last_used - t1
+                syslog.syslog(syslog.LOG_DEBUG, "restful: Connected to %s server %s:%d in %.3f seconds" %
+                              (self.site, server, port, self._last_used - t1))
+                return
 
         # If we got here. None of the servers worked. Raise an exception
         raise IOError, "Unable to obtain a socket connection to %s" % (self.site,)
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except:
+                pass
+        self._sock = None
      
     def _send(self, sock, msg):
-        
-        for _count in range(self.max_tries):
+        """Send a message, and wait for the response."""
+        sock.sendall(msg)
+        _resp = sock.recv(1024)
+        if not _resp:
+            raise IOError, "Connection closed by %s server" % (self.site,)
+        return _resp
+    
 
-            try:
-                sock.send(msg)
-            except (IOError, socket.error), e:
-                # Unsuccessful. Log it and go around again for another try
-                syslog.syslog(syslog.LOG_ERR, "restful: Attempt #%d failed to send to %s" % (_count+1, self.site))
-                syslog.syslog(syslog.LOG_ERR, "   ****  Reason: %s" % (e,))
+#===============================================================================
+#                             class CircuitBreaker
+#===============================================================================
+
+def retry_delay(count, base, maximum=None):
+    """Return how long to wait before retry number 'count' (starting with 1).
+    
+    The wait doubles with each retry, starting at 'base' seconds, and is
+    jittered by +/- 50%, so clients that failed together do not all retry at
+    the same moment. It is never more than 'maximum' seconds, if given."""
+    delay = base * 2 ** (count - 1)
+    if maximum is not None:
+        delay = min(delay, maximum)
+    return delay * random.uniform(0.5, 1.5)
+
+class CircuitBreaker(object):
+    """Decides when attempts to reach a site should be made.
+    
+    After a failure, the next attempt is put off for a while: retry_wait
+    seconds, doubling after each failure in a row, up to max_retry_wait
+    seconds. After max_failures failures in a row, the circuit 'opens', and no
+    attempts are made at all for pause_time seconds. Then it goes 'half-open',
+    and a single attempt is allowed, as a probe. If the probe succeeds, the
+    circuit closes again, and things go back to normal. If it fails, the
+    circuit opens for another pause_time seconds.
+    
+    A success at any time resets everything.
+    
+    Usually, an instance is obtained with getBreaker(), so its state is shared
+    by everything uploading to the same site for the same station, and survives
+    a reload."""
+    
+    def __init__(self, name, retry_wait=60, max_retry_wait=600, max_failures=5, pause_time=1800):
+        """Initialize an instance of CircuitBreaker.
+        
+        name: The name of the site. Used for logging.
+        
+        retry_wait: How long to wait after the first failure, in seconds.
+        [Optional. Default is 60]
+        
+        max_retry_wait: The longest wait after repeated failures, in seconds.
+        [Optional. Default is 600]
+        
+        max_failures: How many failures in a row open the circuit. [Optional.
+        Default is 5]
+        
+        pause_time: How long the circuit stays open, in seconds. [Optional.
+        Default is 1800]"""
+        self.name = name
+        self.lock = threading.Lock()
+        self.configure(retry_wait, max_retry_wait, max_failures, pause_time)
+        self.state      = 'closed'
+        self.failures   = 0
+        self.next_ts    = 0
+        self.stats      = {'successes' : 0, 'failures' : 0, 'opened' : 0, 'refused' : 0}
+        
+    def configure(self, retry_wait=60, max_retry_wait=600, max_failures=5, pause_time=1800):
+        """Change the settings, keeping the state."""
+        self.retry_wait     = retry_wait
+        self.max_retry_wait = max_retry_wait
+        self.max_failures   = max_failures
+        self.pause_time     = pause_time
+    
+    def allow(self):
+        """Return True if an attempt can be made now. If the circuit is open
+        and the pause is over, this lets through the probe."""
+        with self.lock:
+            if time.time() < self.next_ts or self.state == 'probing':
+                self.stats['refused'] += 1
+                return False
+            if self.state == 'open':
+                syslog.syslog(syslog.LOG_INFO, "restful: Trying %s again after a pause" % self.name)
+                self.state = 'probing'
+            return True
+    
+    def release(self):
+        """Call if an attempt allowed by allow() was not made after all."""
+        with self.lock:
+            if self.state == 'probing':
+                self.state = 'open'
+    
+    def waitTime(self):
+        """Return how many seconds until the next attempt can be made."""
+        return max(self.next_ts - time.time(), 0)
+    
+    def success(self):
+        with self.lock:
+            if self.state != 'closed':
+                syslog.syslog(syslog.LOG_INFO, "restful: %s is back" % self.name)
+            self.state    = 'closed'
+            self.failures = 0
+            self.next_ts  = 0
+            self.stats['successes'] += 1
+    
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.stats['failures'] += 1
+            if self.state == 'probing' or self.failures >= self.max_failures:
+                if self.state != 'open':
+                    self.stats['opened'] += 1
+                self.state   = 'open'
+                self.next_ts = time.time() + self.pause_time
+                syslog.syslog(syslog.LOG_ERR, "restful: %d failures in a row for %s. Pausing for %d seconds."
+                              % (self.failures, self.name, self.pause_time))
             else:
-                _resp = sock.recv(1024)
-                return _resp
+                self.next_ts = time.time() + retry_delay(self.failures, self.retry_wait, self.max_retry_wait)
+    
+    def toDict(self):
+        """Return the state and counts, for metrics."""
+        with self.lock:
+            d = dict(self.stats)
+            d.update({'state' : 'half-open' if self.state == 'probing' else self.state,
+                      'failures_in_a_row' : self.failures,
+                      'wait' : self.waitTime()})
+            return d
+    
+    def logState(self):
+        d = self.toDict()
+        syslog.syslog(syslog.LOG_DEBUG, "restful: %s: circuit %s; %d failures in a row; next attempt in %.0f seconds; "
+                      "%d successes, %d failures, %d refused, opened %d times" %
+                      (self.name, d['state'], d['failures_in_a_row'], d['wait'],
+                       d['successes'], d['failures'], d['refused'], d['opened']))
+
+# All the circuit breakers, keyed by (site name, path of the archive database).
+# Several stations may post to the same site, each with its own account, so
+# one station's failures must not hold up the others:
+_breakers     = {}
+_breakers_lock = threading.Lock()
+
+def getBreaker(name, archive_file=None, **kwargs):
+    """Return the circuit breaker for a site, creating it if necessary.
+    
+    name: The name of the site.
+    
+    archive_file: The path to the archive database of the station doing the
+    uploading. [Optional. Default is None, for a breaker that is not tied
+    to a station]
+    
+    The other keyword arguments are the settings. See CircuitBreaker."""
+    key = (name, os.path.abspath(archive_file) if archive_file else None)
+    with _breakers_lock:
+        if key in _breakers:
+            _breakers[key].configure(**kwargs)
         else:
-            # This is executed only if the loop terminates normally, meaning
-            # the send failed max_tries times. Log it.
-            syslog.syslog(syslog.LOG_ERR, "restful: Failed to upload to %s" % self.site)
-            raise IOError, "Failed CWOP upload to site %s after %d tries" % (self.site, self.max_tries)
+            _breakers[key] = CircuitBreaker(name, **kwargs)
+        return _breakers[key]
+
+def breakerFromDict(name, option_dict, archive_file=None):
+    """Return the circuit breaker for a site, using the settings in a
+    configuration dictionary, such as a site section of [RESTful]."""
+    return getBreaker(name, archive_file,
+                      retry_wait     = float(option_dict.get('retry_wait', 60)),
+                      max_retry_wait = float(option_dict.get('max_retry_wait', 600)),
+                      max_failures   = int(option_dict.get('max_failures', 5)),
+                      pause_time     = float(option_dict.get('pause_time', 1800)))
+
+def breakerStates():
+    """Return the state of all the circuit breakers, keyed by (site name,
+    path of the archive database)."""
+    with _breakers_lock:
+        items = _breakers.items()
+    return dict([(key, breaker.toDict()) for (key, breaker) in items])
+
+#===============================================================================
+#                             class DurableQueue
+#===============================================================================
+
+# Held while a queue database is being set up, so two stations starting at
+# the same time do not both try to upgrade it:
+_queue_file_lock = threading.Lock()
+
+class DurableQueue(object):
+    """A queue of the timestamps of the records waiting to be posted to a site.
+    
+    The queue is kept in a sqlite database, so records that have not been posted
+    yet survive a restart (or a crash). A timestamp stays in the queue until it
+    is removed, after it has been dealt with. Several sites, and several
+    stations, can share the same database file. Each queue is identified by
+    the archive database the records come from, and the site.
+    """
+    
+    def __init__(self, queue_file, archive_file, site, latest_only=False):
+        """Initialize an instance of DurableQueue.
+        
+        queue_file: Path to the sqlite database file. It will be created if it
+        does not exist.
+        
+        archive_file: Path to the archive database the records come from.
+        
+        site: The name of the site.
+        
+        latest_only: If True, only the latest record gets taken off the queue.
+        Any older ones are discarded. [Optional. Default is False]"""
+        self.queue_file  = queue_file
+        self.archive     = os.path.abspath(archive_file)
+        self.site        = site
+        self.latest_only = latest_only
+        self.closed      = False
+        self.discarded   = 0
+        self.cond        = threading.Condition()
+        
+        with _queue_file_lock:
+            with sqlite3.connect(self.queue_file) as _connection:
+                _columns = [_row[1] for _row in _connection.execute("PRAGMA table_info(queue);")]
+                if _columns and 'archive' not in _columns:
+                    # Made by an older version, which had only the one station.
+                    # The records must be from this archive:
+                    _connection.execute("ALTER TABLE queue RENAME TO queue_old;")
+                self._createTable(_connection)
+                if _columns and 'archive' not in _columns:
+                    _connection.execute("INSERT OR IGNORE INTO queue (archive, site, dateTime) "
+                                        "SELECT ?, site, dateTime FROM queue_old;", (self.archive,))
+                    _connection.execute("DROP TABLE queue_old;")
+                self._size = self._count(_connection)
+        if self._size:
+            syslog.syslog(syslog.LOG_INFO, "restful: %d records waiting to be posted to %s" % (self._size, site))
+    
+    def put(self, time_ts):
+        """Put the timestamp of a record in the queue.
+        
+        A value of None closes the queue. See get()."""
+        self.putMany([time_ts])
+    
+    def putMany(self, ts_list):
+        """Put a list of timestamps in the queue, in one transaction."""
+        with self.cond:
+            if None in ts_list:
+                self.closed = True
+                ts_list = [ts for ts in ts_list if ts is not None]
+            if ts_list:
+                with sqlite3.connect(self.queue_file) as _connection:
+                    for ts in ts_list:
+                        self._size += _connection.execute("INSERT OR IGNORE INTO queue (archive, site, dateTime) VALUES (?, ?, ?)",
+                                                          (self.archive, self.site, ts)).rowcount
+            self.cond.notify()
+    
+    def get(self, max_batch=1):
+        """Return a list of up to max_batch timestamps, oldest first, blocking
+        until there is at least one. They stay in the queue until removed.
+        
+        If the site only wants the latest record, the list holds just the
+        latest, and any older ones are discarded.
+        
+        Returns None once the queue has been closed."""
+        with self.cond:
+            while True:
+                while not self._size and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return None
+                with sqlite3.connect(self.queue_file) as _connection:
+                    if self.latest_only:
+                        latest_ts = _connection.execute("SELECT MAX(dateTime) FROM queue WHERE archive=? AND site=?",
+                                                        (self.archive, self.site)).fetchone()[0]
+                        if latest_ts is not None:
+                            ndiscarded = _connection.execute("DELETE FROM queue WHERE archive=? AND site=? AND dateTime<?",
+                                                             (self.archive, self.site, latest_ts)).rowcount
+                            self._size     -= ndiscarded
+                            self.discarded += ndiscarded
+                            return [latest_ts]
+                    else:
+                        batch = [_row[0] for _row in _connection.execute("SELECT dateTime FROM queue WHERE archive=? AND site=? "
+                                                                         "ORDER BY dateTime LIMIT ?", (self.archive, self.site, max_batch))]
+                        if batch:
+                            return batch
+                    # The count says there is something, but the table does not.
+                    # Believe the table, then wait for more:
+                    self._size = self._count(_connection)
     
+    def remove(self, ts_list):
+        """Remove timestamps from the queue, in one transaction."""
+        if not ts_list:
+            return
+        with self.cond:
+            with sqlite3.connect(self.queue_file) as _connection:
+                for ts in ts_list:
+                    self._size -= _connection.execute("DELETE FROM queue WHERE archive=? AND site=? AND dateTime=?",
+                                                      (self.archive, self.site, ts)).rowcount
+    
+    def _createTable(self, _connection):
+        _connection.execute("CREATE TABLE IF NOT EXISTS queue (archive TEXT NOT NULL, site TEXT NOT NULL, "
+                            "dateTime INTEGER NOT NULL, PRIMARY KEY (archive, site, dateTime));")
+    
+    def _count(self, _connection):
+        return _connection.execute("SELECT COUNT(*) FROM queue WHERE archive=? AND site=?",
+                                   (self.archive, self.site)).fetchone()[0]
+    
+    def qsize(self):
+        return self._size
 
 #===============================================================================
 #                             class RESTThread
 #===============================================================================
-
 class RESTThread(threading.Thread):
-    """Dedicated thread for publishing weather data using RESTful protocol.
+    """Dedicated thread for publishing weather data to a RESTful site.
     
     Inherits from threading.Thread.
 
     Basically, it watches a queue, and if anything appears in it, it publishes it.
-    The queue should be populated with the timestamps of the data records to be published.
+    The queue should be an instance of DurableQueue, populated with the timestamps
+    of the data records to be published.
+    
+    Each site gets its own thread and its own queue, so a site that is slow, or
+    not answering at all, does not hold up posts to the others. After a failed
+    post, the record stays in the queue, and the thread waits before trying it
+    again, for as long as the site's circuit breaker says (see CircuitBreaker).
+    The queue keeps filling while it waits.
+    
+    Records are taken off the queue in batches, so catching up after an outage
+    does not need a database transaction for every record.
     """
-    def __init__(self, archive, queue, station_list):
+    def __init__(self, archive, queue, station, breaker=None, batch_size=50):
         """Initialize an instance of RESTThread.
         
         archive: The archive database. Usually an instance of weewx.archive.Archive 
         
-        queue: An instance of Queue.Queue where the timestamps will appear
+        queue: An instance of DurableQueue where the timestamps will appear
 
-        station_list: An iterable list of RESTStations.
+        station: The RESTful station to post to. An instance of a subclass of REST.
+        
+        breaker: The circuit breaker for the site. An instance of CircuitBreaker.
+        [Optional. Default is the one returned by getBreaker() for the site
+        and archive]
+        
+        batch_size: The most records to take off the queue at a time. [Optional.
+        Default is 50]
         """
-        threading.Thread.__init__(self, name="RESTThread")
+        threading.Thread.__init__(self, name="RESTThread-%s" % station.site)
         # In the strange vocabulary of Python, declaring yourself a "daemon thread"
         # allows the program to exit even if this thread is running:
         self.setDaemon(True)
-        self.archive = archive
-        self.queue   = queue # Fifo queue where new records will appear
-        self.station_list = station_list
+        self.archive        = archive
+        self.queue          = queue # Fifo queue where new records will appear
+        self.station        = station
+        self.breaker        = breaker if breaker is not None else getBreaker(station.site, archive.archiveFilename)
+        self.batch_size     = batch_size
+        # Set when the thread should stop waiting, and exit:
+        self.stop_requested = threading.Event()
+        self.stats    = {'published' : 0, 'failed' : 0, 'skipped' : 0,
+                         'post_time' : 0.0, 'max_post_time' : 0.0, 'lag' : 0.0}
 
     def run(self):
         while True :
             # This will block until something appears in the queue:
-            time_ts = self.queue.get()
+            batch = self.queue.get(self.batch_size)
             
-            # A 'None' value appearing in the queue is our signal to exit
-            if time_ts is None:
+            # A 'None' value is our signal to exit. Anything still in the
+            # queue will be posted next time.
+            if batch is None:
                 return
             
-            # This string is just used for logging:
-            time_str = weeutil.weeutil.timestamp_to_string(time_ts)
-            
-            # Cycle through all the RESTful stations in the list:
-            for station in self.station_list:
-    
-                # Post the data to the upload site. Be prepared to catch any exceptions:
-                try :
-                    station.postData(self.archive, time_ts)
-                # The urllib2 library throws exceptions of type urllib2.URLError, a subclass
-                # of IOError. Hence all relevant exceptions are caught by catching IOError.
-                # Starting with Python v2.6, socket.error is a subclass of IOError as well,
-                # but we keep them separate to support V2.5:
-                except (IOError, socket.error), e:
-                    syslog.syslog(syslog.LOG_ERR, "restful: Unable to publish record %s to %s station %s" % (time_str, station.site, station.station))
-                    syslog.syslog(syslog.LOG_ERR, "   ****  %s" % e)
-                    if hasattr(e, 'reason'):
-                        syslog.syslog(syslog.LOG_ERR, "   ****  Failed to reach server. Reason: %s" % e.reason)
-                    if hasattr(e, 'code'):
-                        syslog.syslog(syslog.LOG_ERR, "   ****  Failed to reach server. Error code: %s" % e.code)
-                except SkippedPost, e:
-                    syslog.syslog(syslog.LOG_DEBUG, "restful: Skipped record %s to %s station %s" % (time_str, station.site, station.station))
-                    syslog.syslog(syslog.LOG_DEBUG, "   ****  %s" % (e,))
-                except Exception, e:
-                    syslog.syslog(syslog.LOG_CRIT, "restful: Unrecoverable error when posting record %s to %s station %s" % (time_str, station.site, station.station))
-                    syslog.syslog(syslog.LOG_CRIT, "   ****  %s" % (e,))
-                    weeutil.weeutil.log_traceback("   ****  ")
-                    syslog.syslog(syslog.LOG_CRIT, "   ****  Thread terminating.")
-                    raise
-                else:
-                    syslog.syslog(syslog.LOG_INFO, "restful: Published record %s to %s station %s" % (time_str, station.site, station.station))
+            # The records that have been dealt with, one way or another:
+            done = []
+            try:
+                for time_ts in batch:
+                    # Wait until the circuit breaker allows another attempt:
+                    while not self.stop_requested.isSet() and not self.breaker.allow():
+                        self.stop_requested.wait(max(self.breaker.waitTime(), 1.0))
+                    if self.stop_requested.isSet():
+                        return
+                    if not self.post(time_ts):
+                        # It failed. Leave it in the queue, and try again later:
+                        break
+                    done.append(time_ts)
+            finally:
+                self.queue.remove(done)
+
+    def post(self, time_ts):
+        """Post a single record. Returns False if it should be tried again later."""
+        station = self.station
+        
+        # This string is just used for logging:
+        time_str = weeutil.weeutil.timestamp_to_string(time_ts)
+        
+        # Post the data to the upload site. Be prepared to catch any exceptions:
+        t1 = time.time()
+        try :
+            station.postData(self.archive, time_ts)
+        except FailedPost, e:
+            # A bad login. Trying the record again will not help.
+            syslog.syslog(syslog.LOG_ERR, "restful: Unable to publish record %s to %s station %s" % (time_str, station.site, station.station))
+            syslog.syslog(syslog.LOG_ERR, "   ****  %s" % e)
+            self.stats['failed'] += 1
+            self.breaker.failure()
+        # The protocols raise IOError (or a subclass) when they give up on a post.
+        # Hence all relevant exceptions are caught by catching IOError.
+        # Starting with Python v2.6, socket.error is a subclass of IOError as well,
+        # but we keep them separate to support V2.5:
+        except (IOError, socket.error), e:
+            syslog.syslog(syslog.LOG_ERR, "restful: Unable to publish record %s to %s station %s" % (time_str, station.site, station.station))
+            syslog.syslog(syslog.LOG_ERR, "   ****  %s" % e)
+            if hasattr(e, 'reason'):
+                syslog.syslog(syslog.LOG_ERR, "   ****  Failed to reach server. Reason: %s" % e.reason)
+            if hasattr(e, 'code'):
+                syslog.syslog(syslog.LOG_ERR, "   ****  Failed to reach server. Error code: %s" % e.code)
+            self.stats['failed'] += 1
+            self.breaker.failure()
+            return False
+        except SkippedPost, e:
+            syslog.syslog(syslog.LOG_DEBUG, "restful: Skipped record %s to %s station %s" % (time_str, station.site, station.station))
+            syslog.syslog(syslog.LOG_DEBUG, "   ****  %s" % (e,))
+            self.stats['skipped'] += 1
+            # The site was not contacted, so this says nothing about it:
+            self.breaker.release()
+        except Exception, e:
+            syslog.syslog(syslog.LOG_CRIT, "restful: Unrecoverable error when posting record %s to %s station %s" % (time_str, station.site, station.station))
+            syslog.syslog(syslog.LOG_CRIT, "   ****  %s" % (e,))
+            weeutil.weeutil.log_traceback("   ****  ")
+            syslog.syslog(syslog.LOG_CRIT, "   ****  Thread terminating.")
+            # Take the record off the queue, so it does not do this again after a restart:
+            self.queue.remove([time_ts])
+            # The breaker outlives this thread. Do not leave it stuck in the middle of a probe:
+            self.breaker.failure()
+            raise
+        else:
+            t2 = time.time()
+            self.breaker.success()
+            self.stats['published']     += 1
+            self.stats['post_time']     += t2 - t1
+            self.stats['max_post_time']  = max(self.stats['max_post_time'], t2 - t1)
+            self.stats['lag']            = t2 - time_ts
+            syslog.syslog(syslog.LOG_INFO, "restful: Published record %s to %s station %s" % (time_str, station.site, station.station))
+        return True
+
+    def stop(self):
+        """Ask the thread to exit, once it has finished any post in progress.
+        Records still in the queue stay there for next time."""
+        self.stop_requested.set()
+        self.queue.put(None)
+
+    def logStats(self):
+        _stats = self.stats
+        mean = _stats['post_time'] / _stats['published'] if _stats['published'] else 0.0
+        syslog.syslog(syslog.LOG_DEBUG, "restful: %s: %d published, %d failed, %d skipped, %d superseded; %d waiting; "
+                      "post time mean %.2f s, max %.2f s; last record %.0f seconds old when published" %
+                      (self.station.site, _stats['published'], _stats['failed'], _stats['skipped'], self.queue.discarded,
+                       self.queue.qsize(), mean, _stats['max_post_time'], _stats['lag']))
+        self.breaker.logState()
 
 
 #===============================================================================
@@ -513,9 +1001,9 @@ if __name__ == '__main__':
            
     import sys
     import configobj
-    import os.path
+    import os
+    import tempfile
     from optparse import OptionParser
-    import Queue
     
     import weewx.archive
     
@@ -591,10 +1079,12 @@ if __name__ == '__main__':
         obj_class = 'weewx.restful.' + site_dict['protocol']
         station = weeutil.weeutil._get_object(obj_class, site, **site_dict) 
 
-        # Create the queue into which we'll put the timestamps of new data
-        queue = Queue.Queue()
+        # Create the queue into which we'll put the timestamps of new data.
+        # Use a scratch database for it, so the real one is not disturbed:
+        queue_file = tempfile.mktemp('.sdb')
+        queue = DurableQueue(queue_file, archive.archiveFilename, site, station.latest_only)
         # Start up the thread:
-        thread = RESTThread(archive, queue, [station])
+        thread = RESTThread(archive, queue, station)
         thread.start()
 
         for row in archive.genSql("SELECT dateTime FROM archive WHERE dateTime >=? and dateTime <= ?", start_ts, stop_ts):
@@ -602,10 +1092,12 @@ if __name__ == '__main__':
             print "Posting station %s for time %s" % (stationName, weeutil.weeutil.timestamp_to_string(ts))
             queue.put(ts)
             
-        # Value 'None' signals to the thread to exit:
+        # Wait for the queue to empty, then signal to the thread to exit:
+        while queue.qsize() and thread.isAlive():
+            time.sleep(0.5)
         queue.put(None)
-        # Wait for exit:
         thread.join()
+        os.remove(queue_file)
     
     main()
     
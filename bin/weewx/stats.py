@@ -643,6 +643,14 @@ class StatsReadonlyDb(object):
         _row = _cursor.fetchone()
         return _row 
         
+    def close(self):
+        """Close the cached sqlite _connection, if any.
+        
+        A new one will be opened, on the calling thread, the next time one is needed."""
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+        
     def _getConnection(self):
         """Return a sqlite _connection"""
         if not self._connection:
@@ -717,6 +725,38 @@ class StatsDb(StatsReadonlyDb):
         # in a single transaction:
         self._setDay(_allStatsDict, rec['dateTime'], writeThrough = True)
             
+    def addArchiveRecords(self, rec_list):
+        """Add a sequence of archive records to the statistical database.
+        
+        This gives the same results as calling addArchiveRecord() for each record,
+        but each day's statistics are written only once, in a single transaction,
+        instead of once per record."""
+
+        _allStatsDict = None
+        _lastUpdate   = None
+        
+        for rec in rec_list:
+            if rec['dateTime'] is None:
+                syslog.syslog(syslog.LOG_ERR, "stats: archive record with null time encountered. Ignored.")
+                continue
+            
+            _sod_ts = weeutil.weeutil.startOfArchiveDay(rec['dateTime'])
+            
+            if _allStatsDict is None or _allStatsDict.startOfDay_ts != _sod_ts:
+                # A new day. Write out the results for the old day (if any),
+                # then retrieve the statistics for the new day:
+                if _allStatsDict is not None:
+                    self._setDay(_allStatsDict, _lastUpdate, writeThrough = True)
+                _allStatsDict = self.day(_sod_ts)
+
+            for _stats_type in self.statsTypes:
+                _allStatsDict[_stats_type].addToHiLow(rec)
+                _allStatsDict[_stats_type].addToSum(rec)
+            _lastUpdate = rec['dateTime']
+
+        if _allStatsDict is not None:
+            self._setDay(_allStatsDict, _lastUpdate, writeThrough = True)
+            
     def addLoopRecord(self, rec):
         """Add a LOOP record to the statistical database."""
 
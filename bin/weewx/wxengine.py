@@ -18,6 +18,7 @@ import signal
 import socket
 import sys
 import syslog
+import threading
 import time
 
 # 3rd party imports:
@@ -27,6 +28,10 @@ import daemon
 # weewx imports:
 import weewx
 import weewx.archive
+import weewx.calibrate
+import weewx.current
+import weewx.eventbus
+import weewx.profiler
 import weewx.stats
 import weewx.restful
 import weewx.reportengine
@@ -64,22 +69,18 @@ class StdEngine(object):
         """
         config_dict = self.getConfiguration(options, args)
         
-        # Set a default socket time out, in case FTP or HTTP hang:
-        timeout = int(config_dict.get('socket_timeout', 20))
-        socket.setdefaulttimeout(timeout)
-
         syslog.openlog('weewx', syslog.LOG_PID|syslog.LOG_CONS)
-        # Look for the debug flag. If set, ask for extra logging
-        weewx.debug = int(config_dict.get('debug', 0))
-        if weewx.debug:
-            syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_DEBUG))
-        else:
-            syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_INFO))
+        self.setupGlobals(config_dict)
 
+        # Keep the configuration, so it can be compared with a new one on a reload:
+        self.config_dict = config_dict
 
         # Set up the weather station hardware:
         self.setupStation(config_dict)
 
+        # Set up the cache of current conditions:
+        self.setupCurrent(config_dict)
+
         # Set up the services to be run:
         self.setupServices(config_dict)
         
@@ -107,14 +108,60 @@ class StdEngine(object):
         
         return config_dict
     
-    def setupServices(self, config_dict):
-        """Set up the services to be run."""
+    def setupGlobals(self, config_dict):
+        """Set up the options at the top of the configuration file."""
+        # Set a default socket time out, in case FTP or HTTP hang:
+        timeout = int(config_dict.get('socket_timeout', 20))
+        socket.setdefaulttimeout(timeout)
+
+        # Look for the debug flag. If set, ask for extra logging
+        weewx.debug = int(config_dict.get('debug', 0))
+        if weewx.debug:
+            syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_DEBUG))
+        else:
+            syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_INFO))
+
+    def setupCurrent(self, config_dict):
+        """Set up the in-memory cache of current conditions, and fill it from the
+        archive database. See module weewx.current."""
+        self.current = weewx.current.CurrentConditions()
+        self.current_archive = os.path.join(config_dict['Station']['WEEWX_ROOT'],
+                                            config_dict['Archive']['archive_file'])
+        try:
+            # If there is no database yet, there is nothing to fill it with:
+            if os.path.exists(self.current_archive):
+                self.current.backfill(weewx.archive.Archive(self.current_archive))
+            else:
+                self.current.backfill(None)
+        except StandardError, e:
+            # Not fatal. The cache will just have to fill up as records come in:
+            syslog.syslog(syslog.LOG_ERR, "wxengine: Unable to fill the cache of current conditions: %s" % e)
+        weewx.current.register(self.current_archive, self.current)
+
+    def setupServices(self, config_dict, service_names=None):
+        """Set up the services to be run.
+        
+        service_names: A list of the services to be run. [Optional. Default is
+        the list given by option service_list in section [Engines][[WxEngine]]]"""
         
-        # This will hold the list of services to be run:
-        self.service_obj = []
+        # This will hold the list of services to be run, and their names:
+        self.service_obj   = []
+        self.service_names = []
+
+        # If requested, time how long each service takes:
+        engine_dict = config_dict['Engines']['WxEngine']
+        if engine_dict.has_key('profile') and engine_dict.as_bool('profile'):
+            profile_file = engine_dict.get('profile_file')
+            if profile_file:
+                profile_file = os.path.join(config_dict['Station']['WEEWX_ROOT'], profile_file)
+            self.profiler = weewx.profiler.Profiler(int(engine_dict.get('profile_interval', 3600)), profile_file)
+            syslog.syslog(syslog.LOG_INFO, "wxengine: Profiling services.")
+        else:
+            self.profiler = None
 
         # Get the names of the services to be run:
-        service_names = weeutil.weeutil.option_as_list(config_dict['Engines']['WxEngine'].get('service_list'))
+        if service_names is None:
+            service_names = weeutil.weeutil.option_as_list(config_dict['Engines']['WxEngine'].get('service_list'))
         
         syslog.syslog(syslog.LOG_DEBUG, "wxengine: List of services to be run:")
         
@@ -125,7 +172,8 @@ class StdEngine(object):
                 # For each listed service in service_list, instantiates an instance of
                 # the class, passing self and the configuration dictionary as the
                 # arguments:
-                self.service_obj.append(weeutil.weeutil._get_object(svc, self, config_dict))
+                self.service_obj.append(self.loadService(svc, config_dict))
+                self.service_names.append(svc)
                 syslog.syslog(syslog.LOG_DEBUG, "    ****  %s" % svc)
         except:
             # An exception occurred. Shut down any running services, 
@@ -133,6 +181,38 @@ class StdEngine(object):
             self.shutDown()
             raise
 
+    def loadService(self, svc, config_dict):
+        """Instantiate a service, wrapping it for queued dispatch if requested.
+        
+        By default, a service is dispatched the way the class says it should be
+        (see StdService.dispatch). This can be overridden for a specific service
+        in section [Engines][[WxEngine]][[[Dispatch]]], using an option of the form
+        
+          service_name = dispatch[, policy[, queue_size]]
+        
+        where 'dispatch' is either 'inline' or 'queued'."""
+        obj = weeutil.weeutil._get_object(svc, self, config_dict)
+
+        # Do the profiling inside any queue, so only the service itself gets timed:
+        if getattr(self, 'profiler', None):
+            obj = self.profiler.wrap(obj, svc)
+
+        dispatch = getattr(obj, 'dispatch',     'inline')
+        policy   = getattr(obj, 'queue_policy', 'block')
+        maxsize  = getattr(obj, 'queue_size',   100)
+        
+        override = weeutil.weeutil.option_as_list(config_dict['Engines']['WxEngine'].get('Dispatch', {}).get(svc))
+        if override:
+            dispatch = override[0]
+            if len(override) > 1: policy  = override[1]
+            if len(override) > 2: maxsize = int(override[2])
+        
+        if dispatch == 'queued':
+            obj = weewx.eventbus.QueuedService(obj, svc, policy, maxsize)
+        elif dispatch != 'inline':
+            raise weewx.ViolatedPrecondition, "Unknown dispatch '%s' for service %s" % (dispatch, svc)
+        return obj
+
     def setupStation(self, config_dict):
         """Set up the weather station hardware."""
         # Get the hardware type from the configuration dictionary.
@@ -175,12 +255,77 @@ class StdEngine(object):
                     # Process the new LOOP packet:
                     self.newLoopPacket(physicalPacket)
                 
+                # If a reload has been requested, do it now, while the station
+                # is not in the middle of a LOOP. A rebuilt service may need to
+                # talk to it:
+                if reload_requested.isSet():
+                    self.reload()
+                
                 # Get and process any new archive data. 
                 self.processArchiveData()
         finally:
             # The main loop has exited. Shut the engine down.
             self.shutDown()
 
+    def reload(self):
+        """Reread the configuration file, then rebuild just the services affected by
+        the changes. The station, and the services that are not affected, carry on
+        as if nothing had happened.
+        
+        A service says which sections of the configuration it depends on with
+        attribute 'config_sections' (see StdService). If the station's configuration
+        or the engine's own configuration has changed, it is not possible to do this
+        piecemeal, so the engine is restarted."""
+        reload_requested.clear()
+        syslog.syslog(syslog.LOG_INFO, "wxengine: Reloading configuration file %s." % self.config_path)
+        try:
+            new_config_dict = self.getConfiguration(None, [self.config_path])
+        except (IOError, configobj.ConfigObjError):
+            syslog.syslog(syslog.LOG_ERR, "    ****  Unable to read the new configuration. Keeping the old one.")
+            return
+        
+        (changed_sections, changed_options) = configDiff(self.config_dict, new_config_dict)
+        if not changed_sections and not changed_options:
+            syslog.syslog(syslog.LOG_INFO, "    ****  No changes.")
+            return
+        
+        # Anything that touches the station or the engine itself needs a restart:
+        station_type = self.config_dict['Station'].get('station_type')
+        for section in ('Station', station_type, 'Engines', 'Stations'):
+            if section in changed_sections:
+                syslog.syslog(syslog.LOG_NOTICE, "    ****  Section [%s] has changed. Restarting." % section)
+                raise Restart
+        
+        if changed_options:
+            self.setupGlobals(new_config_dict)
+
+        # A new archive database needs a new cache:
+        if 'Archive' in changed_sections and self.current:
+            weewx.current.unregister(self.current_archive, self.current)
+            self.setupCurrent(new_config_dict)
+
+        for i in xrange(len(self.service_obj)):
+            sections = getattr(self.service_obj[i], 'config_sections', None)
+            # A service that does not say which sections it uses depends on all of them:
+            if sections is None:
+                if not changed_sections:
+                    continue
+            elif not changed_sections.intersection(sections):
+                continue
+            svc = self.service_names[i]
+            syslog.syslog(syslog.LOG_INFO, "    ****  Rebuilding service %s" % svc)
+            try:
+                self.service_obj[i].shutDown()
+            except Exception, e:
+                syslog.syslog(syslog.LOG_ERR, "    ****  Error while shutting down %s: %s" % (svc, e))
+            # Put a do-nothing service in its place, in case the new one cannot be
+            # built. Then an orderly shutdown is still possible:
+            self.service_obj[i] = StdService(self)
+            self.service_obj[i] = self.loadService(svc, new_config_dict)
+            self.service_obj[i].setup()
+
+        self.config_dict = new_config_dict
+
     def setup(self):
         """Gets run before anything else."""
         
@@ -200,6 +345,10 @@ class StdEngine(object):
 
         for obj in self.service_obj:
             obj.newLoopPacket(loopPacket)
+
+        # Cache the packet as the services left it:
+        if self.current:
+            self.current.addLoopPacket(loopPacket)
             
     def processArchiveData(self):
         """Run after the main loop.
@@ -209,6 +358,9 @@ class StdEngine(object):
         for obj in self.service_obj:
             obj.processArchiveData()
 
+        if self.profiler:
+            self.profiler.maybeReport()
+
     def shutDown(self):
         """Run when an engine shutdown is requested."""
         # If we've gotten as far as having a list of service objects,
@@ -225,6 +377,19 @@ class StdEngine(object):
             # Unbind the list of service objects. This will allow
             # them to be garbage collected w/o a circular reference:
             del self.service_obj
+        
+        if getattr(self, 'profiler', None):
+            self.profiler.report()
+
+        if getattr(self, 'current', None):
+            weewx.current.unregister(self.current_archive, self.current)
+
+        # Close the connection to the station, if it keeps one open:
+        if hasattr(getattr(self, 'station', None), 'closePort'):
+            try:
+                self.station.closePort()
+            except:
+                pass
 
     def getArchivePacketsSince(self, lastgood_ts):
         """Retrieve new archive packets from the station since a specified time.
@@ -241,7 +406,262 @@ class StdEngine(object):
         
         for obj in self.service_obj:
             obj.newArchivePacket(archivePacket)
+
+        if self.current:
+            self.current.addArchiveRecord(archivePacket)
             
+#===============================================================================
+#                    Class MultiStationEngine
+#===============================================================================
+
+class MultiStationEngine(StdEngine):
+    """An engine that drives several weather stations in one process.
+    
+    Each subsection of section [Stations] describes a station. Each station gets
+    its own StationEngine, running its own copy of the services, on its own thread.
+    Its configuration is the main configuration, with the options in the
+    subsection layered on top (see function stationConfig()).
+    
+    The services listed in option 'shared_services' of section [Stations] are run
+    just once, by this engine, on the main thread. They see the LOOP and archive
+    packets of all the stations, tagged with the station's name under key
+    'station_id', and a processArchiveData event whenever a station has
+    processed its archive data."""
+    
+    def setupStation(self, config_dict):
+        """Set up a thread for each station."""
+        # Events from the stations come in through this queue:
+        self.queue = Queue.Queue()
+        self.station_threads = []
+        # The stations must not share their databases or their reports. Map each
+        # path to the first station using it:
+        used_paths = {}
+        for station_id in config_dict['Stations'].sections:
+            station_dict = stationConfig(config_dict, station_id)
+            for (what, path) in stationPaths(station_dict):
+                if used_paths.has_key(path):
+                    raise weewx.ViolatedPrecondition, "Stations %s and %s both use %s %s. Give each its own in section [Stations]" % \
+                                                      (used_paths[path], station_id, what, path)
+                used_paths[path] = station_id
+            self.station_threads.append(StationThread(station_id, station_dict,
+                                                      self.config_path, self.queue))
+        if not self.station_threads:
+            raise weewx.ViolatedPrecondition, "No stations in section [Stations]"
+        
+    def setupCurrent(self, config_dict):
+        # Each station keeps its own cache. There is none for the shared services:
+        self.current = None
+
+    def setupServices(self, config_dict):
+        """Set up the services shared by all stations."""
+        super(MultiStationEngine, self).setupServices(config_dict,
+                            weeutil.weeutil.option_as_list(config_dict['Stations'].get('shared_services')))
+    
+    def run(self):
+        """Start the stations, then pass on their events to the shared services."""
+        try:
+            self.setup()
+            
+            syslog.syslog(syslog.LOG_INFO, "wxengine: Starting %d stations." % len(self.station_threads))
+            for station_thread in self.station_threads:
+                station_thread.start()
+
+            while True:
+                if reload_requested.isSet():
+                    self.reload()
+                # Use a timeout, so signals get handled:
+                try:
+                    (event_name, args) = self.queue.get(True, 1.0)
+                except Queue.Empty:
+                    continue
+                if event_name == 'error':
+                    # A station died. Reraise its exception here:
+                    raise args[0], args[1], args[2]
+                getattr(self, event_name)(*args)
+        finally:
+            self.shutDown()
+    
+    def shutDown(self):
+        """Stop all the stations, then shut down the shared services."""
+        for station_thread in getattr(self, 'station_threads', []):
+            station_thread.stop()
+        for station_thread in getattr(self, 'station_threads', []):
+            if station_thread.isAlive():
+                station_thread.join(20.0)
+        super(MultiStationEngine, self).shutDown()
+
+    def getArchivePacketsSince(self, lastgood_ts):
+        raise weewx.ViolatedPrecondition, "A shared service cannot retrieve archive packets. Use a per-station service."
+
+    def reload(self):
+        """The stations run on their own threads, so they cannot be reloaded piecemeal. Restart."""
+        reload_requested.clear()
+        raise Restart
+
+def configDiff(old_dict, new_dict):
+    """Compare two configurations.
+    
+    returns: A 2-way tuple (changed_sections, changed_options). The first is
+    the set of names of the top level sections that were added, removed or
+    changed. The second is the set of names of the options at the top level
+    that were."""
+    changed_sections = set()
+    for section in set(old_dict.sections).union(new_dict.sections):
+        if not old_dict.has_key(section) or not new_dict.has_key(section) or \
+                old_dict[section].dict() != new_dict[section].dict():
+            changed_sections.add(section)
+    changed_options = set()
+    for option in set(old_dict.scalars).union(new_dict.scalars):
+        if old_dict.get(option) != new_dict.get(option):
+            changed_options.add(option)
+    return (changed_sections, changed_options)
+
+def stationConfig(config_dict, station_id):
+    """Return the configuration for one of the stations in section [Stations].
+    
+    This is a copy of the main configuration, without section [Stations], and with
+    the subsection of the station layered on top. Options at the top level of the
+    subsection go into section [Station]. Any subsections get merged into the sections
+    of the same name. For example:
+    
+      [Stations]
+          [[barn]]
+              station_type = VantagePro
+              [[[VantagePro]]]
+                  port = /dev/ttyUSB1
+              [[[Archive]]]
+                  archive_file = archive/barn.sdb
+    """
+    station_dict = configobj.ConfigObj(config_dict)
+    del station_dict['Stations']
+    overrides = config_dict['Stations'][station_id]
+    for option in overrides.scalars:
+        station_dict['Station'][option] = overrides[option]
+    for section in overrides.sections:
+        if station_dict.has_key(section):
+            station_dict[section].merge(overrides[section])
+        else:
+            station_dict[section] = overrides[section].dict()
+    return station_dict
+
+def stationPaths(station_dict):
+    """Return the files and directories a station writes to.
+
+    station_dict: The configuration for the station. See function stationConfig().
+
+    returns: A list of 2-way tuples (what, path), where path is an absolute path."""
+    weewx_root = station_dict['Station']['WEEWX_ROOT']
+    path_list = []
+    for (section, option) in (('Archive', 'archive_file'), ('Stats', 'stats_file'), ('Reports', 'HTML_ROOT')):
+        if station_dict.has_key(section) and station_dict[section].has_key(option):
+            path_list.append((option, os.path.abspath(os.path.join(weewx_root, station_dict[section][option]))))
+    return path_list
+
+class StationStopped(Exception):
+    """Exception thrown to stop one of the engines of a MultiStationEngine."""
+
+#===============================================================================
+#                    Class StationEngine
+#===============================================================================
+
+class StationEngine(StdEngine):
+    """Drives one of the stations of a MultiStationEngine.
+    
+    It runs its services just like StdEngine, except that packets get tagged
+    with the name of the station, and events get passed on to the shared services."""
+    
+    def __init__(self, station_id, config_dict, config_path, queue):
+        """Initialize an instance of StationEngine.
+        
+        station_id: The name of the station.
+        
+        config_dict: The configuration for the station. See function stationConfig().
+        
+        config_path: Path to the main configuration file.
+        
+        queue: Where to put events for the shared services."""
+        self.station_id     = station_id
+        self.config_dict    = config_dict
+        self.config_path    = config_path
+        self.queue          = queue
+        self.stop_requested = False
+
+        self.setupStation(config_dict)
+        self.setupCurrent(config_dict)
+        self.setupServices(config_dict)
+
+    def newLoopPacket(self, loopPacket):
+        if self.stop_requested:
+            raise StationStopped
+        loopPacket['station_id'] = self.station_id
+        super(StationEngine, self).newLoopPacket(loopPacket)
+        # The packet belongs to this thread, so pass on a copy:
+        self.queue.put(('newLoopPacket', (dict(loopPacket),)))
+
+    def newArchivePacket(self, archivePacket):
+        archivePacket['station_id'] = self.station_id
+        super(StationEngine, self).newArchivePacket(archivePacket)
+        self.queue.put(('newArchivePacket', (dict(archivePacket),)))
+
+    def processArchiveData(self):
+        super(StationEngine, self).processArchiveData()
+        if self.stop_requested:
+            raise StationStopped
+        self.queue.put(('processArchiveData', ()))
+
+    def reload(self):
+        """Reloads are left to the MultiStationEngine, which restarts all the
+        stations. Leave the request for it to see."""
+        pass
+
+#===============================================================================
+#                    Class StationThread
+#===============================================================================
+
+class StationThread(threading.Thread):
+    """Runs the engine for one of the stations of a MultiStationEngine.
+    
+    If the station has an I/O error, its engine is shut down, then started again
+    60 seconds later, without disturbing the other stations. Any other exception
+    gets passed on to the main engine."""
+    
+    def __init__(self, station_id, config_dict, config_path, queue):
+        threading.Thread.__init__(self, name="Station-%s" % station_id)
+        # Allow the program to exit even if a station is stuck:
+        self.setDaemon(True)
+        self.station_id   = station_id
+        self.config_dict  = config_dict
+        self.config_path  = config_path
+        self.queue        = queue
+        self.engine       = None
+        self.stop_event   = threading.Event()
+
+    def run(self):
+        while not self.stop_event.isSet():
+            try:
+                self.engine = StationEngine(self.station_id, self.config_dict, self.config_path, self.queue)
+                if self.stop_event.isSet():
+                    self.engine.shutDown()
+                    return
+                self.engine.run()
+            except StationStopped:
+                return
+            except weewx.WeeWxIOError, e:
+                syslog.syslog(syslog.LOG_CRIT, "wxengine: Station %s caught WeeWxIOError: %s" % (self.station_id, e))
+                syslog.syslog(syslog.LOG_CRIT, "    ****  Waiting 60 seconds then retrying...")
+                self.stop_event.wait(60)
+            except Exception:
+                syslog.syslog(syslog.LOG_CRIT, "wxengine: Station %s caught unrecoverable exception:" % self.station_id)
+                weeutil.weeutil.log_traceback("    ****  ")
+                self.queue.put(('error', sys.exc_info()))
+                return
+
+    def stop(self):
+        """Ask the station to stop. It will stop at the next LOOP packet."""
+        self.stop_event.set()
+        if self.engine:
+            self.engine.stop_requested = True
+
 #===============================================================================
 #                    Class StdService
 #===============================================================================
@@ -249,6 +669,19 @@ class StdEngine(object):
 class StdService(object):
     """Abstract base class for all services."""
     
+    # How the engine should deliver events to the service. Either 'inline'
+    # (on the engine's own thread), or 'queued' (on a worker thread). A queued
+    # service should not modify the packets it is given. See weewx.eventbus.
+    dispatch     = 'inline'
+    # For queued services, what to do with LOOP packets when the queue is full
+    # ('block', 'drop_oldest', or 'coalesce'), and how big the queue is:
+    queue_policy = 'block'
+    queue_size   = 100
+    # The sections of the configuration the service depends on. When the
+    # configuration is reloaded, the service gets rebuilt only if one of them
+    # has changed. None means it depends on all of them.
+    config_sections = None
+    
     def __init__(self, engine, *dummy, **dummy_kwargs):
         self.engine = engine
     
@@ -280,34 +713,22 @@ class StdCalibrate(StdService):
     This service must be run before StdArchive, so the correction is applied
     before the data is archived."""
     
+    config_sections = ('Calibrate',)
+    
     def __init__(self, engine, config_dict):
         super(StdCalibrate, self).__init__(engine, config_dict)
         
-        self.corrections = {}
-        # Get the list of calibration corrections to apply. If a section
-        # is missing, a KeyError exception will get thrown:
-        try:
-            correction_dict = config_dict['Calibrate']['Corrections']
-        except KeyError:
-            return
-        
-        # For each correction, compile it, then save in a dictionary of
-        # corrections to be applied:
-        for obs_type in correction_dict.scalars:
-            self.corrections[obs_type] = compile(correction_dict[obs_type], 
-                                                 'StdCalibrate', 'eval')
+        # Compile all the corrections in section [Calibrate][[Corrections]] into
+        # a single function:
+        self.calibrator = weewx.calibrate.calibratorFromConfig(config_dict)
         
     def newLoopPacket(self, loopPacket):
         """Apply a calibration correction to a LOOP packet"""
-        for obs_type in self.corrections:
-            if loopPacket.has_key(obs_type) and loopPacket[obs_type] is not None:
-                loopPacket[obs_type] = eval(self.corrections[obs_type], None, loopPacket)
+        self.calibrator.apply(loopPacket)
 
     def newArchivePacket(self, archivePacket):
         """Apply a calibration correction to an archive packet"""
-        for obs_type in self.corrections:
-            if archivePacket.has_key(obs_type) and archivePacket[obs_type] is not None:
-                archivePacket[obs_type] = eval(self.corrections[obs_type], None, archivePacket)
+        self.calibrator.apply(archivePacket)
 
 #===============================================================================
 #                    Class StdQC
@@ -316,32 +737,21 @@ class StdCalibrate(StdService):
 class StdQC(StdService):
     """Performs quality check on incoming data."""
     
+    config_sections = ('QC',)
+    
     def __init__(self, engine, config_dict):
         super(StdQC, self).__init__(engine, config_dict)
 
-        self.min_max_dict = {}
-        # Nothing to do if the 'QC' section does not exist in the configuration
-        # dictionary.
-        if config_dict.has_key('QC'):
-            min_max_dict = config_dict['QC']['MinMax']
-    
-            for obs_type in min_max_dict.scalars:
-                self.min_max_dict[obs_type] = (float(min_max_dict[obs_type][0]),
-                                               float(min_max_dict[obs_type][1]))
+        # Compile all the checks in section [QC][[MinMax]] into a single function:
+        self.qc = weewx.calibrate.qualityControlFromConfig(config_dict)
             
     def newLoopPacket(self, loopPacket):
         """Apply quality check to the data in a LOOP packet"""
-        for obs_type in self.min_max_dict:
-            if loopPacket.has_key(obs_type) and loopPacket[obs_type] is not None:
-                if not self.min_max_dict[obs_type][0] <= loopPacket[obs_type] <= self.min_max_dict[obs_type][1]:
-                    loopPacket[obs_type] = None
+        self.qc.apply(loopPacket)
 
     def newArchivePacket(self, archivePacket):
-        """Apply quality check to the data in a LOOP packet"""
-        for obs_type in self.min_max_dict:
-            if archivePacket.has_key(obs_type) and archivePacket[obs_type] is not None:
-                if not self.min_max_dict[obs_type][0] <= archivePacket[obs_type] <= self.min_max_dict[obs_type][1]:
-                    archivePacket[obs_type] = None
+        """Apply quality check to the data in an archive packet"""
+        self.qc.apply(archivePacket)
 
 #===============================================================================
 #                    Class StdArchive
@@ -350,11 +760,28 @@ class StdQC(StdService):
 class StdArchive(StdService):
     """Archives data in the SQL database."""
     
+    config_sections = ('Archive', 'Stats')
+    
     def __init__(self, engine, config_dict):
         super(StdArchive, self).__init__(engine, config_dict)
 
         self.setupArchiveDatabase(config_dict)
         self.setupStatsDatabase(config_dict)
+
+        # If requested, do the database writes on a separate thread:
+        archive_dict = config_dict['Archive']
+        if archive_dict.has_key('background_writer') and archive_dict.as_bool('background_writer'):
+            # From now on, the stats database will only be used by the writer thread. A
+            # sqlite connection cannot be shared between threads, so close the one opened
+            # on this thread:
+            self.statsDb.close()
+            self.writer = ArchiveWriter(self.archive, self.statsDb,
+                                        int(archive_dict.get('writer_batch_size', 50)),
+                                        int(archive_dict.get('writer_queue_size', 500)))
+            self.writer.start()
+            syslog.syslog(syslog.LOG_DEBUG, "wxengine: Started archive writer thread.")
+        else:
+            self.writer = None
     
     def setup(self):
         # This will do a catch up on any data still on the
@@ -364,12 +791,20 @@ class StdArchive(StdService):
     def newLoopPacket(self, physicalPacket):
         """Add LOOP packet data to the statistical hi/lows."""
         
+        if self.writer:
+            self.writer.addLoopRecord(physicalPacket)
+            return
+
         # Add the LOOP record to the stats database:
         self.statsDb.addLoopRecord(physicalPacket)
             
     def newArchivePacket(self, archivePacket):
         """Add a new archive record to the SQL archive and stats databases."""
 
+        if self.writer:
+            self.writer.addArchiveRecord(archivePacket)
+            return
+
         try:
             # Add the new record to the archive database and stats database:
             self.archive.addRecord(archivePacket)
@@ -386,6 +821,17 @@ class StdArchive(StdService):
         # Tell the engine to get all packets off the station since that time:
         self.engine.getArchivePacketsSince(lastgood_ts)
         
+        # The services that follow (such as reports) expect to find the new
+        # records in the databases. Wait until they have all been written:
+        if self.writer:
+            self.writer.flush()
+        
+    def shutDown(self):
+        """Write anything still queued, then stop the writer thread."""
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
+
     def setupArchiveDatabase(self, config_dict):
         """Setup the main database archive"""
         archiveFilename = os.path.join(config_dict['Station']['WEEWX_ROOT'], 
@@ -418,6 +864,149 @@ class StdArchive(StdService):
         # the stats database is already up-to-date.
         weewx.stats.backfill(self.archive, self.statsDb)
         
+#===============================================================================
+#                    Class ArchiveWriter
+#===============================================================================
+
+class ArchiveWriter(threading.Thread):
+    """Thread that writes records to the archive and stats databases.
+    
+    Records are put in a bounded queue. The thread takes them off in batches,
+    so a run of archive records (such as happens when catching up after the
+    console has been offline) gets written in one transaction per database,
+    instead of one per record. Records are always written in the order they
+    were added."""
+    
+    def __init__(self, archive, statsDb, batch_size=50, queue_size=500):
+        """Initialize an instance of ArchiveWriter.
+        
+        archive: An instance of weewx.archive.Archive.
+        
+        statsDb: An instance of weewx.stats.StatsDb. Once the thread has been
+        started, it should not be used by any other thread.
+        
+        batch_size: The largest number of records to be written in one
+        transaction. [Optional. Default is 50]
+        
+        queue_size: The largest number of records that can be waiting. If the
+        queue is full, the engine will wait. [Optional. Default is 500]"""
+        threading.Thread.__init__(self, name="ArchiveWriter")
+        # Allow the program to exit even if the thread is running:
+        self.setDaemon(True)
+        self.archive    = archive
+        self.statsDb    = statsDb
+        self.batch_size = max(batch_size, 1)
+        self.queue      = Queue.Queue(queue_size)
+        self.exc_info   = None
+        
+    def addArchiveRecord(self, record):
+        self._put(('archive', dict(record)))
+        
+    def addLoopRecord(self, record):
+        self._put(('loop', dict(record)))
+        
+    def flush(self):
+        """Wait until everything in the queue has been written."""
+        done = threading.Event()
+        self._put(('flush', done))
+        # Wait with a timeout, so signals still get handled, and a writer
+        # thread that has died gets noticed:
+        while not done.isSet():
+            done.wait(1.0)
+            if not done.isSet() and not self.isAlive():
+                self._died()
+        self._check()
+    
+    def stop(self):
+        """Write everything in the queue, then stop the thread."""
+        # A None in the queue signals the thread to exit. If the thread has
+        # died, nothing will ever make room for it, so give up:
+        while self.isAlive():
+            try:
+                self.queue.put(None, True, 1.0)
+                break
+            except Queue.Full:
+                pass
+        self.join(20.0)
+        if self.isAlive():
+            syslog.syslog(syslog.LOG_ERR, "wxengine: Archive writer thread did not exit.")
+        
+    def run(self):
+        while True:
+            # Block until something shows up, then grab whatever else is
+            # waiting, up to the batch size:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            
+            archive_records = []
+            for item in batch:
+                if item is None or item[0] != 'archive':
+                    # Anything other than an archive record must wait until
+                    # all archive records before it have been written:
+                    self._writeArchiveRecords(archive_records)
+                    archive_records = []
+                if item is None:
+                    # The connection was opened on this thread, so it must be closed here, too:
+                    self.statsDb.close()
+                    return
+                elif item[0] == 'archive':
+                    archive_records.append(item[1])
+                elif item[0] == 'loop':
+                    self._writeLoopRecord(item[1])
+                else:
+                    # A flush. Signal the waiting thread:
+                    item[1].set()
+            self._writeArchiveRecords(archive_records)
+    
+    def _writeArchiveRecords(self, records):
+        if not records:
+            return
+        try:
+            self.archive.addRecord(records)
+            self.statsDb.addArchiveRecords(records)
+        except weewx.ArchiveError:
+            pass
+        except Exception, e:
+            self._fail(e)
+        
+    def _writeLoopRecord(self, record):
+        try:
+            self.statsDb.addLoopRecord(record)
+        except Exception, e:
+            self._fail(e)
+
+    def _fail(self, e):
+        syslog.syslog(syslog.LOG_CRIT, "wxengine: Caught exception in archive writer thread: %s" % e)
+        weeutil.weeutil.log_traceback("    ****  ")
+        # Save it, so it can be reraised on the engine's thread:
+        self.exc_info = sys.exc_info()
+
+    def _put(self, item):
+        self._check()
+        while True:
+            try:
+                self.queue.put(item, True, 1.0)
+                return
+            except Queue.Full:
+                if not self.isAlive():
+                    self._died()
+    
+    def _died(self):
+        """The writer thread is gone. Reraise its exception, if any."""
+        self._check()
+        raise weewx.WeeWxIOError, "Archive writer thread has stopped"
+        
+    def _check(self):
+        # If there was an error on the writer thread, reraise it here:
+        if self.exc_info:
+            exc_info = self.exc_info
+            self.exc_info = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
 #===============================================================================
 #                    Class StdTimeSynch
 #===============================================================================
@@ -425,6 +1014,8 @@ class StdArchive(StdService):
 class StdTimeSynch(StdService):
     """Regularly asks the station to synch up its clock."""
     
+    config_sections = ('Station',)
+    
     def __init__(self, engine, config_dict):
         super(StdTimeSynch, self).__init__(engine, config_dict)
         
@@ -450,6 +1041,8 @@ class StdPrint(StdService):
     """Service that prints diagnostic information when a LOOP
     or archive packet is received."""
     
+    config_sections = ()
+    
     def newLoopPacket(self, loopPacket):
         print "LOOP:  ", weeutil.weeutil.timestamp_to_string(loopPacket['dateTime']),\
                 loopPacket['barometer'],\
@@ -467,8 +1060,10 @@ class StdPrint(StdService):
 #===============================================================================
 
 class StdRESTful(StdService):
-    """Launches a thread that will monitor a queue of new data, which is to be
-    posted to RESTful websites. Then, put new data in the queue. """
+    """Launches a thread for each RESTful upload site, which will monitor a queue
+    of new data to be posted to the site. Then, put new data in the queues. """
+
+    config_sections = ('RESTful', 'Archive')
 
     def __init__(self, engine, config_dict):
         super(StdRESTful, self).__init__(engine, config_dict)
@@ -491,43 +1086,71 @@ class StdRESTful(StdService):
             except KeyError:
                 syslog.syslog(syslog.LOG_DEBUG, "wxengine: Data will not be posted to %s" % (site,))
             else:
-                station_list.append(new_station)
+                station_list.append((new_station, site_dict))
                 syslog.syslog(syslog.LOG_DEBUG, "wxengine: Data will be posted to %s" % (site,))
         
+        # One thread per upload site:
+        self.threads = []
+        
         # Were there any valid upload sites?
         if len(station_list) > 0 :
-            # Yes. Proceed by setting up the queue and thread.
+            # Yes. Proceed by setting up the queues and threads.
             
             # Create an instance of weewx.archive.Archive
             archiveFilename = os.path.join(config_dict['Station']['WEEWX_ROOT'], 
                                            config_dict['Archive']['archive_file'])
             archive = weewx.archive.Archive(archiveFilename)
-            # Create the queue into which we'll put the timestamps of new data
-            self.queue = Queue.Queue()
-            # Start up the thread:
-            self.thread = weewx.restful.RESTThread(archive, self.queue, station_list)
-            self.thread.start()
-            syslog.syslog(syslog.LOG_DEBUG, "wxengine: Started thread for RESTful upload sites.")
+            # The queues are kept in a database, so records waiting to be posted
+            # are not lost on a restart:
+            queueFilename = os.path.join(config_dict['Station']['WEEWX_ROOT'],
+                                         config_dict['RESTful'].get('queue_file', 'archive/restful.sdb'))
+            for (new_station, site_dict) in station_list:
+                # Give each site its own queue, into which we'll put the timestamps
+                # of new data, and start its thread:
+                queue = weewx.restful.DurableQueue(queueFilename, archiveFilename, new_station.site, new_station.latest_only)
+                thread = weewx.restful.RESTThread(archive, queue, new_station,
+                                                  weewx.restful.breakerFromDict(new_station.site, site_dict, archiveFilename))
+                thread.start()
+                self.threads.append(thread)
+            syslog.syslog(syslog.LOG_DEBUG, "wxengine: Started %d threads for RESTful upload sites." % len(self.threads))
         
         else:
-            self.queue  = None
-            self.thread = None
             syslog.syslog(syslog.LOG_DEBUG, "wxengine: No RESTful upload sites. Thread not started.")
         
+        # Timestamps of new archive records, waiting to be posted:
+        self.pending = []
+        
+    def setup(self):
+        # Post any records added while catching up:
+        self.processArchiveData()
+        
     def newArchivePacket(self, archivePacket):
-        """Post the new archive data to the WU queue"""
-        if self.queue:
-            self.queue.put(archivePacket['dateTime'])
+        """Post the new archive data to the upload queues"""
+        if self.threads:
+            # The record may not be in the archive database yet (see
+            # ArchiveWriter), so hold on to the timestamp until it is:
+            self.pending.append(archivePacket['dateTime'])
+
+    def processArchiveData(self):
+        """By now, StdArchive has written all the new records. Post them."""
+        for thread in self.threads:
+            if self.pending:
+                thread.queue.putMany(self.pending)
+            thread.logStats()
+        self.pending = []
 
     def shutDown(self):
-        """Shut down the RESTful thread"""
-        # Make sure we have initialized:
-        if self.queue:
-            # Put a None in the queue. This will signal to the thread to shutdown
-            self.queue.put(None)
-            # Wait for the thread to exit:
-            self.thread.join(20.0)
-            syslog.syslog(syslog.LOG_DEBUG, "Shut down RESTful thread.")
+        """Shut down the RESTful threads"""
+        # Signal all the threads to shut down first, so they can finish together.
+        # Any records they have not posted yet stay in their queues for next time:
+        for thread in self.threads:
+            thread.stop()
+        # Wait for them to exit:
+        for thread in self.threads:
+            thread.join(20.0)
+        if self.threads:
+            syslog.syslog(syslog.LOG_DEBUG, "Shut down RESTful threads.")
+        self.threads = []
             
     def getSiteDict(self, config_dict, site):
         """Return the site dictionary for the given site.
@@ -535,8 +1158,11 @@ class StdRESTful(StdService):
         This function can be overridden by subclassing if you need something
         extra in the site dictionary.
         """
-        # Get the dictionary for this site out of the config dictionary:
-        site_dict = config_dict['RESTful'][site]
+        # Get a copy of the dictionary for this site out of the config
+        # dictionary. It must be a copy: if the configuration itself were
+        # changed, it would no longer match the file, and every reload would
+        # rebuild this service.
+        site_dict = dict(config_dict['RESTful'][site])
         # Some protocols require extra entries:
         site_dict['latitude']  = config_dict['Station']['latitude']
         site_dict['longitude'] = config_dict['Station']['longitude']
@@ -551,6 +1177,9 @@ class StdRESTful(StdService):
 class StdReportService(StdService):
     """Launches a separate thread to do reporting."""
     
+    # The report engine reads the configuration file itself, every time it runs:
+    config_sections = ()
+    
     def __init__(self, engine, config_dict):
         super(StdReportService, self).__init__(engine, config_dict)
         self.thread = None
@@ -559,7 +1188,13 @@ class StdReportService(StdService):
     def processArchiveData(self):
         """This function processes any new archive data"""
         # Now process the data, using a separate thread
-        self.thread = weewx.reportengine.StdReportEngine(self.engine.config_path,
+        # An engine for one of several stations has a configuration of its own,
+        # which is not in any file:
+        if isinstance(self.engine, StationEngine):
+            config = self.engine.config_dict
+        else:
+            config = self.engine.config_path
+        self.thread = weewx.reportengine.StdReportEngine(config,
                                                          first_run = self.first_run) 
         self.thread.start()
         self.first_run = False
@@ -604,15 +1239,28 @@ def parseArgs():
 
 class Restart(Exception):
     """Exception thrown when restarting the engine is desired."""
-    
+
+# Set when a reload of the configuration has been requested. The engine
+# checks it after each batch of LOOP packets (see StdEngine.reload()):
+reload_requested = threading.Event()
+
 def sigHUPhandler(dummy_signum, dummy_frame):
-    syslog.syslog(syslog.LOG_DEBUG, "wxengine: Received signal HUP. Throwing Restart exception.")
-    raise Restart
+    syslog.syslog(syslog.LOG_DEBUG, "wxengine: Received signal HUP. Requesting a reload.")
+    reload_requested.set()
 
 #===============================================================================
 #                    Function main
 #===============================================================================
 
+def _hasStations(config_path):
+    """Return True if the configuration file has any subsections in section [Stations]."""
+    try:
+        config_dict = configobj.ConfigObj(config_path, file_error=True)
+    except (IOError, configobj.ConfigObjError):
+        # Let the engine deal with it
+        return False
+    return config_dict.has_key('Stations') and len(config_dict['Stations'].sections) > 0
+
 def main(EngineClass=StdEngine) :
     """Prepare the main loop and run it. 
 
@@ -626,11 +1274,17 @@ def main(EngineClass=StdEngine) :
     # Get the command line options and arguments:
     (options, args) = parseArgs()
     
+    # If several stations have been configured, drive them all:
+    if EngineClass is StdEngine and _hasStations(args[0]):
+        EngineClass = MultiStationEngine
+
     while True:
 
         try:
     
             os.chdir(cwd)
+            # The new engine reads the configuration file anyway:
+            reload_requested.clear()
             # Create and initialize the engine
             engine = EngineClass(options, args)
             # Set up the reload signal handler:
@@ -657,7 +1311,7 @@ def main(EngineClass=StdEngine) :
             syslog.syslog(syslog.LOG_NOTICE,"wxengine: retrying...")
     
         except Restart:
-            syslog.syslog(syslog.LOG_NOTICE, "wxengine: Received signal HUP. Restarting.")
+            syslog.syslog(syslog.LOG_NOTICE, "wxengine: Restarting.")
             
         # If run from the command line, catch any keyboard interrupts and log them:
         except KeyboardInterrupt:
@@ -88,6 +88,52 @@ def heatindexF(T, R) :
         hiF = T
     return hiF
 
+#===============================================================================
+#                          Wind vector decomposition
+#===============================================================================
+
+# Cache of unit vectors, keyed by compass direction in degrees. Davis consoles
+# quantize wind direction (22.5 degrees in archive records, whole degrees in
+# LOOP packets), so the table stays small. It is seeded with every whole degree
+# and every compass point; other directions are added as they are seen, up to
+# a limit.
+_unit_vectors = {}
+_max_unit_vectors = 4096
+
+def unit_vector(direction):
+    """Return the unit vector pointing in a compass direction.
+    
+    direction: Compass direction in degrees (0 = North, 90 = East).
+    
+    returns: A 2-way tuple (x, y) with the x- (East) and y- (North) components.
+    The values are bit-for-bit the same as math.cos(math.radians(90.0 - direction))
+    and math.sin(math.radians(90.0 - direction))."""
+    try:
+        return _unit_vectors[direction]
+    except KeyError:
+        theta = math.radians(90.0 - direction)
+        _uv = (math.cos(theta), math.sin(theta))
+        if len(_unit_vectors) < _max_unit_vectors:
+            _unit_vectors[direction] = _uv
+        return _uv
+
+def wind_components(speed, direction):
+    """Break a wind speed and direction down into x- and y-components.
+    
+    speed: The wind speed.
+    
+    direction: Compass direction the wind is coming from, in degrees.
+    
+    returns: A 2-way tuple (x, y)."""
+    (x, y) = unit_vector(direction)
+    return (speed * x, speed * y)
+
+for _dir in range(361):
+    unit_vector(float(_dir))
+for _dir in range(16):
+    unit_vector(_dir * 22.5)
+del _dir
+
 def heating_degrees(t, base):
     return max(base - t, 0) if t is not None else None
 
@@ -95,6 +141,22 @@ def cooling_degrees(t, base):
     return max(t - base, 0) if t is not None else None
 
 if __name__ == '__main__':
+    import timeit
+    
+    # Check that the cached unit vectors are exactly the same as the direct calculation:
+    for d in [i * 22.5 for i in range(16)] + range(361) + [0.1 * i for i in range(3600)]:
+        assert(wind_components(3.5, d) == (3.5 * math.cos(math.radians(90.0 - d)),
+                                           3.5 * math.sin(math.radians(90.0 - d))))
+    print "wind_components: PASSES"
+
+    # Now compare the speed of the two:
+    setup  = "import math; from __main__ import unit_vector; dirs = [i * 22.5 for i in range(16)]"
+    direct = "for d in dirs: (5.0 * math.cos(math.radians(90.0 - d)), 5.0 * math.sin(math.radians(90.0 - d)))"
+    cached = "for d in dirs:\n    (x, y) = unit_vector(d)\n    (5.0 * x, 5.0 * y)"
+    t_direct = min(timeit.Timer(direct, setup).repeat(3, 20000))
+    t_cached = min(timeit.Timer(cached, setup).repeat(3, 20000))
+    print "direct math: %.3f seconds; cached unit vectors: %.3f seconds (%.2fx faster)" % (t_direct, t_cached, t_direct / t_cached)
+
     print heatindexF(75.0, 50.0)
     print heatindexF(80.0, 50.0)
     print heatindexF(80.0, 95.0)